@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 10gen Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Bulk export and import of application data stored by DatastoreMongoDBStub.
+
+Every collection of the application database (entities, schema, indexes,
+GridFS files, ...) is streamed into its own file of BSON documents exactly
+as they are stored, optionally compressed by gzip. Indexes of collections
+are stored in the metadata file. Collections are exported and imported
+in parallel worker processes, import uses bulk inserts.
+
+Datastore files of DatastoreFileStub and DatastoreSqliteStub can be loaded
+as well, this needs the App Engine SDK on the python path.
+
+Usage:
+  python datastore_mongodb_bulk.py export APP_ID DIRECTORY [options]
+  python datastore_mongodb_bulk.py import APP_ID DIRECTORY [options]
+  python datastore_mongodb_bulk.py load APP_ID DATASTORE_FILE [options]
+"""
+
+import argparse
+import gzip
+import multiprocessing
+import os
+import cPickle as pickle
+import sqlite3
+import struct
+import sys
+
+import bson
+try:
+    # pymongo >= 2.4
+    from pymongo import MongoClient
+    PYM_2_4 = True
+except ImportError:
+    from pymongo import Connection
+    PYM_2_4 = False
+
+
+class DatabaseNotEmptyError(ValueError):
+    """Raised when data is imported into database which is not empty."""
+
+
+#: name of the file with list of exported collections and their indexes
+METADATA_FILE = '_metadata.bson'
+#: collections which are not exported
+SKIPPED_COLLECTIONS = frozenset([u'system.indexes', u'_invalidations'])
+#: number of documents inserted by one bulk insert
+BATCH_SIZE = 1000
+#: first bytes of every SQLite database file
+SQLITE_HEADER = 'SQLite format 3\x00'
+
+
+def _connect(host, port):
+    """Get database connection with acknowledged writes."""
+    if PYM_2_4:
+        return MongoClient(host=host, port=port)
+    return Connection(host=host, port=port, safe=True)
+
+
+def _open(path, mode, compress):
+    if compress:
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def _collection_file(directory, coll_name, compress):
+    """Get path of the file containing documents of the collection."""
+    name = coll_name + '.bson'
+    if compress:
+        name += '.gz'
+    return os.path.join(directory, name)
+
+
+def _iter_documents(f):
+    """Iterate over BSON documents stored in the file one after another.
+
+    Args:
+      f: file-like object opened for reading.
+
+    Yields:
+      Decoded documents.
+    """
+    while True:
+        size_data = f.read(4)
+        if not size_data:
+            return
+        if len(size_data) < 4:
+            raise ValueError("Truncated BSON file %s" % f.name)
+        size = struct.unpack('<i', size_data)[0]
+        data = f.read(size - 4)
+        if len(data) < size - 4:
+            raise ValueError("Truncated BSON file %s" % f.name)
+        yield bson.BSON(size_data + data).decode()
+
+
+def _index_specs(coll):
+    """Get indexes of the collection except the _id index.
+
+    Returns:
+      List of dicts {'name': name, 'key': [[field, direction], ...],
+      'options': {...}}.
+    """
+    specs = []
+    for name, info in coll.index_information().iteritems():
+        if name == '_id_':
+            continue
+        options = dict((k, v) for k, v in info.iteritems()
+                       if k not in ('key', 'v', 'ns'))
+        specs.append({'name': name, 'key': [list(k) for k in info['key']],
+                      'options': options})
+    return specs
+
+
+def _export_collection(args):
+    """Export one collection, runs in a worker process.
+
+    Args:
+      args: tuple (host, port, app_id, collection name, directory, compress).
+
+    Returns:
+      Tuple (collection name, number of exported documents).
+    """
+    host, port, app_id, coll_name, directory, compress = args
+    coll = _connect(host, port)[app_id][coll_name]
+    count = 0
+    with _open(_collection_file(directory, coll_name, compress), 'wb',
+               compress) as f:
+        for doc in coll.find():
+            f.write(bson.BSON.encode(doc))
+            count += 1
+    return coll_name, count
+
+
+def _insert(coll, docs):
+    if hasattr(coll, 'insert_many'):
+        coll.insert_many(docs, ordered=False)
+    else:
+        coll.insert(docs)
+
+
+def _import_collection(args):
+    """Import one collection, runs in a worker process.
+
+    Args:
+      args: tuple (host, port, app_id, collection metadata, directory,
+          compress).
+
+    Returns:
+      Tuple (collection name, number of imported documents).
+    """
+    host, port, app_id, meta, directory, compress = args
+    coll_name = meta['name']
+    coll = _connect(host, port)[app_id][coll_name]
+    count = 0
+    batch = []
+    with _open(_collection_file(directory, coll_name, compress), 'rb',
+               compress) as f:
+        for doc in _iter_documents(f):
+            batch.append(doc)
+            if len(batch) >= BATCH_SIZE:
+                _insert(coll, batch)
+                count += len(batch)
+                batch = []
+    if batch:
+        _insert(coll, batch)
+        count += len(batch)
+    # indexes are built after the data, which is much faster
+    for spec in meta['indexes']:
+        options = dict((str(k), v) for k, v in spec['options'].iteritems())
+        coll.ensure_index([tuple(k) for k in spec['key']], name=spec['name'],
+                          **options)
+    return coll_name, count
+
+
+def _map(function, tasks, processes):
+    """Run function for every task in the pool of worker processes."""
+    if processes == 1 or len(tasks) <= 1:
+        return map(function, tasks)
+    pool = multiprocessing.Pool(min(processes, len(tasks)))
+    try:
+        return pool.map(function, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def export_data(app_id, directory, host='localhost', port=27017,
+                compress=False, processes=None):
+    """Export all data of the application into the directory.
+
+    Args:
+      app_id: string, application ID (name of the database).
+      directory: path of the directory, created if it does not exist.
+      host: string, mongodb host.
+      port: int, port on which the mongod server runs.
+      compress: bool, default False. If True, files are compressed by gzip.
+      processes: int, number of worker processes, default number of CPUs.
+
+    Returns:
+      Dict mapping collection names to numbers of exported documents.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    db = _connect(host, port)[app_id]
+    collections = []
+    for coll_name in db.collection_names():
+        if coll_name in SKIPPED_COLLECTIONS or coll_name.startswith('system.'):
+            continue
+        collections.append({'name': coll_name,
+                            'indexes': _index_specs(db[coll_name])})
+    tasks = [(host, port, app_id, meta['name'], directory, compress)
+             for meta in collections]
+    counts = dict(_map(_export_collection, tasks,
+                       processes or multiprocessing.cpu_count()))
+    metadata = {'app_id': app_id, 'compress': compress,
+                'collections': collections}
+    with open(os.path.join(directory, METADATA_FILE), 'wb') as f:
+        f.write(bson.BSON.encode(metadata))
+    return counts
+
+
+def import_data(app_id, directory, host='localhost', port=27017,
+                drop=False, processes=None):
+    """Import data exported by export_data into the application database.
+
+    Imported documents would be mixed with existing data (schema, versions
+    of entity groups, id counter, ...), so the database has to be empty
+    or dropped first.
+
+    Args:
+      app_id: string, application ID (name of the database).
+      directory: path of the directory with exported data.
+      host: string, mongodb host.
+      port: int, port on which the mongod server runs.
+      drop: bool, default False. If True, the database is dropped first.
+      processes: int, number of worker processes, default number of CPUs.
+
+    Returns:
+      Dict mapping collection names to numbers of imported documents.
+
+    Raises:
+      DatabaseNotEmptyError if the database is not empty and drop is False.
+    """
+    with open(os.path.join(directory, METADATA_FILE), 'rb') as f:
+        metadata = bson.BSON(f.read()).decode()
+    conn = _connect(host, port)
+    if drop:
+        conn.drop_database(app_id)
+    elif any(not c.startswith('system.')
+             for c in conn[app_id].collection_names()):
+        raise DatabaseNotEmptyError("Database %s is not empty, drop it first"
+                                    % app_id)
+    tasks = [(host, port, app_id, meta, directory, metadata['compress'])
+             for meta in metadata['collections']]
+    return dict(_map(_import_collection, tasks,
+                     processes or multiprocessing.cpu_count()))
+
+
+def _read_file_stub(path):
+    """Iterate over encoded entities stored by DatastoreFileStub.
+
+    The file is a pickled list of encoded entity protocol buffers.
+    """
+    with open(path, 'rb') as f:
+        encoded_entities = pickle.load(f)
+    for encoded in encoded_entities:
+        yield encoded
+
+
+def _read_sqlite_stub(path):
+    """Iterate over encoded entities stored by DatastoreSqliteStub.
+
+    Entities of every namespace are stored in table "<app>!<ns>!Entities".
+    """
+    conn = sqlite3.connect(path)
+    try:
+        tables = [row[0] for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' "
+                "AND name LIKE '%!Entities'")]
+        for table in tables:
+            query = 'SELECT entity FROM "%s"' % table.replace('"', '""')
+            for row in conn.execute(query):
+                yield str(row[0])
+    finally:
+        conn.close()
+
+
+def read_stub_file(path):
+    """Read entities from datastore file of DatastoreFileStub or
+    DatastoreSqliteStub.
+
+    Args:
+      path: path of the datastore file, its format is detected.
+
+    Yields:
+      Entities (entity_pb.EntityProto).
+    """
+    # the SDK is needed only for loading of datastore files
+    from google.appengine.datastore import entity_pb, datastore_stub_util
+    from_storage = getattr(datastore_stub_util, '_FromStorageEntity', None)
+
+    with open(path, 'rb') as f:
+        is_sqlite = f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+    reader = _read_sqlite_stub if is_sqlite else _read_file_stub
+    for encoded in reader(path):
+        entity = entity_pb.EntityProto(encoded)
+        if from_storage is not None:
+            # newer SDKs store entity version as a special property
+            entity = from_storage(entity).entity
+        yield entity
+
+
+def load_stub_file(app_id, path, host='localhost', port=27017,
+                   batch_size=BATCH_SIZE):
+    """Load entities from datastore file of another stub into mongodb.
+
+    Entities are stored by bulk writes, schema and indexes are built once
+    at the end. Entities of all applications and namespaces in the file
+    are stored into the database of given application.
+
+    Args:
+      app_id: string, application ID (name of the database).
+      path: path of the datastore file of DatastoreFileStub or
+          DatastoreSqliteStub.
+      host: string, mongodb host.
+      port: int, port on which the mongod server runs.
+      batch_size: int, number of documents written by one bulk write.
+
+    Returns:
+      Dict mapping collection names to numbers of loaded entities.
+    """
+    from datastore_mongodb_stub import MongoDatastore
+    datastore = MongoDatastore(host, port, app_id)
+    try:
+        return datastore.bulk_load(read_stub_file(path), batch_size)
+    finally:
+        datastore.close()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+            description="Bulk export and import of data of DatastoreMongoDBStub.")
+    parser.add_argument('command', choices=['export', 'import', 'load'])
+    parser.add_argument('app_id', help="application ID")
+    parser.add_argument('path', help="directory with exported data or "
+                        "datastore file of file or sqlite stub (load)")
+    parser.add_argument('--host', default='localhost', help="mongodb host")
+    parser.add_argument('--port', type=int, default=27017, help="mongodb port")
+    parser.add_argument('--processes', type=int, default=None,
+                        help="number of worker processes (default: CPU count)")
+    parser.add_argument('--gzip', action='store_true',
+                        help="compress exported files by gzip")
+    parser.add_argument('--drop', action='store_true',
+                        help="drop the database before import, required "
+                        "if it is not empty")
+    args = parser.parse_args(argv)
+    if args.command == 'export':
+        counts = export_data(args.app_id, args.path, args.host, args.port,
+                             args.gzip, args.processes)
+    elif args.command == 'import':
+        try:
+            counts = import_data(args.app_id, args.path, args.host,
+                                 args.port, args.drop, args.processes)
+        except DatabaseNotEmptyError, e:
+            parser.error("%s (use --drop)" % e)
+    else:
+        counts = load_stub_file(args.app_id, args.path, args.host, args.port)
+    for coll_name in sorted(counts):
+        print "%s: %d" % (coll_name, counts[coll_name])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
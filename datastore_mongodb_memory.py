@@ -0,0 +1,1049 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 10gen Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+In-process storage engine for DatastoreMongoDBStub.
+
+Implements the subset of pymongo's client, database, collection, cursor and
+GridFS interface used by the stub, so that MongoDatastore can run without
+mongod (see its in_memory argument). Documents are kept as dicts in the same
+form in which pymongo returns them (they are passed through BSON on write),
+collections are ordered by _id and every index keeps sorted keys of its first
+field, which are used for equality and range scans. Queries, sorting,
+projections and aggregation pipelines follow mongodb's semantics, including
+comparison of values of different types and matching of array elements.
+
+All clients of one process share the same databases.
+"""
+
+import bisect
+import collections
+import datetime
+import random
+import threading
+
+import bson
+from bson import ObjectId
+from gridfs.errors import NoFile
+from pymongo import ASCENDING
+from pymongo.errors import CollectionInvalid, DuplicateKeyError, \
+     OperationFailure
+try:
+    from pymongo.binary import Binary
+except ImportError:
+    from bson import Binary
+
+
+# databases shared by all clients of the process
+_databases = {}
+_databases_lock = threading.Lock()
+
+# placeholder of value of path which does not exist in the document
+_MISSING = object()
+
+# estimated size of index entry in bytes reported by collStats
+INDEX_ENTRY_SIZE = 32
+
+
+def _copy(value):
+    """Copy the document, other values stored in documents are immutable."""
+    if isinstance(value, dict):
+        return dict((k, _copy(v)) for k, v in value.iteritems())
+    elif isinstance(value, list):
+        return [_copy(v) for v in value]
+    return value
+
+
+def _key(value):
+    """Get key ordering values in the same way as mongodb does.
+
+    Values of different types are ordered by their type first (null, numbers,
+    strings, objects, arrays, binary data, ObjectId, booleans, dates).
+
+    Args:
+      value: value stored in a document.
+
+    Returns:
+      Comparable tuple, its first item is the type bracket of the value.
+    """
+    if value is None or value is _MISSING:
+        return (1,)
+    elif isinstance(value, bool):
+        return (8, value)
+    elif isinstance(value, (int, long, float)):
+        return (2, value)
+    elif isinstance(value, Binary):
+        return (6, len(value), value.subtype, str(value))
+    elif isinstance(value, unicode):
+        return (3, value.encode('utf-8'))
+    elif isinstance(value, str):
+        return (3, value)
+    elif isinstance(value, dict):
+        return (4, tuple((k.encode('utf-8') if isinstance(k, unicode) else k,
+                          _key(v)) for k, v in sorted(value.iteritems())))
+    elif isinstance(value, list):
+        return (5, tuple(_key(v) for v in value))
+    elif isinstance(value, ObjectId):
+        return (7, value.binary)
+    elif isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.replace(tzinfo=None) - value.utcoffset()
+        return (9, value)
+    return (10, value)
+
+
+def _get(doc, path):
+    """Get value of the dotted path, arrays are not traversed.
+
+    Returns:
+      The value or _MISSING.
+    """
+    for part in path.split('.'):
+        if not isinstance(doc, dict) or part not in doc:
+            return _MISSING
+        doc = doc[part]
+    return doc
+
+
+def _set(doc, path, value):
+    """Set value of the dotted path, missing subdocuments are created."""
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+
+def _values(doc, path, whole_arrays=True):
+    """Get all values of the dotted path as mongodb matches them.
+
+    Arrays on the path are traversed, elements of the array found at the end
+    of the path are returned one by one (and the array itself too).
+
+    Args:
+      doc: dict, document.
+      path: string, dotted path.
+      whole_arrays: bool, if False, arrays themselves are not returned.
+
+    Returns:
+      List of values, empty if the path does not exist.
+    """
+    current = [doc]
+    for part in path.split('.'):
+        found = []
+        for value in current:
+            if isinstance(value, dict):
+                if part in value:
+                    found.append(value[part])
+            elif isinstance(value, list):
+                for x in value:
+                    if isinstance(x, dict) and part in x:
+                        found.append(x[part])
+                if part.isdigit() and int(part) < len(value):
+                    found.append(value[int(part)])
+        current = found
+    values = []
+    for value in current:
+        if isinstance(value, list):
+            values.extend(value)
+            if whole_arrays:
+                values.append(value)
+        else:
+            values.append(value)
+    return values
+
+
+def _is_operator(cond):
+    return (isinstance(cond, dict) and cond
+            and all(k.startswith('$') for k in cond))
+
+
+def _eq(values, arg):
+    k = _key(arg)
+    if arg is None and not values:
+        # null matches missing fields
+        return True
+    return any(_key(v) == k for v in values)
+
+
+def _compare(op):
+    def match(values, arg):
+        k = _key(arg)
+        # ranges match only values of the same type bracket
+        return any(op(kv, k) for kv in (_key(v) for v in values)
+                   if kv[0] == k[0])
+    return match
+
+
+_OPERATORS = {
+    '$eq': _eq,
+    '$ne': lambda values, arg: not _eq(values, arg),
+    '$gt': _compare(lambda a, b: a > b),
+    '$gte': _compare(lambda a, b: a >= b),
+    '$lt': _compare(lambda a, b: a < b),
+    '$lte': _compare(lambda a, b: a <= b),
+    '$in': lambda values, arg: any(_eq(values, a) for a in arg),
+    '$nin': lambda values, arg: not any(_eq(values, a) for a in arg),
+    '$exists': lambda values, arg: bool(values) == bool(arg),
+}
+
+
+def _match(doc, spec):
+    """Check if the document matches the query specification.
+
+    Args:
+      doc: dict, document.
+      spec: dict, query specification.
+
+    Returns:
+      bool.
+    """
+    for field, cond in spec.iteritems():
+        if field == '$and':
+            if not all(_match(doc, s) for s in cond):
+                return False
+        elif field == '$or':
+            if not any(_match(doc, s) for s in cond):
+                return False
+        elif field == '$nor':
+            if any(_match(doc, s) for s in cond):
+                return False
+        else:
+            values = _values(doc, field)
+            if _is_operator(cond):
+                for op, arg in cond.iteritems():
+                    if op not in _OPERATORS:
+                        raise OperationFailure("Unsupported operator %s" % op)
+                    if not _OPERATORS[op](values, arg):
+                        return False
+            elif not _eq(values, cond):
+                return False
+    return True
+
+
+def _conditions(spec):
+    """Iterate over conditions on fields joined by AND.
+
+    Yields:
+      Tuples (field, condition).
+    """
+    for field, cond in spec.iteritems():
+        if field == '$and':
+            for s in cond:
+                for c in _conditions(s):
+                    yield c
+        elif not field.startswith('$'):
+            yield field, cond
+
+
+def _project(doc, projection):
+    """Apply projection to the document.
+
+    Args:
+      doc: dict, document.
+      projection: dict {field: 0 or 1}, list of fields or None.
+
+    Returns:
+      New document.
+    """
+    if not projection:
+        return _copy(doc)
+    if not isinstance(projection, dict):
+        projection = dict((f, 1) for f in projection)
+    fields = [f for f in projection if f != '_id']
+    include = (any(projection[f] for f in fields) or
+               (not fields and projection.get('_id')))
+    if include:
+        result = {}
+        if projection.get('_id', 1) and '_id' in doc:
+            result['_id'] = doc['_id']
+        for field in fields:
+            if projection[field]:
+                _copy_path(doc, result, field.split('.'))
+        return result
+    result = _copy(doc)
+    for field, value in projection.iteritems():
+        if not value:
+            _delete_path(result, field.split('.'))
+    return result
+
+
+def _copy_path(src, dst, parts):
+    part = parts[0]
+    if not isinstance(src, dict) or part not in src:
+        return
+    value = src[part]
+    if len(parts) == 1:
+        dst[part] = _copy(value)
+    elif isinstance(value, dict):
+        _copy_path(value, dst.setdefault(part, {}), parts[1:])
+    elif isinstance(value, list):
+        projected = []
+        for x in value:
+            if isinstance(x, dict):
+                y = {}
+                _copy_path(x, y, parts[1:])
+                projected.append(y)
+        dst[part] = projected
+
+
+def _delete_path(doc, parts):
+    for part in parts[:-1]:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(parts[-1], None)
+
+
+def _sort(items, order, get_doc=None):
+    """Sort documents in place.
+
+    Arrays are ordered by their smallest element in ascending order and by
+    the biggest element in descending order, missing values as nulls.
+
+    Args:
+      items: list of documents or of items referring to documents.
+      order: list of tuples (field, direction).
+      get_doc: function returning document of the item, None if items
+          are documents.
+    """
+    def sort_key(field, direction):
+        def key(item):
+            doc = get_doc(item) if get_doc else item
+            keys = [_key(v) for v in _values(doc, field, whole_arrays=False)]
+            if not keys:
+                return _key(None)
+            return min(keys) if direction > 0 else max(keys)
+        return key
+    # stable sorts from the least significant field
+    for field, direction in reversed(order):
+        items.sort(key=sort_key(field, direction), reverse=direction < 0)
+
+
+def _normalize_order(key_or_list, direction=None):
+    if isinstance(key_or_list, basestring):
+        return [(key_or_list, direction or ASCENDING)]
+    return [(k, d) for k, d in key_or_list]
+
+
+def _apply_update(doc, update):
+    """Apply update specification to the document in place."""
+    if not any(k.startswith('$') for k in update):
+        doc_id = doc.get('_id')
+        doc.clear()
+        doc.update(_copy(update))
+        if doc_id is not None:
+            doc['_id'] = doc_id
+        return
+    for op, fields in update.iteritems():
+        for path, value in fields.iteritems():
+            if op == '$set':
+                _set(doc, path, _copy(value))
+            elif op == '$unset':
+                _delete_path(doc, path.split('.'))
+            elif op == '$inc':
+                current = _get(doc, path)
+                _set(doc, path, value if current is _MISSING
+                                else current + value)
+            elif op == '$addToSet':
+                current = _get(doc, path)
+                if current is _MISSING:
+                    current = []
+                    _set(doc, path, current)
+                if isinstance(value, dict) and '$each' in value:
+                    values = value['$each']
+                else:
+                    values = [value]
+                for v in values:
+                    if _key(v) not in map(_key, current):
+                        current.append(_copy(v))
+            else:
+                raise OperationFailure("Unsupported update operator %s" % op)
+
+
+def _expression(doc, expr):
+    """Evaluate aggregation expression: '$path', document of expressions
+    or literal value.
+    """
+    if isinstance(expr, basestring) and expr.startswith('$'):
+        return _get(doc, expr[1:])
+    elif isinstance(expr, dict):
+        result = {}
+        for k, e in expr.iteritems():
+            value = _expression(doc, e)
+            if value is not _MISSING:
+                result[k] = value
+        return result
+    return expr
+
+
+def _group(docs, spec):
+    """Perform $group stage of aggregation pipeline."""
+    groups = collections.OrderedDict()
+    for doc in docs:
+        group_id = _expression(doc, spec['_id'])
+        if group_id is _MISSING:
+            group_id = None
+        k = _key(group_id)
+        if k not in groups:
+            groups[k] = {'_id': group_id}
+            first = True
+        else:
+            first = False
+        group = groups[k]
+        for field, acc in spec.iteritems():
+            if field == '_id':
+                continue
+            (op, expr), = acc.items()
+            value = _expression(doc, expr)
+            if op == '$first':
+                if first:
+                    group[field] = None if value is _MISSING else value
+            elif op == '$last':
+                group[field] = None if value is _MISSING else value
+            elif op == '$sum':
+                if first:
+                    group[field] = 0
+                if isinstance(value, (int, long, float)) and \
+                        not isinstance(value, bool):
+                    group[field] += value
+            elif op in ('$min', '$max'):
+                if value is _MISSING or value is None:
+                    group.setdefault(field, None)
+                    continue
+                current = group.get(field)
+                if current is None or (
+                        op == '$min' and _key(value) < _key(current)) or (
+                        op == '$max' and _key(value) > _key(current)):
+                    group[field] = value
+            elif op == '$push':
+                group.setdefault(field, [])
+                if value is not _MISSING:
+                    group[field].append(value)
+            elif op == '$addToSet':
+                group.setdefault(field, [])
+                if value is not _MISSING and \
+                        _key(value) not in map(_key, group[field]):
+                    group[field].append(value)
+            else:
+                raise OperationFailure("Unsupported accumulator %s" % op)
+    return groups.values()
+
+
+def _unwind(docs, spec):
+    """Perform $unwind stage of aggregation pipeline."""
+    path = (spec['path'] if isinstance(spec, dict) else spec)[1:]
+    for doc in docs:
+        value = _get(doc, path)
+        if value is _MISSING or value is None or value == []:
+            continue
+        if not isinstance(value, list):
+            yield doc
+            continue
+        for x in value:
+            d = _copy(doc)
+            _set(d, path, x)
+            yield d
+
+
+
+class _Index(object):
+    """
+    Sorted keys of the first field of the index and ids of their documents.
+
+    Documents are found by bisection of keys, the remaining conditions
+    of the query are checked on the documents.
+    """
+    def __init__(self, name, key, options):
+        self.name = name
+        self.key = key
+        self.options = options
+        self.field = key[0][0]
+        self._keys = []
+        self._ids = []
+
+    def _entries(self, doc):
+        keys = set(_key(v) for v in _values(doc, self.field))
+        if not keys and self.options.get('sparse'):
+            return keys
+        # documents without the field are indexed as nulls
+        return keys or set([_key(None)])
+
+    def add(self, id_key, doc):
+        for k in self._entries(doc):
+            i = bisect.bisect_right(self._keys, k)
+            self._keys.insert(i, k)
+            self._ids.insert(i, id_key)
+
+    def remove(self, id_key, doc):
+        for k in self._entries(doc):
+            lo = bisect.bisect_left(self._keys, k)
+            hi = bisect.bisect_right(self._keys, k)
+            for i in xrange(lo, hi):
+                if self._ids[i] == id_key:
+                    del self._keys[i]
+                    del self._ids[i]
+                    break
+
+    def clear(self):
+        self._keys = []
+        self._ids = []
+
+    def ranges(self, cond):
+        """Get ranges of positions of keys which may match the condition.
+
+        Returns:
+          List of tuples (lo, hi) or None if the condition can not use
+          the index.
+        """
+        if self.options.get('sparse') and _match({}, {self.field: cond}):
+            # documents without the field are not in sparse index
+            return None
+        if not _is_operator(cond):
+            return [self._equal(cond)]
+        ranges = None
+        for op, arg in cond.iteritems():
+            if op == '$in':
+                r = [self._equal(a) for a in arg]
+            elif op == '$eq':
+                r = [self._equal(arg)]
+            elif op in ('$gt', '$gte', '$lt', '$lte'):
+                k = _key(arg)
+                # the whole bracket of the value's type, bounds are checked
+                # on documents
+                lo = bisect.bisect_left(self._keys, (k[0],))
+                hi = bisect.bisect_left(self._keys, (k[0] + 1,))
+                if op in ('$gt', '$gte'):
+                    lo = bisect.bisect_left(self._keys, k, lo, hi)
+                else:
+                    hi = bisect.bisect_right(self._keys, k, lo, hi)
+                r = [(lo, hi)]
+            else:
+                continue
+            if ranges is None or sum(h - l for l, h in r) < \
+                    sum(h - l for l, h in ranges):
+                ranges = r
+        return ranges
+
+    def _equal(self, value):
+        k = _key(value)
+        return (bisect.bisect_left(self._keys, k),
+                bisect.bisect_right(self._keys, k))
+
+    def scan(self, ranges):
+        ids = set()
+        for lo, hi in ranges:
+            ids.update(self._ids[lo:hi])
+        return ids
+
+
+
+class Cursor(object):
+    """
+    Lazily evaluated query on the collection, the subset of pymongo.Cursor.
+    """
+    def __init__(self, collection, spec=None, projection=None):
+        self._collection = collection
+        self._spec = spec or {}
+        self._projection = projection
+        self._order = None
+        self._skip = 0
+        self._limit = 0
+        self._results = None
+
+    def sort(self, key_or_list, direction=None):
+        self._order = _normalize_order(key_or_list, direction)
+        return self
+
+    def skip(self, n):
+        self._skip = n
+        return self
+
+    def limit(self, n):
+        self._limit = n
+        return self
+
+    def batch_size(self, n):
+        return self
+
+    def hint(self, index):
+        return self
+
+    def _evaluate(self):
+        if self._results is None:
+            self._results = iter(self._collection._query(
+                    self._spec, self._projection, self._order, self._skip,
+                    self._limit))
+        return self._results
+
+    def count(self, with_limit_and_skip=False):
+        if with_limit_and_skip:
+            return len(self._collection._query(
+                    self._spec, {'_id': 1}, None, self._skip, self._limit))
+        return len(self._collection._query(self._spec, {'_id': 1}))
+
+    @property
+    def alive(self):
+        return self._results is None
+
+    def __getitem__(self, index):
+        return self._collection._query(self._spec, self._projection,
+                                       self._order, self._skip + index, 1)[0]
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self._evaluate().next()
+    __next__ = next
+
+
+
+class Collection(object):
+    """
+    Collection of documents ordered by _id, the subset of
+    pymongo.collection.Collection.
+    """
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.full_name = "%s.%s" % (database.name, name)
+        self._lock = database._lock
+        self._exists = False
+        self.options = {}
+        self._clear()
+
+    def _clear(self):
+        self._docs = {}
+        self._id_index = _Index('_id_', [('_id', ASCENDING)], {})
+        self._indexes = {}
+
+    def _create(self):
+        self._exists = True
+
+    # writes
+
+    def _prepare(self, doc):
+        """Get copy of the document in the form in which pymongo returns it."""
+        if '_id' not in doc:
+            doc['_id'] = ObjectId()
+        return bson.BSON.encode(doc, check_keys=True).decode()
+
+    def _insert(self, doc):
+        id_key = _key(doc['_id'])
+        if id_key in self._docs:
+            raise DuplicateKeyError("E11000 duplicate key error %s: %r"
+                                    % (self.full_name, doc['_id']))
+        self._create()
+        self._docs[id_key] = doc
+        self._id_index.add(id_key, doc)
+        for index in self._indexes.itervalues():
+            index.add(id_key, doc)
+
+    def _remove(self, id_key):
+        doc = self._docs.pop(id_key)
+        self._id_index.remove(id_key, doc)
+        for index in self._indexes.itervalues():
+            index.remove(id_key, doc)
+
+    def insert(self, doc_or_docs, **kwargs):
+        docs = doc_or_docs if isinstance(doc_or_docs, list) else [doc_or_docs]
+        prepared = [self._prepare(d) for d in docs]
+        with self._lock:
+            for doc in prepared:
+                self._insert(doc)
+        ids = [d['_id'] for d in prepared]
+        return ids if isinstance(doc_or_docs, list) else ids[0]
+
+    def insert_many(self, docs, **kwargs):
+        self.insert(list(docs))
+
+    def save(self, doc, **kwargs):
+        doc = self._prepare(doc)
+        with self._lock:
+            id_key = _key(doc['_id'])
+            if id_key in self._docs:
+                self._remove(id_key)
+            self._insert(doc)
+        return doc['_id']
+
+    def remove(self, spec_or_id=None, **kwargs):
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        with self._lock:
+            for id_key in self._find_ids(spec_or_id or {}):
+                self._remove(id_key)
+
+    def update(self, spec, document, upsert=False, multi=False, **kwargs):
+        with self._lock:
+            ids = self._find_ids(spec)
+            if not ids and upsert:
+                self._upsert(spec, document)
+            for id_key in ids[:None if multi else 1]:
+                doc = _copy(self._docs[id_key])
+                _apply_update(doc, document)
+                doc = self._prepare(doc)
+                self._remove(id_key)
+                self._insert(doc)
+
+    def _upsert(self, spec, update):
+        doc = dict((f, c) for f, c in _conditions(spec)
+                   if not _is_operator(c) and '.' not in f)
+        _apply_update(doc, update)
+        doc = self._prepare(doc)
+        self._insert(doc)
+        return doc
+
+    def find_and_modify(self, query=None, update=None, upsert=False,
+                        sort=None, new=False, remove=False, fields=None,
+                        **kwargs):
+        with self._lock:
+            ids = self._find_ids(query or {}, sort and _normalize_order(sort))
+            if not ids:
+                if not upsert:
+                    return None
+                doc = self._upsert(query or {}, update)
+                return _project(doc, fields) if new else None
+            id_key = ids[0]
+            old = self._docs[id_key]
+            if remove:
+                self._remove(id_key)
+                return _project(old, fields)
+            doc = _copy(old)
+            _apply_update(doc, update)
+            doc = self._prepare(doc)
+            self._remove(id_key)
+            self._insert(doc)
+            return _project(doc if new else old, fields)
+
+    def drop(self):
+        self.database.drop_collection(self.name)
+
+    # indexes
+
+    def ensure_index(self, key_or_list, cache_for=None, **kwargs):
+        key = _normalize_order(key_or_list)
+        name = kwargs.pop('name', None) or \
+                "_".join("%s_%s" % (k, d) for k, d in key)
+        with self._lock:
+            self._create()
+            if name == '_id_' or name in self._indexes:
+                return name
+            index = _Index(name, key, kwargs)
+            for id_key, doc in self._docs.iteritems():
+                index.add(id_key, doc)
+            self._indexes[name] = index
+        return name
+    create_index = ensure_index
+
+    def drop_index(self, index_or_name):
+        if not isinstance(index_or_name, basestring):
+            index_or_name = "_".join("%s_%s" % (k, d) for k, d
+                                     in _normalize_order(index_or_name))
+        with self._lock:
+            if self._indexes.pop(index_or_name, None) is None:
+                raise OperationFailure("index not found with name [%s]"
+                                       % index_or_name)
+
+    def drop_indexes(self):
+        with self._lock:
+            self._indexes = {}
+
+    def index_information(self):
+        with self._lock:
+            info = {'_id_': {'key': [('_id', ASCENDING)], 'v': 1}}
+            for name, index in self._indexes.iteritems():
+                info[name] = dict(index.options, key=list(index.key), v=1)
+            return info
+
+    # reads
+
+    def _find_ids(self, spec, order=None):
+        """Get keys of _id of documents matching the specification.
+
+        The most selective index usable for the query narrows the documents
+        which are matched, documents are returned in order of _id unless
+        the order is given.
+        """
+        candidates = None
+        best = None
+        for field, cond in _conditions(spec):
+            index = self._id_index if field == '_id' else None
+            if index is None:
+                for i in self._indexes.itervalues():
+                    if i.field == field:
+                        index = i
+                        break
+            if index is None:
+                continue
+            ranges = index.ranges(cond)
+            if ranges is None:
+                continue
+            size = sum(hi - lo for lo, hi in ranges)
+            if best is None or size < best[0]:
+                best = (size, index, ranges)
+        if best is not None:
+            candidates = sorted(best[1].scan(best[2]))
+        else:
+            candidates = self._id_index._ids
+        ids = [k for k in candidates if _match(self._docs[k], spec)]
+        if order:
+            _sort(ids, order, self._docs.__getitem__)
+        return ids
+
+    def _query(self, spec, projection=None, order=None, skip=0, limit=0):
+        with self._lock:
+            ids = self._find_ids(spec, order)
+            ids = ids[skip:skip + limit if limit else None]
+            return [_project(self._docs[k], projection) for k in ids]
+
+    def _all(self):
+        with self._lock:
+            return [self._docs[k] for k in self._id_index._ids]
+
+    def find(self, spec=None, fields=None, **kwargs):
+        cursor = Cursor(self, spec, fields or kwargs.get('projection'))
+        if 'sort' in kwargs:
+            cursor.sort(kwargs['sort'])
+        return cursor.skip(kwargs.get('skip', 0)).limit(kwargs.get('limit', 0))
+
+    def find_one(self, spec_or_id=None, *args, **kwargs):
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        for doc in self.find(spec_or_id, *args, **kwargs).limit(1):
+            return doc
+        return None
+
+    def count(self):
+        with self._lock:
+            return len(self._docs)
+
+    def count_documents(self, filter, limit=0, skip=0, **kwargs):
+        return len(self._query(filter, {'_id': 1}, None, skip, limit))
+
+    def aggregate(self, pipeline, **kwargs):
+        """Run aggregation pipeline.
+
+        Supports stages $match, $project (inclusion and exclusion), $unwind,
+        $group, $sort, $skip, $limit, $sample, $count and $out.
+
+        Returns:
+          Iterator over resulting documents.
+        """
+        stages = list(pipeline)
+        # the first $match can use indexes
+        if stages and '$match' in stages[0]:
+            docs = self._query(stages.pop(0)['$match'])
+        else:
+            docs = [_copy(d) for d in self._all()]
+        for stage in stages:
+            (op, arg), = stage.items()
+            if op == '$match':
+                docs = [d for d in docs if _match(d, arg)]
+            elif op == '$project':
+                docs = [_project(d, arg) for d in docs]
+            elif op == '$unwind':
+                docs = list(_unwind(docs, arg))
+            elif op == '$group':
+                docs = _group(docs, arg)
+            elif op == '$sort':
+                _sort(docs, arg.items())
+            elif op == '$skip':
+                docs = docs[arg:]
+            elif op == '$limit':
+                docs = docs[:arg]
+            elif op == '$sample':
+                docs = random.sample(docs, min(arg['size'], len(docs)))
+            elif op == '$count':
+                docs = [{arg: len(docs)}]
+            elif op == '$out':
+                self.database[arg]._replace(docs)
+                docs = []
+            else:
+                raise OperationFailure("Unsupported pipeline stage %s" % op)
+        return iter(docs)
+
+    def _stats(self):
+        """Get statistics of the collection in the format of collStats.
+
+        Sizes of documents are computed on demand, sizes of indexes are
+        estimated from the number of their entries.
+        """
+        with self._lock:
+            size = sum(len(bson.BSON.encode(d))
+                       for d in self._docs.itervalues())
+            index_sizes = {'_id_': len(self._id_index._ids) * INDEX_ENTRY_SIZE}
+            for name, index in self._indexes.iteritems():
+                index_sizes[name] = len(index._ids) * INDEX_ENTRY_SIZE
+            count = len(self._docs)
+        return {'ns': self.full_name, 'count': count, 'size': size,
+                'avgObjSize': size / count if count else 0,
+                'storageSize': size, 'nindexes': len(index_sizes),
+                'indexSizes': index_sizes,
+                'totalIndexSize': sum(index_sizes.itervalues()), 'ok': 1.0}
+
+    def _replace(self, docs):
+        """Replace all documents of the collection, indexes are kept."""
+        prepared = [self._prepare(d) for d in docs]
+        with self._lock:
+            self._docs = {}
+            self._id_index.clear()
+            for index in self._indexes.itervalues():
+                index.clear()
+            for doc in prepared:
+                self._insert(doc)
+            self._create()
+
+
+
+class Database(object):
+    """
+    Database of collections, the subset of pymongo.database.Database.
+    """
+    def __init__(self, client, name):
+        self.client = self.connection = client
+        self.name = name
+        self._lock = threading.RLock()
+        self._collections = {}
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = Collection(self, name)
+            return self._collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def collection_names(self, include_system_collections=True):
+        with self._lock:
+            return sorted(name for name, coll in self._collections.iteritems()
+                          if coll._exists)
+    list_collection_names = collection_names
+
+    def create_collection(self, name, **options):
+        with self._lock:
+            coll = self[name]
+            if coll._exists:
+                raise CollectionInvalid("collection %s already exists" % name)
+            coll.options = options
+            coll._create()
+            return coll
+
+    def drop_collection(self, name_or_collection):
+        name = getattr(name_or_collection, 'name', name_or_collection)
+        with self._lock:
+            coll = self[name]
+            coll._clear()
+            coll.options = {}
+            coll._exists = False
+
+    def _drop(self):
+        with self._lock:
+            for name in self.collection_names():
+                self.drop_collection(name)
+
+    def command(self, command, value=1, **kwargs):
+        if isinstance(command, basestring):
+            command = {command: value}
+        name, value = iter(command.items()).next()
+        name = name.lower()
+        if name in ('ismaster', 'ping'):
+            # standalone server without replica set, i.e. without
+            # transactions and change streams
+            return {'ok': 1.0, 'ismaster': True, 'maxWireVersion': 0}
+        elif name == 'collstats':
+            return self[value]._stats()
+        raise OperationFailure("Unsupported command %s" % name)
+
+
+
+class MemoryClient(object):
+    """
+    Client of the in-process storage engine, the subset of
+    pymongo.MongoClient.
+    """
+    def __init__(self, host=None, port=None, **kwargs):
+        self.write_concern = {}
+
+    def __getitem__(self, name):
+        with _databases_lock:
+            if name not in _databases:
+                _databases[name] = Database(self, name)
+            return _databases[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def database_names(self):
+        with _databases_lock:
+            dbs = _databases.values()
+        return sorted(db.name for db in dbs if db.collection_names())
+
+    def drop_database(self, name_or_database):
+        name = getattr(name_or_database, 'name', name_or_database)
+        # handles of the database stay valid as in pymongo
+        self[name]._drop()
+
+    def close(self):
+        pass
+
+
+
+class _GridOut(object):
+    def __init__(self, doc):
+        self._id = doc['_id']
+        self.length = doc['length']
+        self._data = str(doc['data'])
+
+    def read(self):
+        return self._data
+
+
+
+class GridFS(object):
+    """
+    Files stored in documents of collection "<collection>.files",
+    the subset of gridfs.GridFS.
+    """
+    def __init__(self, database, collection='fs'):
+        self._files = database[collection + '.files']
+
+    def put(self, data, **kwargs):
+        doc = dict(kwargs)
+        doc.setdefault('_id', ObjectId())
+        doc['length'] = len(data)
+        doc['uploadDate'] = datetime.datetime.utcnow()
+        doc['data'] = Binary(data)
+        self._files.insert(doc)
+        return doc['_id']
+
+    def get(self, file_id):
+        doc = self._files.find_one({'_id': file_id})
+        if doc is None:
+            raise NoFile("no file in gridfs collection %r with _id %r"
+                         % (self._files, file_id))
+        return _GridOut(doc)
+
+    def delete(self, file_id):
+        self._files.remove({'_id': file_id})
+
+    def exists(self, file_id):
+        return self._files.find_one({'_id': file_id}) is not None
@@ -27,38 +27,272 @@ Author: Stanislav Heller, heller.stanislav@gmail.com
 
 import collections
 import datetime
+import hashlib
+import heapq
 import itertools
+import multiprocessing.pool
 import random
 import sys
 import string
+import threading
 import time
 import re
+import struct
 import warnings
 import weakref
+import zlib
 
-from google.appengine.api import apiproxy_stub, datastore_types, datastore, users
+from google.appengine.api import apiproxy_rpc, apiproxy_stub, datastore_types, \
+     datastore, users
 from google.appengine.datastore import entity_pb, datastore_pb, datastore_stub_util
 from google.appengine.datastore.datastore_stub_util import _MAXIMUM_RESULTS, \
      _MAX_QUERY_OFFSET, LoadEntity, ParseNamespaceQuery
 from google.appengine.ext.blobstore import BlobKey
 from google.appengine.runtime import apiproxy_errors
 
+import bson
+import gridfs
+import pymongo
 from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import CollectionInvalid, DuplicateKeyError, \
+     OperationFailure
 try:
     # pymongo >= 2.4
-    from pymongo import MongoClient
+    from pymongo import MongoClient, ReadPreference
     PYM_2_4 = True
 except ImportError:
     from pymongo import Connection
     PYM_2_4 = False
+try:
+    # pymongo < 3.0 reads from secondaries only by replica set client
+    from pymongo import MongoReplicaSetClient
+except ImportError:
+    MongoReplicaSetClient = None
 try:
     from pymongo.binary import Binary
 except ImportError:
     from bson import Binary
+try:
+    from pymongo.son import SON
+except ImportError:
+    from bson.son import SON
+# pymongo >= 2.6 passes options of aggregation to the command
+PYM_2_6 = pymongo.version_tuple[:2] >= (2, 6)
+try:
+    # pymongo >= 3.0, write concern of clients is read-only
+    from pymongo.write_concern import WriteConcern
+    PYM_3_0 = True
+except ImportError:
+    PYM_3_0 = False
+try:
+    # pymongo >= 3.7, multi-document transactions
+    from pymongo import DeleteOne, ReplaceOne, UpdateOne
+    from pymongo.client_session import ClientSession
+    PYM_3_7 = hasattr(ClientSession, 'start_transaction')
+except ImportError:
+    PYM_3_7 = False
+try:
+    # pymongo >= 3.0
+    from pymongo import CursorType
+except ImportError:
+    CursorType = None
+try:
+    # pymongo >= 3.8, change streams which can be polled
+    from pymongo.change_stream import ChangeStream
+    PYM_3_8 = hasattr(ChangeStream, 'try_next')
+except ImportError:
+    PYM_3_8 = False
+
+import datastore_mongodb_memory
 
 
 STRUCTURED_PROPERTY_DELIMITER = "#!#"
 
+# attribute of every document containing mongodb key of the root entity
+# of its entity group, ancestor queries are indexed equalities on it
+ENTITY_GROUP_ATTR = "_g"
+
+# attribute of every document containing sort keys of its orderable values
+SORT_KEYS_ATTR = "_s"
+# sort keys are cut to fit into mongodb index keys, longer keys end with
+# a hash of the whole key, so that different values have different keys
+SORT_KEY_MAX_LENGTH = 250
+SORT_KEY_HASH_LENGTH = 16
+
+# special property which the SDK sets on a part of entities, it contains
+# a hash of the key, so queries ordered by it return random entities
+SCATTER_ATTR = "__scatter__"
+# sort keys of scatter property, indexed by a sparse index
+SCATTER_SORT_KEY = "%s.%s" % (SORT_KEYS_ATTR, SCATTER_ATTR)
+# number of entities sampled for every range by split_points
+SPLIT_OVERSAMPLING = 32
+
+# schema attribute listing properties which are not indexed
+UNINDEXED_ATTR = "_unindexed"
+# types of values which datastore never indexes
+UNINDEXED_TYPES = (datastore_types.Blob, datastore_types.Text,
+                   datastore_types.EmbeddedEntity)
+
+# collections used by the stub itself, all other collections contain entities
+RESERVED_COLLECTIONS = frozenset([u'_indexes', u'system.indexes', u'_schema',
+                                  u'_entity_groups', u'_gridfs.files',
+                                  u'_gridfs.chunks', u'_invalidations',
+                                  u'_snapshots', u'_stats', u'_sequences'])
+# names of property types in datastore statistics by type of the value
+# in mongodb document (see _Document.ENCODER) or in the schema
+STAT_PROPERTY_TYPES = {
+    'datetime': 'Date/Time', 'blob': 'Blob', 'geo': 'GeoPt', 'key': 'Key',
+    'blobkey': 'BlobKey', 'text': 'Text', 'local': 'EmbeddedEntity',
+    'user': 'User', 'bytes': 'ShortBlob',
+    'int': 'Integer', 'long': 'Integer', 'float': 'Float', 'bool': 'Boolean',
+    'NoneType': 'NULL', 'Key': 'Key', 'Blob': 'Blob', 'Text': 'Text',
+    'ByteString': 'ShortBlob', 'GeoPt': 'GeoPt', 'User': 'User',
+    'BlobKey': 'BlobKey', 'EmbeddedEntity': 'EmbeddedEntity',
+}
+
+# collections of named snapshots are "<prefix><snapshot name>.<collection>"
+SNAPSHOT_PREFIX = u"_snap."
+
+
+def _is_entity_collection(coll_name):
+    """Check if the collection contains entities of some kind."""
+    return (coll_name not in RESERVED_COLLECTIONS
+            and not coll_name.startswith(SNAPSHOT_PREFIX))
+
+
+def _copy_entity(entity):
+    """Get copy of the entity (entity_pb.EntityProto)."""
+    clone = entity_pb.EntityProto()
+    clone.CopyFrom(entity)
+    return clone
+
+
+def _add_filter(filters, prop, val):
+    """Add filter on property into filter specification.
+
+    Args:
+      filters: dict of filters for pymongo's Cursor.
+      prop: name of the filtered attribute.
+      val: filter value, either value or dict with operator.
+    """
+    # if there are more filters on the same property -> AND
+    if prop in filters:
+        filters.setdefault("$and", []).extend([{prop: filters.pop(prop)},
+                                               {prop: val}])
+    elif '$and' in filters and any(prop in f for f in filters['$and']):
+        filters['$and'].append({prop: val})
+    else:
+        filters[prop] = val
+
+
+# stages of aggregation pipelines may write temporary files (mongod >= 2.6)
+_AGGREGATE_OPTIONS = {'allowDiskUse': True} if PYM_2_6 else {}
+
+
+def _aggregate(collection, pipeline):
+    """Run aggregation pipeline on the collection.
+
+    Args:
+      collection: pymongo.collection.Collection instance.
+      pipeline: list of aggregation pipeline stages.
+
+    Returns:
+      Iterator over resulting documents.
+    """
+    # $group and $sort of large collections exceed memory limit of stages
+    result = collection.aggregate(pipeline, **_AGGREGATE_OPTIONS)
+    # pymongo < 2.6 returns whole result in response of the command
+    if isinstance(result, dict):
+        return iter(result['result'])
+    return result
+
+
+def _read_preference(pref):
+    """Get pymongo read preference.
+
+    Args:
+      pref: read preference of pymongo or name of its mode, e.g.
+          'secondaryPreferred' or 'SECONDARY_PREFERRED'.
+
+    Returns:
+      Read preference (member of pymongo.ReadPreference).
+    """
+    if isinstance(pref, basestring):
+        name = re.sub(r'([a-z])([A-Z])', r'\1_\2', pref).upper()
+        try:
+            return getattr(ReadPreference, name)
+        except AttributeError:
+            raise ValueError("Unknown read preference %r" % pref)
+    return pref
+
+
+def _index_options(spec):
+    """Get options of the index of the document (see iter_mongo_indexes).
+
+    Args:
+      spec: index specification, string or list of (field, direction).
+
+    Returns:
+      Dict of keyword arguments for ensure_index.
+    """
+    if spec == SCATTER_SORT_KEY:
+        # only a part of entities has the scatter property, the name
+        # differs from the full index created by older versions
+        return {'sparse': True, 'name': SCATTER_SORT_KEY + '_sparse'}
+    return {}
+
+
+def _stat_property_type(value):
+    """Get name of the property type of the value in datastore statistics.
+
+    Args:
+      value: value stored in mongodb document, not a list.
+
+    Returns:
+      String, e.g. 'Integer' or 'Date/Time'.
+    """
+    if isinstance(value, dict):
+        return STAT_PROPERTY_TYPES[value["t"]]
+    elif value is None:
+        return 'NULL'
+    return STAT_PROPERTY_TYPES.get(value.__class__.__name__, 'String')
+
+
+def _property_stats(mongo_doc):
+    """Count values of properties of the document by their types.
+
+    Args:
+      mongo_doc: dict, entity in mongodb format.
+
+    Returns:
+      Dict mapping property types to lists [number of values, bytes].
+    """
+    stats = collections.defaultdict(lambda: [0, 0])
+    for attr, val in mongo_doc.iteritems():
+        if attr in ('_id', SCATTER_ATTR, ENTITY_GROUP_ATTR, SORT_KEYS_ATTR):
+            continue
+        for v in (val if isinstance(val, list) else [val]):
+            stat = stats[_stat_property_type(v)]
+            stat[0] += 1
+            stat[1] += len(bson.BSON.encode({attr: v}))
+    return stats
+
+
+def _count(collection, filters, limit):
+    """Count documents matching the filters on the server.
+
+    Args:
+      collection: pymongo.collection.Collection instance.
+      filters: dict of filters for the query.
+      limit: maximal number of documents to count.
+
+    Returns:
+      int, number of matching documents, at most limit.
+    """
+    if hasattr(collection, 'count_documents'):
+        return collection.count_documents(filters, limit=limit)
+    return collection.find(filters).limit(limit).count(with_limit_and_skip=True)
+
 
 def parse_isoformat(datestring):
     """Try to parse date in ISO8061 format.
@@ -76,6 +310,204 @@ def parse_isoformat(datestring):
 
 
 
+class _VersionMismatch(Exception):
+    """Version of an entity group changed during atomic commit."""
+
+
+
+class _EntityGroupSnapshot(dict):
+    """
+    Entities of an entity group read by a transaction, mapped by their keys,
+    together with the version of the group they were read at.
+    """
+    def __init__(self, entities, version):
+        super(_EntityGroupSnapshot, self).__init__(entities)
+        self.version = version
+
+
+
+class _KeyedLocks(object):
+    """
+    Lazily created reentrant locks, one lock for every key.
+
+    The guarding lock is held only while looking up the lock for the key,
+    so threads working with different keys do not block each other. Locks
+    which are not held by anybody are garbage collected.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = weakref.WeakValueDictionary()
+
+    def __call__(self, key):
+        """Get lock for the key.
+
+        Args:
+          key: any hashable object.
+
+        Returns:
+          threading.RLock instance.
+        """
+        with self._lock:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._locks[key] = threading.RLock()
+            return lock
+
+
+
+class _LRUCache(object):
+    """
+    Thread-safe LRU cache limited by number of entries and their total size.
+
+    Entries stored by a reader, which started before an invalidation, are
+    dropped, so that the cache never keeps value older than the last write.
+    Keeps statistics of hits, misses and evictions.
+    """
+    def __init__(self, max_entries, max_bytes=None, sizeof=len):
+        """Constructor.
+
+        Args:
+          max_entries: int, maximal number of cached entries.
+          max_bytes: int or None, maximal total size of cached entries.
+          sizeof: function returning size of the cached value.
+        """
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        # increased by every invalidation
+        self._epoch = 0
+        self._hits = self._misses = self._evictions = 0
+
+    def epoch(self):
+        """Get current epoch, which has to be passed to put."""
+        return self._epoch
+
+    def get(self, key):
+        """Get cached value and mark it as recently used.
+
+        Args:
+          key: hashable key of the value.
+
+        Returns:
+          Cached value or None.
+        """
+        with self._lock:
+            try:
+                value, size = self._entries.pop(key)
+            except KeyError:
+                self._misses += 1
+                return None
+            self._entries[key] = (value, size)
+            self._hits += 1
+            return value
+
+    def put(self, key, value, epoch):
+        """Store value into the cache.
+
+        Args:
+          key: hashable key of the value.
+          value: value to be cached.
+          epoch: result of epoch() obtained before the value was read.
+        """
+        size = self._sizeof(value)
+        with self._lock:
+            if epoch != self._epoch:
+                return
+            self._remove(key)
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._entries and (len(self._entries) > self._max_entries or
+                    (self._max_bytes is not None and self._bytes > self._max_bytes)):
+                self._bytes -= self._entries.popitem(last=False)[1][1]
+                self._evictions += 1
+
+    def _remove(self, key):
+        try:
+            self._bytes -= self._entries.pop(key)[1]
+        except KeyError:
+            pass
+
+    def invalidate(self, key):
+        """Remove value from the cache."""
+        with self._lock:
+            self._epoch += 1
+            self._remove(key)
+
+    def clear(self):
+        """Remove all values from the cache."""
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Get statistics of the cache.
+
+        Returns:
+          Dict with number of hits, misses, evictions, entries, total size
+          of entries in bytes and hit ratio.
+        """
+        with self._lock:
+            requests = self._hits + self._misses
+            return {'hits': self._hits, 'misses': self._misses,
+                    'evictions': self._evictions,
+                    'entries': len(self._entries), 'bytes': self._bytes,
+                    'hit_ratio': float(self._hits) / requests if requests else 0.0}
+
+
+
+# Keys are stored in _id as strings which preserve the ordering of datastore
+# keys, so that sorting and range scans on __key__ work natively in mongodb.
+# Every element of the key path is encoded as
+#   <kind> KEY_TERMINATOR (KEY_ID_MARK <16 hex digits> | KEY_NAME_MARK <name>)
+#   KEY_TERMINATOR
+# Kinds and names are escaped so that they never contain the terminator,
+# ids have fixed width so they compare numerically and sort before names.
+KEY_TERMINATOR = u"\x01"
+KEY_ESCAPE = u"\x02"
+KEY_ID_MARK = u"#"
+KEY_NAME_MARK = u"@"
+
+_INT64_OFFSET = 1 << 63
+_UINT64_MASK = (1 << 64) - 1
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+_KEY_ESCAPES = {u"\x00": u"\x02\x03", u"\x01": u"\x02\x04", u"\x02": u"\x02\x05"}
+_KEY_UNESCAPES = dict((v, k) for k, v in _KEY_ESCAPES.iteritems())
+_KEY_ESCAPE_RE = re.compile(u"[\x00-\x02]")
+_KEY_UNESCAPE_RE = re.compile(u"\x02[\x03-\x05]")
+
+
+def _float_sort_key(f):
+    """Encode float as hex string preserving the ordering of floats."""
+    bits = struct.unpack('>Q', struct.pack('>d', f))[0]
+    if bits & _INT64_OFFSET:
+        bits = ~bits & _UINT64_MASK
+    else:
+        bits |= _INT64_OFFSET
+    return u"%016x" % bits
+
+
+def _escape_key_part(part):
+    """Escape kind or name of the key path element."""
+    if not isinstance(part, unicode):
+        part = part.decode('utf-8')
+    if _KEY_ESCAPE_RE.search(part):
+        part = _KEY_ESCAPE_RE.sub(lambda m: _KEY_ESCAPES[m.group()], part)
+    return part
+
+
+def _unescape_key_part(part):
+    """Reverse function to _escape_key_part."""
+    if KEY_ESCAPE in part:
+        part = _KEY_UNESCAPE_RE.sub(lambda m: _KEY_UNESCAPES[m.group()], part)
+    return part
+
+
+
 class _Key(object):
     """
     Wrapper class for handling both datastore and mongodb keys.
@@ -86,28 +518,36 @@ class _Key(object):
     def __init__(self, key, app_id):
         self._app_id = app_id
         self.path_chain = []
-        if isinstance(key, dict):
+        if isinstance(key, basestring):
             # mongo _id
-            self._mongo_key = key['dskey']
-            for elem in self._mongo_key:
-                type_, id_ = elem.split("-")
-                try: id_ = int(id_)
-                except: pass
-                self.path_chain.extend([type_, id_])
+            self._mongo_key = key
+            parts = key.split(KEY_TERMINATOR)
+            for i in xrange(0, len(parts) - 1, 2):
+                tagged = parts[i + 1]
+                if tagged[0] == KEY_ID_MARK:
+                    id_ = int(tagged[1:], 16)
+                else:
+                    id_ = _unescape_key_part(tagged[1:])
+                self.path_chain.extend([_unescape_key_part(parts[i]), id_])
 
         elif isinstance(key, entity_pb.Reference):
             # protobuf
             path = key.path().element_list()
-            self._mongo_key = []
+            encoded = []
             for elem in path:
+                encoded.append(_escape_key_part(elem.type()))
+                encoded.append(KEY_TERMINATOR)
                 if elem.has_id():
-                    self._mongo_key.append(elem.type() + "-" + str(elem.id()))
+                    encoded.append(u"%s%016x" % (KEY_ID_MARK, elem.id()))
                     self.path_chain.extend([elem.type(), elem.id()])
                 elif elem.has_name():
-                    self._mongo_key.append(elem.type() + "-" + elem.name())
+                    encoded.append(KEY_NAME_MARK)
+                    encoded.append(_escape_key_part(elem.name()))
                     self.path_chain.extend([elem.type(), elem.name()])
                 else:
-                    raise RuntimeException("Path element doesnt have id neither name.")
+                    raise RuntimeError("Path element doesnt have id neither name.")
+                encoded.append(KEY_TERMINATOR)
+            self._mongo_key = u"".join(encoded)
 
     def to_datastore_key(self):
         """Convert the key into datastore format.
@@ -117,26 +557,71 @@ class _Key(object):
         """
         return datastore_types.Key.from_path(*self.path_chain, _app=self._app_id)
 
+    def to_reference(self):
+        """Convert the key into protocol buffer format.
+
+        Builds the reference straight from the path, which is cheaper than
+        going through datastore_types.Key.
+
+        Returns:
+          Converted key as entity_pb.Reference
+        """
+        ref = entity_pb.Reference()
+        ref.set_app(self._app_id)
+        path = ref.mutable_path()
+        for i in xrange(0, len(self.path_chain), 2):
+            elem = path.add_element()
+            elem.set_type(self.path_chain[i].encode('utf-8'))
+            id_ = self.path_chain[i + 1]
+            if isinstance(id_, basestring):
+                elem.set_name(id_.encode('utf-8'))
+            else:
+                elem.set_id(id_)
+        return ref
+
     def to_mongo_key(self):
         """Convert this key into mongodb format.
 
-        Mongodb format is dict, which contains key 'dskey' mapping to list
-        containing parent path. The last element is key of the entity.
+        Mongodb format is an order-preserving string encoding the whole path
+        of the key (see KEY_TERMINATOR). Keys of descendants are prefixed
+        by keys of their ancestors.
+
+        Returns:
+          Converted key as unicode string.
+        """
+        return self._mongo_key
+
+    def descendants_range(self):
+        """Get range of mongodb keys of this key and all its descendants.
+
+        Returns:
+          Tuple (lower bound inclusive, upper bound exclusive).
+        """
+        return (self._mongo_key, self._mongo_key[:-1] + KEY_ESCAPE)
 
-        Example: {'dskey': ['Product-1', 'Image-4', ...]}
+    def root(self):
+        """Get mongodb key of the root of the entity group of this key.
 
         Returns:
-          Converted key as dict.
+          Converted root key as unicode string.
         """
-        return {'dskey': self._mongo_key}
+        kind_end = self._mongo_key.index(KEY_TERMINATOR)
+        return self._mongo_key[:self._mongo_key.index(KEY_TERMINATOR, kind_end + 1) + 1]
+
+    def is_root(self):
+        """Check if the key has no parent."""
+        return len(self.path_chain) == 2
 
     def collection(self):
         """Get collection name which the key belongs to.
 
+        Every kind has its own collection, entities of one entity group
+        are linked together by ENTITY_GROUP_ATTR.
+
         Returns:
           Name of the collection as string.
         """
-        return self.path_chain[0].lower()
+        return self.kind().lower()
 
     def kind(self):
         """Get kind of the key.
@@ -147,7 +632,7 @@ class _Key(object):
         return self.path_chain[-2]
 
     def __str__(self):
-        return "_Key(%s)" % self._mongo_key
+        return "_Key(%r)" % self._mongo_key
 
 
 
@@ -177,13 +662,16 @@ class _Document(object):
         "key": lambda self, x: _Key(x, self._app_id).to_datastore_key(),
         "blobkey": lambda self, x: BlobKey(x),
         "blob": lambda self, x: datastore_types.Blob(str(x)),
+        "bytes": lambda self, x: str(x),
         "text": lambda self, x: datastore_types.Text(x),
         "local": lambda self, x: datastore_types.EmbeddedEntity(str(x)),
         "user": lambda self, x: users.User(**x)
     }
 
-    def __init__(self, app_id):
+    def __init__(self, app_id, large_values=None):
         self._app_id = app_id
+        self._large_values = large_values
+        self._unindexed = set()
 
     def _encode_user(self, user):
         d = {}
@@ -210,7 +698,8 @@ class _Document(object):
                 s.decode('utf-8')
                 return s
             except UnicodeDecodeError:
-                return "$UTF8$" + "~".join([str(ord(l)) for l in s])
+                # bson strings must be valid utf-8
+                return {"t":"bytes", "v":Binary(s)}
 
         if val.__class__ in self.ENCODER:
             return self.ENCODER[val.__class__](self, val)
@@ -223,6 +712,105 @@ class _Document(object):
         else:
             return val
 
+    def _sort_key(self, val):
+        """Get sort key of datastore value.
+
+        Sort keys are strings which are ordered in the same way as datastore
+        orders the values: type first (null, integers and dates, booleans,
+        strings, floats, geo points, users, keys), then value. Equal values
+        have equal sort keys, so that filters are evaluated on sort keys.
+        Values with long sort keys are ordered only by their prefix.
+
+        Args:
+          val: value, not a list.
+
+        Returns:
+          Sort key as unicode string or None if the value is not orderable.
+        """
+        cls = val.__class__
+        if val is None:
+            return u"0"
+        elif cls in UNINDEXED_TYPES:
+            return None
+        elif cls is bool:
+            return u"2" + (u"1" if val else u"0")
+        elif isinstance(val, (int, long)):
+            return u"1%016x" % (val + _INT64_OFFSET)
+        elif isinstance(val, datetime.datetime):
+            if val.tzinfo is not None:
+                val = val.replace(tzinfo=None) - val.utcoffset()
+            d = val - _EPOCH
+            us = (d.days * 86400 + d.seconds) * 1000000 + d.microseconds
+            return u"1%016x" % (us + _INT64_OFFSET)
+        elif isinstance(val, float):
+            return u"4" + _float_sort_key(val)
+        elif cls is datastore_types.GeoPt:
+            return u"5" + _float_sort_key(val.lat) + _float_sort_key(val.lon)
+        elif cls is users.User:
+            # users without email (federated identity) differ by identity
+            key = u"6" + (val.email() or u"")
+            if val.federated_identity():
+                key += u"\x00" + val.federated_identity()
+        elif cls is datastore_types.Key:
+            key = u"7" + _Key(val._ToPb(), self._app_id).to_mongo_key()
+        elif cls is BlobKey:
+            key = u"3" + str(val).decode('utf-8')
+        elif isinstance(val, basestring):
+            if not isinstance(val, unicode):
+                try:
+                    val = val.decode('utf-8')
+                except UnicodeDecodeError:
+                    val = val.decode('latin-1')
+            key = u"3" + val
+        else:
+            return None
+        if len(key) > SORT_KEY_MAX_LENGTH:
+            digest = hashlib.md5(key.encode('utf-8')).hexdigest()
+            key = (key[:SORT_KEY_MAX_LENGTH - SORT_KEY_HASH_LENGTH] +
+                   digest[:SORT_KEY_HASH_LENGTH].decode('ascii'))
+        return key
+
+    def _sort_keys(self, val):
+        """Get sort key or list of sort keys of repeated property.
+
+        Args:
+          val: value or list of values.
+
+        Returns:
+          Sort key, list of sort keys or None if nothing is orderable.
+        """
+        if not isinstance(val, list):
+            return self._sort_key(val)
+        keys = [k for k in itertools.imap(self._sort_key, val) if k is not None]
+        return keys or None
+
+    def _property_sort_keys(self, attr, val):
+        """Get sort key or list of sort keys of value of the property.
+
+        Used both for stored values and for filter values.
+
+        Args:
+          attr: name of the property in mongodb format.
+          val: value or list of values.
+
+        Returns:
+          Sort key, list of sort keys or None if nothing is orderable.
+        """
+        if attr == SCATTER_ATTR:
+            # the hash is ordered as bytes, whether valid utf-8 or not
+            return u"3" + val.decode('latin-1')
+        return self._sort_keys(val)
+
+    def _is_indexed(self, val):
+        """Check if the value (or any value of the list) can be indexed.
+
+        Values of the list which can not be indexed get no sort keys, but
+        the other values are indexed, as by the datastore.
+        """
+        if isinstance(val, list):
+            return not val or any(itertools.imap(self._is_indexed, val))
+        return val.__class__ not in UNINDEXED_TYPES
+
     def _decode_value(self, val):
         """Translate mongodb value into datastore value.
 
@@ -232,15 +820,13 @@ class _Document(object):
         Returns:
           Value in datastore format.
         """
-        def from_utf8(s):
-            return "".join([chr(int(l)) for l in pp.split("~")])
-
         if isinstance(val, dict):
+            if "r" in val:
+                # value stored in GridFS
+                return self.DECODER[val["t"]](self, self._large_values.load(val))
             return self.DECODER[val["t"]](self, val["v"])
         elif isinstance(val, list):
             return [self._decode_value(x) for x in val]
-        elif isinstance(val, str) and val.startswith("$UTF8$"):
-            return from_utf8(val)
         return val
 
     def _parse_pb(self, entity):
@@ -251,12 +837,30 @@ class _Document(object):
         """
         self._mongo_doc = {}
         self._mongo_doc['_id'] = self.key.to_mongo_key()
+        self._mongo_doc[ENTITY_GROUP_ATTR] = self.key.root()
+        self._unindexed = set()
+        sort_keys = {}
         d = datastore.Entity._FromPb(entity)
+        unindexed_properties = d.unindexed_properties()
+        # repeated property may have both indexed and raw values
+        indexed_properties = set(p.name().decode('utf-8')
+                                 for p in entity.property_list())
         for k, v in d.iteritems():
             # in order to store structured property, we need to translate
             # dot notation into something, what mongodb accepts
             attr = k.replace(".", STRUCTURED_PROPERTY_DELIMITER)
             self._mongo_doc[attr] = self._encode_value(v)
+            # properties stored as raw_property (indexed=False in ndb) and
+            # values like Text or Blob get neither indexes nor sort keys
+            if ((k in unindexed_properties and k not in indexed_properties)
+                    or not self._is_indexed(v)):
+                self._unindexed.add(attr)
+                continue
+            sort_key = self._property_sort_keys(attr, v)
+            if sort_key is not None:
+                sort_keys[attr] = sort_key
+        if sort_keys:
+            self._mongo_doc[SORT_KEYS_ATTR] = sort_keys
 
     def _parse_mongo(self, doc):
         """Parse mongodb document and store result into self.
@@ -267,8 +871,8 @@ class _Document(object):
         key = self.key.to_datastore_key()
         entity = datastore.Entity(kind=key.kind(), parent=key.parent(), name=key.name())
         for k, v in doc.iteritems():
-            # do not set mongodb id
-            if k == '_id': continue
+            # do not set mongodb id, entity group and sort keys
+            if k in ('_id', ENTITY_GROUP_ATTR, SORT_KEYS_ATTR): continue
             # transform attributes of structured properties into dotted format
             attr = k.replace(STRUCTURED_PROPERTY_DELIMITER, ".")
             entity[attr] = self._decode_value(v)
@@ -321,17 +925,19 @@ class _Document(object):
         return d
 
     @classmethod
-    def from_mongo(cls, doc, app_id):
+    def from_mongo(cls, doc, app_id, large_values=None):
         """Parses entity in mongodb format.
 
         Args:
           doc: dict contaning entity to be parsed.
           app_id: string contaning the application ID.
+          large_values: _LargeValueStore instance to load values stored
+              out of the document, None if not used.
 
         Returns:
           Instance of _Document class.
         """
-        d = cls(app_id)
+        d = cls(app_id, large_values)
         d.key = _Key(doc['_id'], app_id)
         d._parse_mongo(doc)
         d._mongo_doc = doc
@@ -353,18 +959,14 @@ class _Document(object):
             if isinstance(v, list):
                 type_ += ":" + v[0].__class__.__name__
             schema[k] = type_
+        schema[UNINDEXED_ATTR] = sorted(self._unindexed)
         return schema
 
     def iter_mongo_indexes(self):
-        for attr, val in self._mongo_doc.iteritems():
-            if attr in ('_id', '__scatter__'):
-                continue
-            if isinstance(val, dict):
-                t = "%s.t" % attr
-                v = "%s.v" % attr
-                yield [(v, ASCENDING), (t, ASCENDING)]
-            else:
-                yield attr
+        # properties are both filtered and ordered by their sort keys
+        yield ENTITY_GROUP_ATTR
+        for attr in self._mongo_doc.get(SORT_KEYS_ATTR, ()):
+            yield "%s.%s" % (SORT_KEYS_ATTR, attr)
 
     def __str__(self):
         return "_Document(%s)" % str(self._mongo_doc)
@@ -379,21 +981,31 @@ class _BaseCursor(object):
         self._app_id = query.app()
         self._skipped_results = 0
 
+    def _key_only_entity(self, doc):
+        """Build key-only entity from the document, properties are skipped.
 
+        Args:
+          doc: dict containing at least _id of the entity.
 
-class _IteratorCursor(_BaseCursor):
-    """
-    Iterable cursor wrapper around pymongo.Cursor.
+        Returns:
+          Entity in entity_pb.EntityProto format without properties.
+        """
+        entity = entity_pb.EntityProto()
+        entity.mutable_key().CopyFrom(_Key(doc['_id'], self._app_id).to_reference())
+        entity.mutable_entity_group()
+        return entity
 
-    Returns results in format of entity_pb.EntityProto objects. The cursor
-    returns partial entities when projection on repeated property is applied.
+
+
+class _QueryPlan(object):
     """
-    # maps mongodb operators to appropriate python functions.
-    _MONGO_FILTER_MAP = {"$lt": lambda x,y: x<y,
-                         "$lte": lambda x,y: x<=y,
-                         "$gte": lambda x,y: x>=y,
-                         "$gt": lambda x,y: x>y}
+    Translation of datastore query into mongodb query, which does not depend
+    on literal values of the query.
 
+    Plans are cached by the shape of the query (kind, filtered properties
+    and operators, orders, projection, ancestor, ...), so that queries
+    of the same shape only bind their values to the plan.
+    """
     # maps datastore query operators to mongodb ones.
     _DATASTORE_FILTER_MAP = {
         datastore_pb.Query_Filter.LESS_THAN: '$lt',
@@ -402,55 +1014,80 @@ class _IteratorCursor(_BaseCursor):
         datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL: '$gte',
     }
 
-    def __init__(self, query, db):
+    def __init__(self, query, unwound):
         """Constructor.
 
-        Initializes pymongo cursor inside this wrapper.
+        Args:
+          query: datastore query (datastore_pb.Query) of the shape.
+          unwound: list of projected repeated properties (see unwound()).
+        """
+        self.app_id = query.app()
+        self.coll_name = query.kind().lower()
+        self.keys_only = query.keys_only()
+        self.ancestor = query.has_ancestor()
+        self.projected_props = set(query.property_name_list())
+        self.projected_mongo_props = self.mongo_props(query)
+        self.unwound = unwound
+        self.projection = self._projection(query)
+        self.filters = self._filters(query)
+        self.order, self.order_filters = self._ordering(query)
+        self.dummy = self._dummy_proto(query)
+        # encoder of filter values
+        self._encoder = _Document(self.app_id)
+
+    @staticmethod
+    def mongo_props(query):
+        """Get projected properties of the query in mongodb format."""
+        return sorted(set([x.replace(".", STRUCTURED_PROPERTY_DELIMITER)
+                           for x in query.property_name_list()]))
+
+    @classmethod
+    def unwound(cls, query, schema):
+        """Get projected repeated properties, which are split by pipeline.
 
         Args:
-          query: datastore query (datastore_pb.Query) for which the cursor
-                 is created.
-          db: pymongo.database.Database instance.
+          query: datastore query (datastore_pb.Query).
+          schema: schema manager, tells which properties are repeated.
+
+        Returns:
+          List of property names in mongodb format.
         """
-        super(_IteratorCursor, self).__init__(query)
-        self.__limit = 0
-        self.__offset = 0
-        self.__query = query
-        self._skipped_results = 0
-        self._projected_props = set(query.property_name_list())
-        self._projected_mongo_props = set([x.replace(".", \
-                STRUCTURED_PROPERTY_DELIMITER) for x in query.property_name_list()])
-        # storage for results of projection queries on repeated properties
-        self._projection_splitted = []
-
-        # parse query
-        proj = self._projection(query)
-        self._filters = self._get_filters(query)
-        self._ancestor_query(query)
-        order = self._ordering(query)
-        coll_name = query.kind().lower()
+        if not query.property_name_size():
+            return []
+        kind = query.kind().lower()
+        unwound = []
+        for attr in cls.mongo_props(query):
+            try:
+                if schema.get_type(kind, attr).startswith("list"):
+                    unwound.append(attr)
+            except KeyError:
+                pass
+        return unwound
 
-        # get cursor
-        if proj:
-            self.__cursor = db[coll_name].find(self._filters, proj)
-        else:
-            self.__cursor = db[coll_name].find(self._filters)
-        if order:
-            self.__cursor.sort(order)
-        if query.has_offset():
-            self.offset(query.offset())
-        if query.has_limit():
-            self.limit(query.limit())
+    @staticmethod
+    def shape(query, unwound):
+        """Get shape of the query, the key of its plan in the cache.
+
+        Args:
+          query: datastore query (datastore_pb.Query).
+          unwound: list of projected repeated properties.
 
-        self._dummy = self._dummy_proto()
+        Returns:
+          Hashable tuple.
+        """
+        return (query.app(), query.kind(),
+                tuple((f.property(0).name(), f.op()) for f in query.filter_list()),
+                tuple((o.property(), o.direction()) for o in query.order_list()),
+                tuple(query.property_name_list()), query.has_ancestor(),
+                query.keys_only(), tuple(unwound))
 
-    def _dummy_proto(self):
+    def _dummy_proto(self, query):
         pb = entity_pb.EntityProto()
         pb.mutable_entity_group()
         pk = pb.mutable_key()
-        pk.set_app(self.__query.app())
+        pk.set_app(query.app())
         pe = pk.mutable_path().add_element()
-        pe.set_type(self.__query.kind())
+        pe.set_type(query.kind())
         pe.set_id(0)
         return pb
 
@@ -463,53 +1100,33 @@ class _IteratorCursor(_BaseCursor):
         Returns:
           Projection specification for pymongo's Cursor.
         """
+        if query.keys_only():
+            # keys are read from _id only, which is also covered by the index
+            return {'_id': 1}
         proj = {}
         for prop_name in query.property_name_list():
             proj[prop_name.replace(".", STRUCTURED_PROPERTY_DELIMITER)] = 1
         return proj
 
-    def _get_filters(self, query):
-        """Get filter specification for mongo query.
+    def _filters(self, query):
+        """Get filtered attributes and operators.
 
         Args:
           query: datastore query (datastore_pb.Query).
 
         Returns:
-          Dict of filters for pymongo's Cursor.
+          List of tuples (attribute, mongodb operator or None for equality).
         """
-        # dummy document, XXX: needs refactoring
-        _d = _Document('a')
-        filters = {}
+        filters = []
         for f in query.filter_list():
-            # resolve property name and value
             prop = f.property(0).name().decode('utf-8')
             if prop == "__key__":
-                prop = "_id.dskey"
-            prop = prop.replace(".", STRUCTURED_PROPERTY_DELIMITER)
-
-            val = datastore_types.FromPropertyPb(f.property_list()[0])
-            val = _d._encode_value(val)
-
-            # transform filter value of nonequality filter
-            if f.op() != datastore_pb.Query_Filter.EQUAL:
-                val = {self._DATASTORE_FILTER_MAP[f.op()] : val}
-            # if there are more filters on the same property -> AND
-            if prop in filters:
-                v1 = filters[prop]
-                del filters[prop]
-                filters["$and"] = [{prop:v1}, {prop:val}]
-            elif '$and' in filters:
-                filters['$and'].append({prop: val})
+                prop = "_id"
             else:
-                filters[prop] = val
+                prop = prop.replace(".", STRUCTURED_PROPERTY_DELIMITER)
+            filters.append((prop, self._DATASTORE_FILTER_MAP.get(f.op())))
         return filters
 
-    def _ancestor_query(self, query):
-        """Handle ancestor queries. Adds new filter to _id attribute."""
-        if query.has_ancestor():
-            k = _Key(query.ancestor(), self._app_id)._mongo_key
-            self._filters["_id.dskey"] = {'$all' : k}
-
     def _ordering(self, query):
         """Get sort orders in mongodb format.
 
@@ -517,84 +1134,435 @@ class _IteratorCursor(_BaseCursor):
           query: datastore query (datastore_pb.Query).
 
         Returns:
-          List of order dicts for pymongo.Cursor.
+          Tuple (list of order tuples for pymongo.Cursor, list of filters
+          which have to be added to the query).
         """
         ordering = []
+        filters = []
         for order in query.order_list():
             key = order.property().decode('utf-8')
             direction = ASCENDING
             if order.direction() is datastore_pb.Query_Order.DESCENDING:
                 direction = DESCENDING
 
-            # translate key attribute
+            # translate key attribute, keys are always present and orderable
             if key == "__key__":
-                key = "_id.dskey"
+                ordering.append(("_id", direction))
+                continue
             # translate structured property attributes
             key = key.replace(".", STRUCTURED_PROPERTY_DELIMITER)
 
-            ordering.append((key, direction))
+            # order by sort keys, they exist only for orderable values, so
+            # the range filter omits entities without the property or with
+            # unorderable values as google datastore does
+            sort_key = "%s.%s" % (SORT_KEYS_ATTR, key)
+            ordering.append((sort_key, direction))
+            filters.append((sort_key, {"$gt": u""}))
+        return ordering, filters
 
-            # add $exists filter to get the same behaviour as google datastore:
-            # if the attribute does not exist in the entity, datastore omits it,
-            # but mognodb returns it..
-            if key in self._filters:
-                try:
-                    self._filters[key]["$exists"] = True
-                except TypeError:
-                    pass
-            else:
-                self._filters[key] = {"$exists" : True}
-
-            # ensure that there are not returned results with unorderable
-            # property types
-            type_for_key = "%s.t" % key
-            self._filters[type_for_key] = {"$nin" : ["blob", "text", "local"]}
-        return ordering
-
-    def offset(self, o):
-        """Apply offset to this cursor."""
-        assert o >= 0
-        self.__offset = o
-        # HACK: ndb is probably requesting count()
-        if o >= 2147483647:
-            o = 0
-        self.__cursor.skip(o)
-        return self
-
-    def limit(self, l):
-        """Apply limit to this cursor."""
-        assert l >= 0
-        if isinstance(l, long):
-            if l < sys.maxint:
-                l = int(l)
-            else:
-                l = sys.maxint
-        self.__limit = l
-        self.__cursor.limit(l)
-        return self
-
-    def _prepare_properties(self, entity):
-        """Prepares properties in case of projection query.
+    def bind(self, query):
+        """Get filter specification for mongo query.
 
         Args:
-          entity: entity_pb.EntityProto to be prepared.
+          query: datastore query (datastore_pb.Query) of the plan's shape.
+
+        Returns:
+          Dict of filters for pymongo's Cursor.
         """
-        return LoadEntity(entity, keys_only=False,  # TODO: keys only???
-                          property_names=self._projected_props)
+        filters = {}
+        for (prop, op), f in itertools.izip(self.filters, query.filter_list()):
+            val = datastore_types.FromPropertyPb(f.property(0))
+            if prop == "_id":
+                val = _Key(val._ToPb(), self.app_id).to_mongo_key()
+                if op is not None:
+                    val = {op : val}
+                _add_filter(filters, prop, val)
+                continue
 
-    def __iter__(self): return self
+            # properties are filtered by sort keys, which are indexed
+            val = self._encoder._property_sort_keys(prop, val)
+            prop = "%s.%s" % (SORT_KEYS_ATTR, prop)
+            if val is None:
+                # unorderable values are not indexed, nothing matches
+                val = {"$in": []}
+            elif op is not None:
+                # range of values of the same type, sort keys start with
+                # the type
+                if op in ("$gt", "$gte"):
+                    bound = {"$lt": unichr(ord(val[0]) + 1)}
+                else:
+                    bound = {"$gte": val[0]}
+                _add_filter(filters, prop, bound)
+                val = {op : val}
+            _add_filter(filters, prop, val)
+
+        # ancestor query: equality filter on the entity group and, if the
+        # ancestor is not the root of the group, range filter on _id
+        if self.ancestor:
+            k = _Key(query.ancestor(), self.app_id)
+            _add_filter(filters, ENTITY_GROUP_ATTR, k.root())
+            if not k.is_root():
+                lower, upper = k.descendants_range()
+                _add_filter(filters, "_id", {"$gte": lower, "$lt": upper})
+
+        for prop, val in self.order_filters:
+            _add_filter(filters, prop, val)
+        return filters
 
-    def _get_filter_fnc(self, filter_spec):
-        """Get filtering function for projected properties.
+    def bind_values(self, query):
+        """Get filters on values of properties.
 
-        In case of projection query, returned function filters
-        results from datastore on app layer.
+        Partial entities of projection queries are filtered by the values,
+        which are split from lists.
+
+        Args:
+          query: datastore query (datastore_pb.Query) of the plan's shape.
+
+        Returns:
+          Dict of filters on properties in mongodb format.
+        """
+        filters = {}
+        for (prop, op), f in itertools.izip(self.filters, query.filter_list()):
+            if prop == "_id":
+                continue
+            val = datastore_types.FromPropertyPb(f.property(0))
+            val = self._encoder._encode_value(val)
+            if op is not None:
+                val = {op : val}
+            _add_filter(filters, prop, val)
+        return filters
+
+
+
+class _IteratorCursor(_BaseCursor):
+    """
+    Iterable cursor wrapper around pymongo.Cursor.
+
+    Returns results in format of entity_pb.EntityProto objects. The cursor
+    returns partial entities when projection on repeated property is applied:
+    such queries are compiled into aggregation pipeline, which splits,
+    filters, de-duplicates and orders the partial entities inside mongodb.
+    Lists found in properties the schema does not know as repeated are split
+    by the cursor itself.
+    """
+    # maps mongodb operators to appropriate python functions.
+    _MONGO_FILTER_MAP = {"$lt": lambda x,y: x<y,
+                         "$lte": lambda x,y: x<=y,
+                         "$gte": lambda x,y: x>=y,
+                         "$gt": lambda x,y: x>y}
+
+    def __init__(self, query, db, schema, large_values=None, plans=None):
+        """Constructor.
+
+        Initializes pymongo cursor inside this wrapper.
+
+        Args:
+          query: datastore query (datastore_pb.Query) for which the cursor
+                 is created.
+          db: pymongo.database.Database instance.
+          schema: schema manager, tells which properties are repeated.
+          large_values: _LargeValueStore instance or None.
+          plans: _LRUCache of query plans or None.
+        """
+        super(_IteratorCursor, self).__init__(query)
+        self._large_values = large_values
+        self.__limit = 0
+        self.__offset = 0
+        self.__query = query
+        self._skipped_results = 0
+        self.__pipeline = None
+        # partial entities split from the last fetched document
+        self.__split = []
+        #: number of skipped results of count query, None otherwise
+        self.count = None
+
+        # get plan of the query and bind values of the query to it
+        plan = self._plan(query, schema, plans)
+        self._keys_only = plan.keys_only
+        self._projected_props = plan.projected_props
+        self._projected_mongo_props = plan.projected_mongo_props
+        # projected repeated properties, which are split by the pipeline
+        self._unwound = plan.unwound
+        self._dummy = plan.dummy
+        self._filters = plan.bind(query)
+        self._value_filters = {}
+        if self._projected_mongo_props:
+            self._value_filters = plan.bind_values(query)
+        # decoder of values matched to unwound sort keys
+        self._decoder = _Document(self._app_id)
+        proj = plan.projection
+        order = plan.order
+        coll = db[plan.coll_name]
+        if plan.ancestor and order:
+            self._ensure_ancestor_index(coll, order)
+
+        # get cursor
+        if self.is_count(query):
+            # only number of skipped results is requested (ndb's count()),
+            # count them on the server, the cursor returns no results
+            self.__cursor = iter([])
+            self.count = self._count(coll, order, self._bounded(query.offset()))
+            return
+        if self._unwound:
+            self.__pipeline = self._pipeline(order)
+        elif proj:
+            self.__cursor = coll.find(self._filters, proj)
+        else:
+            # sort keys are needed only by mongodb
+            self.__cursor = coll.find(self._filters, {SORT_KEYS_ATTR: 0})
+        if order and self.__pipeline is None:
+            self.__cursor.sort(order)
+        # results bounded by cursors are skipped and limited outside
+        # of mongodb, after the cursors are applied
+        if not (query.has_compiled_cursor() or
+                query.has_end_compiled_cursor()):
+            if query.has_offset():
+                self.offset(query.offset())
+            if query.has_limit():
+                self.limit(query.limit())
+        if self.__pipeline is not None:
+            self.__cursor = _aggregate(coll, self.__pipeline)
+
+    def _plan(self, query, schema, plans):
+        """Get plan of the query from the cache or create it.
+
+        Args:
+          query: datastore query (datastore_pb.Query).
+          schema: schema manager.
+          plans: _LRUCache of query plans or None.
+
+        Returns:
+          _QueryPlan instance.
+        """
+        unwound = _QueryPlan.unwound(query, schema)
+        if plans is None:
+            return _QueryPlan(query, unwound)
+        shape = _QueryPlan.shape(query, unwound)
+        plan = plans.get(shape)
+        if plan is None:
+            epoch = plans.epoch()
+            plan = _QueryPlan(query, unwound)
+            plans.put(shape, plan, epoch)
+        return plan
+
+    @staticmethod
+    def is_count(query):
+        """Check if query requests only the number of skipped results.
+
+        Args:
+          query: datastore query (datastore_pb.Query).
+
+        Returns:
+          True if the query has zero limit and nonzero offset and it is not
+          bounded by cursors, which mongodb can not count.
+        """
+        if query.has_compiled_cursor() or query.has_end_compiled_cursor():
+            return False
+        return query.has_limit() and query.limit() == 0 and query.offset() > 0
+
+    def _count(self, coll, order, limit):
+        """Count results of the query on the server.
+
+        Args:
+          coll: pymongo.collection.Collection queried collection.
+          order: list of sort orders of the query plan.
+          limit: maximal number of results to count.
+
+        Returns:
+          int, number of results, at most limit.
+        """
+        if not self._unwound:
+            return _count(coll, self._filters, limit)
+        # partial entities are counted after they are split and de-duplicated
+        pipeline = self._pipeline(order)
+        pipeline.extend([{'$limit': limit},
+                         {'$group': {'_id': None, 'n': {'$sum': 1}}}])
+        for doc in _aggregate(coll, pipeline):
+            return doc['n']
+        return 0
+
+    def _bounded(self, n):
+        """Convert long number to int accepted by pymongo."""
+        if isinstance(n, long):
+            if n < sys.maxint:
+                n = int(n)
+            else:
+                n = sys.maxint
+        return n
+
+    def _ensure_ancestor_index(self, coll, order):
+        """Ensure compound index for ordered ancestor query.
+
+        Args:
+          coll: pymongo.collection.Collection queried collection.
+          order: list of sort orders of the query plan.
+        """
+        coll.ensure_index([(ENTITY_GROUP_ATTR, ASCENDING)] + list(order),
+                          cache_for=3600)
+
+    def _pipeline(self, order):
+        """Compile projection query on repeated properties into pipeline.
+
+        Documents are matched by filters, projected, sort keys of every
+        projected repeated property are unwound, the partial documents are
+        filtered again by the filters on unwound properties, de-duplicated
+        and sorted, so that they are ordered as by the datastore. Values
+        are matched to the unwound sort keys by _from_group.
+
+        Args:
+          order: list of sort orders from _ordering method.
+
+        Returns:
+          List of aggregation pipeline stages.
+        """
+        proj = dict((attr, 1) for attr in self._projected_mongo_props)
+        for attr in self._unwound:
+            proj["%s.%s" % (SORT_KEYS_ATTR, attr)] = 1
+        for attr, direction in order:
+            proj[attr] = 1
+        pipeline = [{'$match': self._filters}, {'$project': proj}]
+        for attr in self._unwound:
+            pipeline.append({'$unwind': "$%s.%s" % (SORT_KEYS_ATTR, attr)})
+        filters = self._unwound_filters()
+        if filters:
+            pipeline.append({'$match': filters})
+
+        # group by key and projected values (sort keys of the unwound ones)
+        # to get rid of duplicates, sort orders on other properties and lists
+        # of the unwound values are carried along
+        group_id = {'k': '$_id'}
+        group = {'_id': group_id}
+        aliases = {'_id': '_id.k'}
+        for i, attr in enumerate(self._projected_mongo_props):
+            if attr in self._unwound:
+                sort_key = "%s.%s" % (SORT_KEYS_ATTR, attr)
+                group_id['p%d' % i] = '$' + sort_key
+                aliases[sort_key] = '_id.p%d' % i
+                group['v%d' % i] = {'$first': '$' + attr}
+            else:
+                group_id['p%d' % i] = '$' + attr
+                aliases[attr] = '_id.p%d' % i
+        for i, (attr, direction) in enumerate(order):
+            if attr not in aliases:
+                group['o%d' % i] = {'$first': '$' + attr}
+                aliases[attr] = 'o%d' % i
+        pipeline.append({'$group': group})
+
+        # datastore returns partial entities ordered by key and then by value
+        sort = SON()
+        for attr, direction in order:
+            sort[aliases[attr]] = direction
+        for attr in ['_id'] + ["%s.%s" % (SORT_KEYS_ATTR, attr)
+                               for attr in self._unwound]:
+            if aliases[attr] not in sort:
+                sort[aliases[attr]] = ASCENDING
+        pipeline.append({'$sort': sort})
+        return pipeline
+
+    def _unwound_filters(self):
+        """Get filters on sort keys of unwound properties.
+
+        Returns:
+          Dict of filters for $match stage of aggregation pipeline.
+        """
+        unwound = set("%s.%s" % (SORT_KEYS_ATTR, attr)
+                      for attr in self._unwound)
+        filters = {}
+        for attr, val in self._filters.iteritems():
+            if attr in unwound:
+                filters[attr] = val
+        for f in self._filters.get("$and", []):
+            attr, val = f.items()[0]
+            if attr in unwound:
+                _add_filter(filters, attr, val)
+        return filters
+
+    def _from_group(self, group):
+        """Translate result of the pipeline back into partial document.
+
+        Args:
+          group: document produced by $group stage of the pipeline.
+
+        Returns:
+          Document in the same format as stored in mongodb.
+        """
+        values = group['_id']
+        doc = {'_id': values['k']}
+        for i, attr in enumerate(self._projected_mongo_props):
+            alias = 'p%d' % i
+            if alias not in values:
+                continue
+            if attr in self._unwound:
+                doc[attr] = [self._unwound_value(attr, group.get('v%d' % i),
+                                                 values[alias])]
+            else:
+                doc[attr] = values[alias]
+        return doc
+
+    def _unwound_value(self, attr, values, sort_key):
+        """Find the value of repeated property which has the sort key.
+
+        Args:
+          attr: name of the property in mongodb format.
+          values: list of values of the property as stored in mongodb.
+          sort_key: unwound sort key.
+
+        Returns:
+          Value as stored in mongodb.
+        """
+        if not isinstance(values, list):
+            values = [values]
+        for val in values:
+            if isinstance(val, dict) and "r" in val:
+                # values stored in GridFS are not orderable
+                continue
+            decoded = self._decoder._decode_value(val)
+            if self._decoder._property_sort_keys(attr, decoded) == sort_key:
+                return val
+        return None
+
+    def offset(self, o):
+        """Apply offset to this cursor."""
+        assert o >= 0
+        o = self._bounded(o)
+        self.__offset = o
+        if self.__pipeline is not None:
+            if o:
+                self.__pipeline.append({'$skip': o})
+        else:
+            self.__cursor.skip(o)
+        return self
+
+    def limit(self, l):
+        """Apply limit to this cursor."""
+        assert l >= 0
+        l = self._bounded(l)
+        self.__limit = l
+        if self.__pipeline is not None:
+            # zero means no limit as in pymongo.Cursor
+            if l:
+                self.__pipeline.append({'$limit': l})
+        else:
+            self.__cursor.limit(l)
+        return self
+
+    def _prepare_properties(self, entity):
+        """Prepares properties in case of projection query.
+
+        Args:
+          entity: entity_pb.EntityProto to be prepared.
+        """
+        return LoadEntity(entity, keys_only=False,
+                          property_names=self._projected_props)
+
+    def _get_filter_fnc(self, filter_spec):
+        """Get function performing filter on a value of projected property.
 
         Args:
           filter_spec: filter specification in pymongo's format.
 
         Returns:
-          Function (lambda) performing the filter.
+          Function (lambda) performing the filter or None.
         """
         if isinstance(filter_spec, dict):
             # inequality operator
@@ -606,72 +1574,60 @@ class _IteratorCursor(_BaseCursor):
                 return None
         else:
             # equals
-            return lambda x: x == spec
+            return lambda x: x == filter_spec
 
-    def _filter_projected_values(self, prop, values):
-        """Filters values from repeated property in case of projection query.
+    def _filter_projected_values(self, attr, values):
+        """Filter and de-duplicate values of split property.
 
         Args:
-          prop: name of repeated property
+          attr: name of the property in mongodb format.
           values: list of the property's values.
 
         Returns:
-          Filtered results.
-        """
-        # is there some filter defined on this property?
-        filter_fnc = []
-        if prop in self._filters:
-            filter_fnc.append(self._get_filter_fnc(self._filters[prop]))
-        if "$and" in self._filters and not filter_fnc:
-            for f in self._filters["$and"]:
-                filtered_prop, fdict = f.items()[0]
-                if filtered_prop != prop: continue
-                filter_fnc.append(self._get_filter_fnc(fdict))
-        # get rid of None's
-        filter_fnc = filter(None, filter_fnc)
-        if not filter_fnc:
-            return set(values)
-        # do filtering
+          List of values matching all filters on the property.
+        """
+        specs = []
+        if attr in self._value_filters:
+            specs.append(self._value_filters[attr])
+        for f in self._value_filters.get("$and", []):
+            if attr in f:
+                specs.append(f[attr])
+        filter_fnc = filter(None, map(self._get_filter_fnc, specs))
         result = []
-        for v in set(values):
-            if all([fnc(v) for fnc in filter_fnc]):
+        for v in values:
+            if v not in result and all(fnc(v) for fnc in filter_fnc):
                 result.append(v)
         return result
 
-    def _split_projected(self, e):
-        """Splits values of repeated property if it is projected.
+    def _split_projected(self, doc):
+        """Split document on list values of projected properties.
 
-        Inserts all partial entities into _projection_splitted list.
+        Used for properties which the schema does not know as repeated,
+        so the query was not compiled into aggregation pipeline.
 
         Args:
-          e: entity which could be potentionally splitted.
+          doc: document fetched from mongodb.
 
         Returns:
-          True if the the splitting was done, False otherwise.
+          List of partial documents, None if there is nothing to split.
         """
-        projected = set(e.keys()) & self._projected_mongo_props
-        if not projected:
-            return False
-        repeated = filter(lambda t: isinstance(t[1], list), # XXX list only?
-                          [(attr, e[attr]) for attr in projected])
+        repeated = [attr for attr in self._projected_mongo_props
+                    if isinstance(doc.get(attr), list)]
         if not repeated:
-            return False
-        if len(repeated) > 1:
-            warnings.warn("Projection queries on more than one multivalued "\
-                          "properties not supported yet.", FutureWarning)
-            return False
-        # split result on repeated property
-        prop, values = repeated[0]
-        for value in self._filter_projected_values(prop, values):
-            e_new = e.copy()
-            e_new[prop] = [value]
-            e_proto = _Document.from_mongo(e_new, self._app_id).to_pb()
-            self._projection_splitted.insert(0, self._prepare_properties(e_proto))
-        return True
+            return None
+        values = [self._filter_projected_values(attr, doc[attr])
+                  for attr in repeated]
+        docs = []
+        for combination in itertools.product(*values):
+            partial = dict(doc)
+            for attr, value in itertools.izip(repeated, combination):
+                partial[attr] = [value]
+            docs.append(partial)
+        return docs
+
+    def __iter__(self): return self
 
     def _next_offset(self):
-        if self.__offset > 10000: # XXX ?
-            return False
         if self._skipped_results < self.__offset:
             self._skipped_results += 1
             return True
@@ -682,19 +1638,26 @@ class _IteratorCursor(_BaseCursor):
         if self._next_offset():
             return self._dummy
 
-        # If query has defined projection on repeated property, we fetch
-        # entity and split it into multiple partial entities which we
-        # return sequentially by calling this method.
-        if self._projection_splitted:
-            return self._projection_splitted.pop()
-
-        e = self.__cursor.next()
-        if self._split_projected(e):
-            return self._projection_splitted.pop()
+        if self.__split:
+            e = self.__split.pop()
         else:
-            # not splitted, just return this result
-            entity = _Document.from_mongo(e, self._app_id).to_pb()
-            return self._prepare_properties(entity)
+            e = self.__cursor.next()
+            if self._keys_only:
+                return self._key_only_entity(e)
+            if self.__pipeline is not None:
+                # partial entity produced by the pipeline
+                e = self._from_group(e)
+            elif self._projected_mongo_props:
+                split = self._split_projected(e)
+                while split == []:
+                    # no value of the document matches the filters
+                    e = self.__cursor.next()
+                    split = self._split_projected(e)
+                if split:
+                    self.__split = split[::-1]
+                    e = self.__split.pop()
+        entity = _Document.from_mongo(e, self._app_id, self._large_values).to_pb()
+        return self._prepare_properties(entity)
 
 
 
@@ -753,14 +1716,300 @@ class _PseudoKindCursor(_BaseCursor):
 
 
 
-def _StatCursor(query, db):
-    """Just a dummy cursor returning all entities in database"""
-    app_id = query.app()
-    cols = set(db.collection_names())
-    cols -= set([u'_indexes', u'system.indexes', u'_schema'])
-    for c in cols:
-        for e in db[c].find():
-            yield _Document.from_mongo(e, app_id).to_pb()
+class _CountCursor(datastore_stub_util.IteratorCursor):
+    """
+    Cursor of query requesting only the number of skipped results.
+
+    The number is counted by mongodb and reported in the first batch,
+    no results are skipped one by one.
+    """
+    def __init__(self, query, dsquery, orders, index_list, count):
+        """Constructor.
+
+        Args:
+          query: datastore_pb.Query which is counted.
+          dsquery: datastore_query.Query built from the query.
+          orders: list of orders of the query.
+          index_list: list of indexes used by the query.
+          count: int, number of skipped results.
+        """
+        super(_CountCursor, self).__init__(query, dsquery, orders,
+                                           index_list, iter([]))
+        self.__count = count
+
+    def PopulateQueryResult(self, result, count, deprecated_offset,
+                            *args, **kwargs):
+        super(_CountCursor, self).PopulateQueryResult(result, 0, 0,
+                                                      *args, **kwargs)
+        result.set_skipped_results(self.__count)
+        result.set_more_results(False)
+        self.__count = 0
+
+
+
+class _CachingCursor(object):
+    """
+    Cursor wrapper recording results of the query into the query cache.
+
+    Results are stored when the wrapped cursor is exhausted, unless there
+    are too many of them.
+    """
+    def __init__(self, cursor, cache, key, version, max_results):
+        """Constructor.
+
+        Args:
+          cursor: iterable cursor returning entities.
+          cache: _LRUCache instance.
+          key: key of the query in the cache.
+          version: write version of the kind before the query was performed.
+          max_results: int, maximal number of results to be cached.
+        """
+        self._cursor = cursor
+        self._cache = cache
+        self._epoch = cache.epoch()
+        self._key = key
+        self._version = version
+        self._max_results = max_results
+        self._results = []
+
+    def __iter__(self): return self
+
+    def next(self):
+        try:
+            entity = self._cursor.next()
+        except StopIteration:
+            if self._results is not None:
+                self._cache.put(self._key, (self._version, self._results),
+                                self._epoch)
+                self._results = None
+            raise
+        if self._results is not None:
+            # the returned entity may be changed by the caller
+            self._results.append(_copy_entity(entity))
+            if len(self._results) > self._max_results:
+                self._results = None
+        return entity
+
+
+
+class _Prefetcher(object):
+    """
+    Reads documents of a cursor ahead by batches.
+
+    The next batch is read while the previous one is consumed. Batches are
+    read by a pool of threads shared by all prefetchers, so the number of
+    threads does not grow with the number of read cursors. A batch is read
+    only when the previous one was taken, so an abandoned prefetcher holds
+    no thread.
+    """
+    #: number of threads reading batches of all prefetchers
+    POOL_SIZE = 4
+
+    _pool = None
+    _pool_lock = threading.Lock()
+
+    def __init__(self, cursor, size):
+        """Constructor.
+
+        Args:
+          cursor: iterable pymongo cursor.
+          size: int, number of documents in one batch.
+        """
+        self._cursor = cursor
+        self._size = size
+        self._pending = self._get_pool().apply_async(self._read)
+
+    @classmethod
+    def _get_pool(cls):
+        with cls._pool_lock:
+            if cls._pool is None:
+                cls._pool = multiprocessing.pool.ThreadPool(cls.POOL_SIZE)
+            return cls._pool
+
+    def _read(self):
+        return list(itertools.islice(self._cursor, self._size))
+
+    def __iter__(self):
+        while True:
+            # errors of the reading thread are raised here
+            batch = self._pending.get()
+            if len(batch) < self._size:
+                for doc in batch:
+                    yield doc
+                return
+            self._pending = self._get_pool().apply_async(self._read)
+            for doc in batch:
+                yield doc
+
+
+
+class _KindlessCursor(_BaseCursor):
+    """
+    Cursor for kindless queries, returns entities of all kinds in key order.
+
+    Every collection is queried with key filters and ancestor of the query,
+    sorted by key and limited to the number of entities needed for offset
+    and limit. Collections are read concurrently and their streams are merged,
+    so reading stops as soon as enough entities are returned.
+    """
+    #: number of documents read ahead from every collection
+    PREFETCH_SIZE = 100
+
+    def __init__(self, query, db, large_values=None):
+        """Constructor.
+
+        Args:
+          query: kindless datastore query (datastore_pb.Query).
+          db: pymongo.database.Database instance.
+          large_values: _LargeValueStore instance or None.
+        """
+        super(_KindlessCursor, self).__init__(query)
+        self._large_values = large_values
+        plan = _QueryPlan(query, [])
+        self._keys_only = plan.keys_only
+        filters = plan.bind(query)
+        # sort keys are needed only by mongodb
+        proj = plan.projection or {SORT_KEYS_ATTR: 0}
+        needed = None
+        if query.has_limit():
+            # pymongo accepts only 32-bit limits
+            needed = min(query.offset() + query.limit(), 2147483647)
+
+        streams = []
+        if needed != 0:
+            for coll_name in db.collection_names():
+                if not _is_entity_collection(coll_name):
+                    continue
+                # keys are unique and ordered in the same way in all kinds
+                cursor = db[coll_name].find(filters, proj).sort('_id', ASCENDING)
+                if needed:
+                    cursor.limit(int(needed))
+                streams.append(cursor)
+        # few needed documents are read by the first batch of every cursor
+        if len(streams) > 1 and (needed is None or needed > self.PREFETCH_SIZE):
+            streams = [_Prefetcher(c, self.PREFETCH_SIZE) for c in streams]
+        self._docs = heapq.merge(*[((doc['_id'], doc) for doc in stream)
+                                   for stream in streams])
+
+    def __iter__(self): return self
+
+    def next(self):
+        key, doc = self._docs.next()
+        if self._keys_only:
+            return self._key_only_entity(doc)
+        return _Document.from_mongo(doc, self._app_id, self._large_values).to_pb()
+
+
+
+class _StatCursor(_BaseCursor):
+    """
+    Cursor returning entities of datastore statistics kinds.
+
+    Statistics of kinds are computed from collStats of their collections.
+    Statistics of property types are summed from counters maintained by put
+    and delete (see stat_counters of MongoDatastore), without the counters
+    they are estimated from the schema. Entities are not scanned.
+    """
+    #: supported statistics kinds
+    KINDS = frozenset(['__Stat_Total__', '__Stat_Kind__',
+                       '__Stat_PropertyType__'])
+    #: key name of the only __Stat_Total__ entity
+    TOTAL_KEY_NAME = 'total_entity_usage'
+
+    def __init__(self, query, db, schema):
+        """Constructor.
+
+        Args:
+          query: query (datastore_pb.Query) on one of the statistics kinds.
+          db: pymongo.database.Database instance.
+          schema: schema manager.
+        """
+        super(_StatCursor, self).__init__(query)
+        self._namespace = query.name_space() or None
+        self._db = db
+        self._schema = schema
+        self._timestamp = datetime.datetime.utcnow().replace(microsecond=0)
+        colls = []
+        for coll_name in db.collection_names():
+            if _is_entity_collection(coll_name):
+                colls.append((coll_name, db.command('collstats', coll_name)))
+        kind = query.kind()
+        if kind == '__Stat_PropertyType__':
+            entities = self._property_type_stats(colls)
+        elif kind == '__Stat_Kind__':
+            entities = self._kind_stats(colls)
+        else:
+            entities = [self._total_stat(colls)]
+        self._entities = iter(entities)
+
+    def _entity(self, kind, name, **props):
+        entity = datastore.Entity(kind, name=name, _app=self._app_id,
+                                  namespace=self._namespace)
+        entity.update(props)
+        entity['timestamp'] = self._timestamp
+        return entity._ToPb()
+
+    def _usage(self, stats):
+        """Get common statistics properties from collStats."""
+        count = int(stats.get('count', 0))
+        entity_bytes = int(stats.get('size', 0))
+        index_bytes = int(stats.get('totalIndexSize', 0))
+        return {'count': count, 'bytes': entity_bytes + index_bytes,
+                'entity_bytes': entity_bytes,
+                'builtin_index_bytes': index_bytes,
+                'builtin_index_count': count * int(stats.get('nindexes', 0)),
+                'composite_index_bytes': 0, 'composite_index_count': 0}
+
+    def _kind_stats(self, colls):
+        entities = []
+        for coll_name, stats in colls:
+            kind = self._schema.get_kind(coll_name)
+            entities.append(self._entity('__Stat_Kind__', kind, kind_name=kind,
+                                         **self._usage(stats)))
+        return entities
+
+    def _total_stat(self, colls):
+        total = collections.defaultdict(int)
+        for coll_name, stats in colls:
+            for prop, value in self._usage(stats).iteritems():
+                total[prop] += value
+        return self._entity('__Stat_Total__', self.TOTAL_KEY_NAME, **total)
+
+    def _property_type_stats(self, colls):
+        types = collections.defaultdict(lambda: [0, 0])
+        counters = list(self._db[MongoDatastore.STATS_COLLECTION].find())
+        if counters:
+            for doc in counters:
+                for type_, stat in doc.iteritems():
+                    if type_ != '_id':
+                        types[type_][0] += stat.get('count', 0)
+                        types[type_][1] += stat.get('bytes', 0)
+        else:
+            # every entity of the kind is supposed to have all properties
+            # of the schema, which share size of the entities evenly
+            for coll_name, stats in colls:
+                props = self._schema.get_property_types(coll_name)
+                for type_ in props.itervalues():
+                    type_ = STAT_PROPERTY_TYPES.get(type_.split(":")[-1],
+                                                    'String')
+                    types[type_][0] += int(stats.get('count', 0))
+                    types[type_][1] += int(stats.get('size', 0)) / len(props)
+        entities = []
+        for type_, (count, size) in sorted(types.iteritems()):
+            if count <= 0:
+                continue
+            size = max(size, 0)
+            entities.append(self._entity('__Stat_PropertyType__', type_,
+                                         property_type=type_, count=count,
+                                         bytes=size, entity_bytes=size,
+                                         builtin_index_bytes=0,
+                                         builtin_index_count=0))
+        return entities
+
+    def __iter__(self): return self
+
+    def next(self):
+        return self._entities.next()
 
 
 
@@ -786,29 +2035,37 @@ class MongoSchemaManager(object):
         self._db = db
         self._schema_coll = self._db[self.SCHEMA_COLLECTION]
         self._local_schema = {}
+        # locks of schema entries
+        self._locks = _KeyedLocks()
 
     def update_if_changed(self, schema):
         """Updates schema for one entity group.
 
         Args:
           schema: dictionary containing schema for one entity group.
+
+        Returns:
+          True if the schema was changed.
         """
         coll_name = schema['_id']
-        if coll_name not in self._local_schema:
-            self._schema_coll.save(schema)
-            self._local_schema[coll_name] = schema
-        else:
-            # do not touch mongo if not needed
-            if self._local_schema[coll_name] != schema:
+        # do not touch mongo if not needed
+        if self._local_schema.get(coll_name) == schema:
+            return False
+        with self._locks(coll_name):
+            if self._local_schema.get(coll_name) != schema:
                 self._schema_coll.save(schema)
                 self._local_schema[coll_name] = schema
+                return True
+        return False
 
     def load(self):
         """Loads the schema from mongo db into datastore stub."""
-        self._local_schema = {}
+        local_schema = {}
         for group in self._schema_coll.find():
             coll = group['_id']
-            self._local_schema[coll] = group
+            local_schema[coll] = group
+        # replace the whole schema at once, readers never see it half-loaded
+        self._local_schema = local_schema
     reload = load
 
     def get_type(self, kind, prop):
@@ -833,6 +2090,43 @@ class MongoSchemaManager(object):
         except KeyError:
             raise KeyError("No such property %s.%s" % (kind, prop))
 
+    def get_unindexed(self, kind):
+        """Get properties of the kind which are not indexed.
+
+        Args:
+          kind: string, kind (collection name) of the entities.
+
+        Returns:
+          Set of property names in mongodb format.
+        """
+        group = self._local_schema.get(kind, {})
+        return set(group.get(UNINDEXED_ATTR, ()))
+
+    def get_kind(self, coll_name):
+        """Get name of the kind stored in the collection.
+
+        Args:
+          coll_name: name of the collection.
+
+        Returns:
+          String, name of the kind.
+        """
+        return self._local_schema.get(coll_name, {}).get('_kind', coll_name)
+
+    def get_property_types(self, kind):
+        """Get types of properties of the kind.
+
+        Args:
+          kind: string, kind (collection name) of the entities.
+
+        Returns:
+          Dict mapping property names in mongodb format to names of their
+          types, repeated properties as "list:<type>".
+        """
+        group = self._local_schema.get(kind, {})
+        return dict((k, v) for k, v in group.iteritems()
+                    if k not in ('_id', '_kind', SCATTER_ATTR, UNINDEXED_ATTR))
+
     def get_kinds(self):
         """Get all kinds which are stored in datastore.
 
@@ -843,6 +2137,270 @@ class MongoSchemaManager(object):
 
 
 
+class _LargeValueStore(object):
+    """
+    Storage of large Blob, Text and EmbeddedEntity values in GridFS.
+
+    Values bigger than the threshold are moved out of the document, which
+    keeps only reference {t: type, r: file id, z: compressed}. The value
+    is loaded when the document is decoded into entity, so that queries
+    do not transfer the large values of entities which are not returned.
+    Without the threshold values are only loaded, e.g. those stored by other
+    processes.
+    """
+    #: name of GridFS collections
+    COLLECTION = '_gridfs'
+    #: types of values which can be moved into GridFS
+    TYPES = ('blob', 'text', 'local')
+
+    def __init__(self, db, threshold=None, compress=False):
+        """Constructor.
+
+        Args:
+          db: pymongo.database.Database instance.
+          threshold: int, minimal size in bytes of values stored in GridFS
+              or None if no value is stored in GridFS.
+          compress: bool, default False. If True, values are compressed
+              by zlib.
+        """
+        if isinstance(db, datastore_mongodb_memory.Database):
+            self._fs = datastore_mongodb_memory.GridFS(db, self.COLLECTION)
+        else:
+            self._fs = gridfs.GridFS(db, self.COLLECTION)
+        self._files = db[self.COLLECTION + '.files']
+        if threshold is not None:
+            self._files.ensure_index('entity')
+        self._threshold = threshold
+        self._compress = compress
+
+    def _offload_value(self, val, key):
+        """Move value into GridFS if it is large enough.
+
+        Args:
+          val: encoded value of the property.
+          key: mongodb key of the entity.
+
+        Returns:
+          Either the value itself or reference to it.
+        """
+        if not isinstance(val, dict) or val["t"] not in self.TYPES:
+            return val
+        data = val["v"]
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        else:
+            data = str(data)
+        if len(data) < self._threshold:
+            return val
+        if self._compress:
+            data = zlib.compress(data)
+        file_id = self._fs.put(data, entity=key)
+        return {"t": val["t"], "r": file_id, "z": self._compress}
+
+    def offload(self, mongo_doc):
+        """Move large values of the document into GridFS.
+
+        Args:
+          mongo_doc: dict, document to be stored. Changed in place.
+        """
+        if self._threshold is None:
+            return
+        key = mongo_doc['_id']
+        for attr, val in mongo_doc.items():
+            if isinstance(val, list):
+                mongo_doc[attr] = [self._offload_value(x, key) for x in val]
+            else:
+                mongo_doc[attr] = self._offload_value(val, key)
+
+    def load(self, ref):
+        """Load value from GridFS.
+
+        Args:
+          ref: dict, reference to the value.
+
+        Returns:
+          Value in format accepted by _Document.DECODER.
+        """
+        data = self._fs.get(ref["r"]).read()
+        if ref.get("z"):
+            data = zlib.decompress(data)
+        if ref["t"] == "text":
+            return data.decode('utf-8')
+        return data
+
+    @staticmethod
+    def _references(mongo_doc):
+        """Get ids of files referenced by the document.
+
+        Args:
+          mongo_doc: dict, document of the entity or None.
+
+        Returns:
+          List of ids of files.
+        """
+        refs = []
+        for val in (mongo_doc or {}).itervalues():
+            for v in (val if isinstance(val, list) else [val]):
+                if isinstance(v, dict) and "r" in v:
+                    refs.append(v["r"])
+        return refs
+
+    def cleanup(self, key, mongo_doc=None, old=None):
+        """Delete files of the entity which are no longer referenced.
+
+        Files of the replaced document are deleted without any query. If it
+        was not read, files of the entity are looked up only if this store
+        moves values into GridFS, otherwise they are not indexed by entity.
+
+        Args:
+          key: mongodb key of the entity.
+          mongo_doc: dict, current document of the entity or None if
+              the entity was deleted.
+          old: dict, replaced or deleted document of the entity ({} if
+              there was none) or None if it was not read.
+        """
+        keep = self._references(mongo_doc)
+        if old is not None:
+            for file_id in self._references(old):
+                if file_id not in keep:
+                    self._fs.delete(file_id)
+            return
+        if self._threshold is None:
+            return
+        spec = {'entity': key}
+        if keep:
+            spec['_id'] = {'$nin': keep}
+        for f in self._files.find(spec, {'_id': 1}):
+            self._fs.delete(f['_id'])
+
+    def discard(self, mongo_doc):
+        """Delete files of the document which was not stored.
+
+        Args:
+          mongo_doc: dict, document whose values were moved into GridFS
+              by offload.
+        """
+        for file_id in self._references(mongo_doc):
+            self._fs.delete(file_id)
+
+
+
+class _ChangeWatcher(threading.Thread):
+    """
+    Background thread evicting data changed by other processes from caches.
+
+    Uses mongodb change stream of the database if available (pymongo >= 3.8,
+    mongod >= 4.0 running as a replica set). Otherwise tails capped
+    collection into which every process writes keys of changed entities.
+    """
+    #: name of capped collection with invalidations
+    COLLECTION = '_invalidations'
+    #: size of the capped collection in bytes
+    COLLECTION_SIZE = 1024 * 1024
+    #: how long (ms) the server waits for new changes before returning
+    AWAIT_TIME_MS = 500
+
+    def __init__(self, datastore, use_change_stream):
+        """Constructor.
+
+        Args:
+          datastore: MongoDatastore whose caches are kept up to date.
+          use_change_stream: bool, True if change streams are supported.
+        """
+        super(_ChangeWatcher, self).__init__(name='mongodb-change-watcher')
+        self.daemon = True
+        self._datastore = weakref.proxy(datastore)
+        self._db = datastore._db
+        self._use_change_stream = use_change_stream
+        self._stopped = threading.Event()
+        if not use_change_stream:
+            self._prepare_collection()
+
+    publishes = property(lambda self: not self._use_change_stream)
+
+    def _prepare_collection(self):
+        try:
+            self._db.create_collection(self.COLLECTION, capped=True,
+                                       size=self.COLLECTION_SIZE)
+            # tailable cursors on empty collections are closed immediately
+            self._db[self.COLLECTION].insert({'c': None})
+        except CollectionInvalid:
+            pass
+
+    def publish(self, coll_name, key=None):
+        """Announce change to other processes (only without change streams).
+
+        Args:
+          coll_name: name of the changed collection.
+          key: mongodb key of the changed entity or None.
+        """
+        self._db[self.COLLECTION].insert({'c': coll_name, 'k': key})
+
+    def stop(self):
+        """Stop the thread and wait until it finishes."""
+        self._stopped.set()
+        self.join(2 * self.AWAIT_TIME_MS / 1000.0)
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                if self._use_change_stream:
+                    self._watch_change_stream()
+                else:
+                    self._tail_collection()
+            except ReferenceError:
+                # the datastore does not exist anymore
+                return
+            except Exception:
+                # changes may have been missed, start over with empty caches
+                if self._stopped.is_set():
+                    return
+                self._datastore.evict(None, None)
+                self._stopped.wait(1)
+
+    def _watch_change_stream(self):
+        with self._db.watch(max_await_time_ms=self.AWAIT_TIME_MS) as stream:
+            while not self._stopped.is_set():
+                change = stream.try_next()
+                if change is None:
+                    continue
+                key = change.get('documentKey', {}).get('_id')
+                if 'ns' in change:
+                    self._datastore.evict(change['ns']['coll'], key)
+                else:
+                    # dropped database or invalidated stream
+                    self._datastore.evict(None, None)
+
+    def _tail_collection(self):
+        coll = self._db[self.COLLECTION]
+        # ObjectIds of documents inserted by different processes are not
+        # ordered, the position is the last seen document in $natural order
+        last = coll.find().sort('$natural', DESCENDING).limit(1)[0]['_id']
+        while not self._stopped.is_set():
+            if CursorType is not None:
+                cursor = coll.find(cursor_type=CursorType.TAILABLE_AWAIT,
+                                   max_await_time_ms=self.AWAIT_TIME_MS)
+            else:
+                cursor = coll.find(tailable=True, await_data=True)
+            found = False
+            while cursor.alive and not self._stopped.is_set():
+                for doc in cursor:
+                    if not found:
+                        # skip documents up to the last seen one
+                        found = doc['_id'] == last
+                        continue
+                    last = doc['_id']
+                    if doc['c'] is not None:
+                        self._datastore.evict(doc['c'], doc.get('k'))
+                if not found:
+                    # the last seen document was overwritten, changes made
+                    # since then may have been missed
+                    found = True
+                    self._datastore.evict(None, None)
+            self._stopped.wait(0.1)
+
+
+
 class MongoDatastore(object):
     """
     Base MongoDB Datastore.
@@ -852,55 +2410,365 @@ class MongoDatastore(object):
     by cursors.
     """
 
-    def __init__(self, host, port, app_id, require_indexes=False):
+    #: name of collection where versions of entity groups are stored
+    ENTITY_GROUP_COLLECTION = '_entity_groups'
+    #: maximal number of results of query stored in the query cache
+    QUERY_CACHE_MAX_RESULTS = 1000
+    #: maximal number of cached query plans
+    QUERY_PLAN_CACHE_SIZE = 256
+    #: name of collection where descriptions of snapshots are stored
+    SNAPSHOT_COLLECTION = '_snapshots'
+    #: name of collection with counters of property types of kinds
+    STATS_COLLECTION = '_stats'
+    #: name of collection with the counter of allocated ids
+    SEQUENCE_COLLECTION = '_sequences'
+
+    def __init__(self, host, port, app_id, require_indexes=False,
+                 atomic_commit=False, gridfs_threshold=None,
+                 gridfs_compress=False, entity_cache_size=0,
+                 entity_cache_bytes=None, watch_changes=False,
+                 query_cache_size=0, in_memory=False, stat_counters=False,
+                 replica_set=None, query_read_preference=None):
         """Constructor.
 
         Creates mongodb connection (in case of pymongo 2.4 MongoClient)
         and initializes a few helpers.
 
         Args:
-          host: string, mongodb host.
+          host: string, mongodb host or mongodb URI, e.g.
+              "mongodb://a:27017,b:27017/?replicaSet=rs0".
           port: int, port on which the mongod server runs.
           app_id: string representing the application ID.
           require_indexes: bool, default False. If True, composite indexes must
               exist in index.yaml for queries that need them.
+          atomic_commit: bool, default False. If True, mutations of committed
+              transactions are applied in one multi-document mongodb
+              transaction. Needs pymongo >= 3.7 and mongod >= 4.0 running
+              as a replica set, otherwise mutations are applied one by one.
+          gridfs_threshold: int or None, default None. Blob, Text and
+              EmbeddedEntity values of at least this size in bytes are stored
+              in GridFS. If None, all values are stored in documents.
+          gridfs_compress: bool, default False. If True, values stored in
+              GridFS are compressed by zlib.
+          entity_cache_size: int, default 0. Maximal number of entities kept
+              in the in-process cache serving get by key. If 0, the cache
+              is disabled.
+          entity_cache_bytes: int or None, default None. Maximal total size
+              of entities in the cache.
+          watch_changes: bool, default False. If True, a background thread
+              evicts entities and schema changed by other processes from
+              caches. Uses change streams on replica sets, otherwise all
+              processes have to enable it, because they publish their
+              changes into a capped collection.
+          query_cache_size: int, default 0. Maximal number of queries whose
+              results are kept in the in-process cache until their kind
+              is written. If 0, results of queries are not cached.
+          in_memory: bool, default False. If True, data are stored by
+              the in-process engine (datastore_mongodb_memory) instead
+              of mongod, host and port are ignored. Data are shared by all
+              datastores of the process and lost when it exits.
+          stat_counters: bool, default False. If True, put and delete keep
+              counters of values of every property type in the statistics
+              (__Stat_PropertyType__), which costs an acknowledged read
+              of the replaced or deleted entity. Entities loaded by
+              bulk_load or restored from a snapshot are counted again
+              (see rebuild_stat_counters). If False, property type
+              statistics are estimated from the schema.
+          replica_set: string or None, default None. Name of the replica set
+              to connect to, it can be given in the URI as well, except for
+              pymongo < 3.0, which needs it for reads from secondaries.
+          query_read_preference: read preference (pymongo.ReadPreference
+              or name of its mode, e.g. 'secondaryPreferred') or None,
+              default None. Non-ancestor queries, which are eventually
+              consistent in the High Replication datastore, read from
+              members given by it. Gets, ancestor queries and transactions
+              always read from the primary. If None, all reads go
+              to the primary. Needs pymongo >= 2.4.
+        """
+        self._app_id = app_id
+        self._stat_counters = stat_counters
+        self._require_indexes = require_indexes
+        # get connection
+        if in_memory:
+            self._conn = datastore_mongodb_memory.MemoryClient()
+        elif PYM_2_4:
+            options = {}
+            if replica_set:
+                options['replicaSet'] = replica_set
+            # maximum performance (no write concern, no fsync, no journaling),
+            # pymongo >= 3.0 accepts it only by the constructor of the client
+            if replica_set and CursorType is None:
+                seeds = host
+                if '://' not in host and ':' not in host:
+                    seeds = "%s:%d" % (host, port)
+                self._conn = MongoReplicaSetClient(seeds, **options)
+            elif PYM_3_0:
+                self._conn = MongoClient(host=host, port=port, w=0, **options)
+            else:
+                self._conn = MongoClient(host=host, port=port, **options)
+            if not PYM_3_0:
+                self._conn.write_concern['w'] = 0
+        else:
+            # plain old connection
+            self._conn = Connection(host=host, port=port)
+        self._atomic_commit = atomic_commit and self._supports_transactions()
+
+        # database for this application
+        self._db = self._conn[app_id]
+        # the same database read by eventually consistent queries
+        self._query_db = self._db
+        if query_read_preference is not None and PYM_2_4 and not in_memory:
+            pref = _read_preference(query_read_preference)
+            if hasattr(self._conn, 'get_database'):
+                self._query_db = self._conn.get_database(app_id,
+                                                         read_preference=pref)
+            else:
+                # pymongo < 2.9 creates new database object for every access
+                self._query_db = self._conn[app_id]
+                self._query_db.read_preference = pref
+
+        # schema manager
+        self._schema = MongoSchemaManager(self._db)
+        self._schema.load()
+
+        # storage of large values, values stored by other processes are
+        # loaded even if this one does not store them
+        self._large_values = _LargeValueStore(self._db, gridfs_threshold,
+                                              gridfs_compress)
+
+        # cache of entities by mongodb key
+        self._entity_cache = None
+        if entity_cache_size:
+            self._entity_cache = _LRUCache(entity_cache_size, entity_cache_bytes,
+                                           lambda e: e.ByteSize())
+
+        # plans of queries by their shape
+        self._plans = _LRUCache(self.QUERY_PLAN_CACHE_SIZE, sizeof=lambda plan: 0)
+
+        # cache of query results, valid until the kind is written
+        self._query_cache = None
+        self._kind_versions = collections.defaultdict(int)
+        self._write_counter = itertools.count(1)
+        if query_cache_size:
+            self._query_cache = _LRUCache(query_cache_size,
+                    sizeof=lambda v: sum(e.ByteSize() for e in v[1]))
+
+        # watcher of changes made by other processes, there are none
+        # when the data live in this process
+        self._watcher = None
+        if watch_changes and not in_memory:
+            self._watcher = _ChangeWatcher(self, self._supports_change_streams())
+            self._watcher.start()
+
+    schema = property(lambda self: self._schema)
+    atomic_commit = property(lambda self: self._atomic_commit)
+
+    def _supports_transactions(self):
+        """Check if multi-document transactions can be used.
+
+        Returns:
+          True if both pymongo and the server support transactions.
+        """
+        if not PYM_3_7:
+            return False
+        info = self._conn.admin.command('ismaster')
+        # transactions are available on replica sets since mongodb 4.0
+        return 'setName' in info and info.get('maxWireVersion', 0) >= 7
+
+    def _supports_change_streams(self):
+        """Check if change stream of the database can be watched.
+
+        Returns:
+          True if both pymongo and the server support change streams.
+        """
+        if not PYM_3_8:
+            return False
+        info = self._conn.admin.command('ismaster')
+        # database change streams are available on replica sets since 4.0
+        return 'setName' in info and info.get('maxWireVersion', 0) >= 7
+
+    def close(self):
+        """Stop background threads."""
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher = None
+
+    def evict(self, coll_name, key):
+        """Evict data changed by another process from caches.
+
+        Args:
+          coll_name: name of the changed collection, None if unknown.
+          key: mongodb key of the changed entity, None if unknown.
+        """
+        if coll_name == MongoSchemaManager.SCHEMA_COLLECTION:
+            self.schema.reload()
+            return
+        elif coll_name is not None and not _is_entity_collection(coll_name):
+            return
+        if coll_name is None:
+            if self._query_cache:
+                self._query_cache.clear()
+        else:
+            self._kind_versions[coll_name] = next(self._write_counter)
+        if not self._entity_cache:
+            return
+        elif coll_name is None or key is None:
+            self._entity_cache.clear()
+        else:
+            self._entity_cache.invalidate(key)
+
+    @property
+    def write_concern(self):
+        """Dictionary representing MongoClient's write concern.
+
+        With pymongo >= 3.0 it is a copy, the write concern of the client
+        can not be changed.
+        """
+        if not PYM_2_4:
+            raise RuntimeError("write_concern is for pymongo >= 2.4 only.")
+        if PYM_3_0 and not isinstance(self._conn.write_concern, dict):
+            return self._conn.write_concern.document
+        return self._conn.write_concern
+
+    def _ensure_noncomposite_indexes(self, doc):
+        """Simulate EntitiesByPropertyASC and EntitiesByPropertyDESC indexes"""
+        coll = self._db[doc.get_collection()]
+        for spec in doc.iter_mongo_indexes():
+            coll.ensure_index(spec, cache_for=3600, **_index_options(spec))
+
+    def _prepare_document(self, entity):
+        """Translate entity into document and prepare schema and indexes for it.
+
+        Args:
+          entity: entity (entity_pb.EntityProto) to be stored.
+
+        Returns:
+          Instance of _Document.
+        """
+        doc = _Document.from_pb(entity, self._app_id)
+        # update schema
+        if self.schema.update_if_changed(doc.get_schema()):
+            self._publish(MongoSchemaManager.SCHEMA_COLLECTION)
+        # be sure to have all indexes (EntitiesByPropertyASC & DESC)
+        self._ensure_noncomposite_indexes(doc)
+        self._large_values.offload(doc.to_mongo())
+        return doc
+
+    def _publish(self, coll_name, key=None):
+        """Announce change to other processes, if they can not watch it.
+
+        Args:
+          coll_name: name of the changed collection.
+          key: mongodb key of the changed entity or None.
+        """
+        if self._watcher is not None and self._watcher.publishes:
+            self._watcher.publish(coll_name, key)
+
+    def _invalidate(self, key):
+        """Drop the entity from the entity cache.
+
+        Args:
+          key: mongodb key of the written entity.
+        """
+        coll_name = _Key(key, self._app_id).collection()
+        # results of cached queries on the kind are no longer valid
+        self._kind_versions[coll_name] = next(self._write_counter)
+        if self._entity_cache:
+            self._entity_cache.invalidate(key)
+        self._publish(coll_name, key)
+
+    def query_plan_stats(self):
+        """Get statistics of the cache of query plans.
+
+        Returns:
+          Dict of statistics (see _LRUCache.stats).
+        """
+        return self._plans.stats()
+
+    def query_cache_stats(self):
+        """Get statistics of the query cache.
+
+        Returns:
+          Dict of statistics (see _LRUCache.stats) or None if the cache
+          is disabled.
         """
-        self._app_id = app_id
-        self._require_indexes = require_indexes
-        # get connection
-        if PYM_2_4:
-            self._conn = MongoClient(host=host, port=port)
-            # maximum performance (no write concern, no fsync, no journaling)
-            self._conn.write_concern['w'] = 0
-        else:
-            # plain old connection
-            self._conn = Connection(host=host, port=port)
+        if self._query_cache:
+            return self._query_cache.stats()
+        return None
 
-        # database for this application
-        self._db = self._conn[app_id]
+    def entity_cache_stats(self):
+        """Get statistics of the entity cache.
 
-        # schema manager
-        self._schema = MongoSchemaManager(self._db)
-        self._schema.load()
+        Returns:
+          Dict of statistics (see _LRUCache.stats) or None if the cache
+          is disabled.
+        """
+        if self._entity_cache:
+            return self._entity_cache.stats()
+        return None
 
-        # cursors
-        self._cursors = {}
+    def _update_stat_counters(self, coll_name, old, new):
+        """Update counters of property types after the entity was written.
 
-    schema = property(lambda self: self._schema)
+        Args:
+          coll_name: name of the collection of the entity.
+          old: dict, previous document of the entity or None.
+          new: dict, current document of the entity or None if deleted.
+        """
+        inc = collections.defaultdict(int)
+        for mongo_doc, sign in ((new, 1), (old, -1)):
+            if not mongo_doc:
+                continue
+            for type_, (count, size) in _property_stats(mongo_doc).iteritems():
+                inc[type_ + '.count'] += sign * count
+                inc[type_ + '.bytes'] += sign * size
+        inc = dict((k, v) for k, v in inc.iteritems() if v)
+        if inc:
+            # lost or late updates would make the counters drift
+            self._db[self.STATS_COLLECTION].update({'_id': coll_name},
+                                                   {'$inc': inc}, upsert=True,
+                                                   w=1)
+
+    def _has_stat_counters(self):
+        """Check if counters of property types are maintained or used."""
+        return (self._stat_counters or
+                self._db[self.STATS_COLLECTION].find_one() is not None)
+
+    def rebuild_stat_counters(self, coll_names=None):
+        """Count values of property types of stored entities again.
+
+        The counters do not include entities written by processes which do
+        not maintain them, e.g. when the database is restored or loaded.
 
-    @property
-    def write_concern(self):
-        """Dictionary representing MongoClient's write concern."""
-        if not PYM_2_4:
-            raise RuntimeError("write_concern is for pymongo >= 2.4 only.")
-        return self._conn.write_concern
+        Args:
+          coll_names: names of collections to be counted, default all.
+        """
+        stats = self._db[self.STATS_COLLECTION]
+        if coll_names is None:
+            stats.drop()
+            coll_names = self.entity_collections()
+        for coll_name in coll_names:
+            counters = {'_id': coll_name}
+            for mongo_doc in self._db[coll_name].find({}, {SORT_KEYS_ATTR: 0}):
+                for type_, (count, size) in _property_stats(mongo_doc).iteritems():
+                    stat = counters.setdefault(type_, {'count': 0, 'bytes': 0})
+                    stat['count'] += count
+                    stat['bytes'] += size
+            if len(counters) > 1:
+                stats.save(counters, w=1)
+            else:
+                stats.remove({'_id': coll_name}, w=1)
 
-    def _ensure_noncomposite_indexes(self, doc):
-        """Simulate EntitiesByPropertyASC and EntitiesByPropertyDESC indexes"""
-        coll = self._db[doc.get_collection()]
-        coll.ensure_index('_id.dskey', cache_for=7200)
-        for spec in doc.iter_mongo_indexes():
-            coll.ensure_index(spec, cache_for=3600)
+    def _cleanup_large_values(self, key, mongo_doc=None, old=None):
+        """Delete values of the entity no longer referenced from GridFS.
+
+        Args:
+          key: mongodb key of the stored or deleted entity.
+          mongo_doc: dict, stored document or None if the entity was deleted.
+          old: dict, replaced or deleted document ({} if there was none)
+              or None if it was not read.
+        """
+        self._large_values.cleanup(key, mongo_doc, old)
 
     def put(self, entities):
         """Puts all entities into datastore.
@@ -912,20 +2780,206 @@ class MongoDatastore(object):
           list of datastore_types.Key instances of stored entities in
           the right order.
         """
-        batch_insert = {}
         keys = []
         for e in entities:
-            doc = _Document.from_pb(e, self._app_id)
-            # update schema
-            self.schema.update_if_changed(doc.get_schema())
+            doc = self._prepare_document(e)
             # insert / overwrite
             coll = self._db[doc.get_collection()]
-            coll.save(doc.to_mongo())
-            # be sure to have all indexes (EntitiesByPropertyASC & DESC)
-            self._ensure_noncomposite_indexes(doc)
+            old = None
+            if self._stat_counters:
+                # the replaced document is needed to update the counters
+                old = coll.find_and_modify({'_id': doc.key.to_mongo_key()},
+                                           doc.to_mongo(), upsert=True) or {}
+                self._update_stat_counters(doc.get_collection(), old,
+                                           doc.to_mongo())
+            else:
+                coll.save(doc.to_mongo())
+            self._invalidate(doc.key.to_mongo_key())
+            self._cleanup_large_values(doc.key.to_mongo_key(), doc.to_mongo(),
+                                       old)
             keys.append(doc.key.to_datastore_key())
         return keys
 
+    def bulk_load(self, entities, batch_size=1000):
+        """Store many entities at once, e.g. when importing existing data.
+
+        Unlike put, documents are written by bulk writes and schema and
+        indexes are updated only once at the end.
+
+        Args:
+          entities: iterable of entities (entity_pb.EntityProto) to be stored.
+          batch_size: int, number of documents written by one bulk write.
+
+        Returns:
+          Dict mapping collection names to numbers of stored entities.
+        """
+        batches = collections.defaultdict(list)
+        schemas = {}
+        indexes = collections.defaultdict(set)
+        counts = collections.defaultdict(int)
+
+        def flush(coll_name):
+            docs = batches.pop(coll_name)
+            coll = self._db[coll_name]
+            # the in-memory engine stores documents one by one
+            if PYM_3_7 and hasattr(coll, 'bulk_write'):
+                coll.bulk_write([ReplaceOne({'_id': d['_id']}, d, upsert=True)
+                                 for d in docs], ordered=False)
+            else:
+                for d in docs:
+                    coll.save(d)
+            for d in docs:
+                self._cleanup_large_values(d['_id'], d)
+            # record the kind in the groups, which may have been cached
+            groups = self._db[self.ENTITY_GROUP_COLLECTION]
+            update = self._group_update([coll_name])
+            roots = set(d[ENTITY_GROUP_ATTR] for d in docs)
+            if PYM_3_7 and hasattr(groups, 'bulk_write'):
+                groups.bulk_write([UpdateOne({'_id': root}, update, upsert=True)
+                                   for root in roots], ordered=False)
+            else:
+                for root in roots:
+                    groups.update({'_id': root}, update, upsert=True)
+
+        for e in entities:
+            doc = _Document.from_pb(e, self._app_id)
+            coll_name = doc.get_collection()
+            # the last entity of the kind determines its schema, as in put
+            schemas[coll_name] = doc.get_schema()
+            for spec in doc.iter_mongo_indexes():
+                indexes[coll_name].add(spec if isinstance(spec, basestring)
+                                       else tuple(spec))
+            mongo_doc = doc.to_mongo()
+            self._large_values.offload(mongo_doc)
+            batches[coll_name].append(mongo_doc)
+            counts[coll_name] += 1
+            if len(batches[coll_name]) >= batch_size:
+                flush(coll_name)
+        for coll_name in batches.keys():
+            flush(coll_name)
+
+        for coll_name, schema in schemas.iteritems():
+            if self.schema.update_if_changed(schema):
+                self._publish(MongoSchemaManager.SCHEMA_COLLECTION)
+        for coll_name, specs in indexes.iteritems():
+            coll = self._db[coll_name]
+            for spec in specs:
+                coll.ensure_index(spec if isinstance(spec, basestring)
+                                  else list(spec), cache_for=3600,
+                                  **_index_options(spec))
+        if self._has_stat_counters():
+            self.rebuild_stat_counters(counts.keys())
+        # any cached entity or query result may be stale now
+        for coll_name in counts:
+            self._kind_versions[coll_name] = next(self._write_counter)
+            self._publish(coll_name)
+        if self._entity_cache:
+            self._entity_cache.clear()
+        return dict(counts)
+
+    def commit(self, entities, keys, versions=()):
+        """Apply mutations of a committed transaction and increase versions
+        of its entity groups.
+
+        If atomic commit is enabled, all mutations are applied in one mongodb
+        transaction with one bulk write per collection, together with
+        compare-and-set of the versions. Otherwise entities are stored and
+        deleted one by one and the versions are increased unconditionally.
+
+        Args:
+          entities: list of entities (entity_pb.EntityProto) to be stored.
+          keys: list of keys (entity_pb.Reference) to be deleted.
+          versions: list of tuples (entity_pb.Reference of the root entity
+              of the group, expected version of the group).
+
+        Returns:
+          List of new versions of the entity groups or None if some version
+          does not match, then no mutation is applied.
+        """
+        # collections of the stored entities by roots of their groups
+        kinds = collections.defaultdict(set)
+        for e in entities:
+            k = _Key(e.key(), self._app_id)
+            kinds[k.root()].add(k.collection())
+        if not self._atomic_commit:
+            self.put(entities)
+            for key in keys:
+                self.delete(key)
+            return [self.bump_entity_group_version(
+                        eg, kinds=kinds[_Key(eg, self._app_id).root()])
+                    for eg, v in versions]
+        # schema and indexes can not be changed inside of the transaction
+        writes = collections.defaultdict(list)
+        written = collections.defaultdict(list)
+        stored = []
+        for e in entities:
+            doc = self._prepare_document(e)
+            mongo_doc = doc.to_mongo()
+            stored.append(mongo_doc)
+            writes[doc.get_collection()].append(
+                    ReplaceOne({'_id': mongo_doc['_id']}, mongo_doc, upsert=True))
+            written[doc.get_collection()].append(mongo_doc['_id'])
+        deleted = []
+        for key in keys:
+            k = _Key(key, self._app_id)
+            deleted.append(k.to_mongo_key())
+            writes[k.collection()].append(DeleteOne({'_id': k.to_mongo_key()}))
+            written[k.collection()].append(k.to_mongo_key())
+        if not writes and not versions:
+            return []
+        groups = self._db[self.ENTITY_GROUP_COLLECTION]
+        old = {}
+        committed = False
+        try:
+            with self._conn.start_session() as session:
+                # transactions do not allow unacknowledged writes
+                with session.start_transaction(write_concern=WriteConcern(w=1)):
+                    if self._stat_counters:
+                        # the replaced documents are needed to update
+                        # the counters
+                        for coll_name, ids in written.iteritems():
+                            for d in self._db[coll_name].find(
+                                    {'_id': {'$in': ids}}, session=session):
+                                old[d['_id']] = d
+                    for coll_name, requests in writes.iteritems():
+                        self._db[coll_name].bulk_write(requests,
+                                                       session=session)
+                    for eg, version in versions:
+                        root = _Key(eg, self._app_id).root()
+                        result = groups.update_one(
+                                {'_id': root, 'v': version},
+                                self._group_update(kinds[root]),
+                                session=session)
+                        if not result.matched_count:
+                            # aborts the transaction
+                            raise _VersionMismatch()
+            committed = True
+        except _VersionMismatch:
+            return None
+        finally:
+            if not committed:
+                # values moved into GridFS are not referenced by any entity
+                for mongo_doc in stored:
+                    self._large_values.discard(mongo_doc)
+        for mongo_doc in stored:
+            replaced = None
+            if self._stat_counters:
+                replaced = old.get(mongo_doc['_id'], {})
+                self._update_stat_counters(
+                        _Key(mongo_doc['_id'], self._app_id).collection(),
+                        replaced, mongo_doc)
+            self._invalidate(mongo_doc['_id'])
+            self._cleanup_large_values(mongo_doc['_id'], mongo_doc, replaced)
+        for key in deleted:
+            replaced = None
+            if self._stat_counters:
+                replaced = old.get(key, {})
+                self._update_stat_counters(
+                        _Key(key, self._app_id).collection(), replaced, None)
+            self._invalidate(key)
+            self._cleanup_large_values(key, old=replaced)
+        return [version + 1 for eg, version in versions]
+
     def get(self, key):
         """Get entity by given key.
 
@@ -933,14 +2987,25 @@ class MongoDatastore(object):
           keys: key (entity_pb.Reference) to be fetched.
 
         Returns:
-           fetched entity (entity_pb.EntityProto).
+           fetched entity (entity_pb.EntityProto) or None if it does not exist.
+           The entity may be shared with the entity cache, it must not be
+           modified.
         """
         # translate datastore key (references) to mongodb key
         k = _Key(key, self._app_id)
-        doc = self._db[k.collection()].find({'_id.dskey': {'$all': k._mongo_key}})
+        cache = self._entity_cache
+        if cache:
+            entity = cache.get(k.to_mongo_key())
+            if entity is not None:
+                return entity
+            epoch = cache.epoch()
+        doc = self._db[k.collection()].find_one({'_id': k.to_mongo_key()})
         if not doc:
             return None
-        return _Document.from_mongo(d, self._app_id).to_pb()
+        entity = _Document.from_mongo(doc, self._app_id, self._large_values).to_pb()
+        if cache:
+            cache.put(k.to_mongo_key(), entity, epoch)
+        return entity
 
     def delete(self, key):
         """Delete entity by given key.
@@ -950,11 +3015,27 @@ class MongoDatastore(object):
         """
         k = _Key(key, self._app_id)
         coll = self._db[k.collection()]
-        coll.remove({'_id.dskey': {'$all': k._mongo_key}})
+        old = None
+        if self._stat_counters:
+            old = coll.find_and_modify({'_id': k.to_mongo_key()},
+                                       remove=True) or {}
+            self._update_stat_counters(k.collection(), old, None)
+        else:
+            coll.remove({'_id': k.to_mongo_key()})
+        self._invalidate(k.to_mongo_key())
+        self._cleanup_large_values(k.to_mongo_key(), old=old)
 
     def clear(self):
-        """Clear the whole mongo datastore."""
+        """Clear the whole mongo datastore.
+
+        Counters of property types are dropped with the database, their
+        updates are acknowledged, so that none of them arrives later.
+        """
         self._conn.drop_database(self._app_id)
+        if self._entity_cache:
+            self._entity_cache.clear()
+        if self._query_cache:
+            self._query_cache.clear()
 
     def query(self, query):
         """Perform a query on specified kind or pseudokind.
@@ -966,15 +3047,229 @@ class MongoDatastore(object):
           string, cursor ID for given query.
         """
         coll_name = query.kind().lower()
+        # only ancestor queries are strongly consistent
+        db = self._db if query.has_ancestor() else self._query_db
         if coll_name in ('__kind__', '__namespace__'):
             cursor = _PseudoKindCursor(query, self._db, self.schema)
+        elif query.kind() in _StatCursor.KINDS:
+            cursor = _StatCursor(query, self._db, self.schema)
         elif coll_name == '':
-            cursor = _StatCursor(query, self._db)
+            cursor = _KindlessCursor(query, db, self._large_values)
+        elif (self._query_cache and db is self._db and
+              not _IteratorCursor.is_count(query)):
+            # results read from secondaries may be older than the last
+            # write, so they are never cached, nor are counts, which are
+            # reported directly
+            cursor = self._cached_query(query)
         else:
-            cursor = _IteratorCursor(query, self._db)
+            cursor = _IteratorCursor(query, db, self.schema,
+                                     self._large_values, self._plans)
 
         return cursor
 
+    def _query_cache_key(self, query):
+        """Get normalized query, which is used as key in the query cache.
+
+        Args:
+          query: datastore_pb.Query.
+
+        Returns:
+          Hashable tuple.
+        """
+        return (query.kind(),
+                tuple(sorted(f.Encode() for f in query.filter_list())),
+                tuple(o.Encode() for o in query.order_list()),
+                tuple(query.property_name_list()),
+                tuple(query.group_by_property_name_list()),
+                query.ancestor().Encode() if query.has_ancestor() else None,
+                query.compiled_cursor().Encode()
+                    if query.has_compiled_cursor() else None,
+                query.end_compiled_cursor().Encode()
+                    if query.has_end_compiled_cursor() else None,
+                query.limit() if query.has_limit() else None,
+                query.offset(), query.keys_only())
+
+    def _cached_query(self, query):
+        """Perform query using the query cache.
+
+        Args:
+          query: datastore_pb.Query on entity kind.
+
+        Returns:
+          Iterable cursor returning entities.
+        """
+        key = self._query_cache_key(query)
+        version = self._kind_versions[query.kind().lower()]
+        cached = self._query_cache.get(key)
+        if cached is not None and cached[0] == version:
+            return (_copy_entity(e) for e in cached[1])
+        cursor = _IteratorCursor(query, self._db, self.schema,
+                                 self._large_values, self._plans)
+        return _CachingCursor(cursor, self._query_cache, key, version,
+                              self.QUERY_CACHE_MAX_RESULTS)
+
+    def entity_collections(self):
+        """Get names of all collections containing entities.
+
+        Returns:
+          List of collection names.
+        """
+        return [c for c in self._db.collection_names()
+                if _is_entity_collection(c)]
+
+    def superfluous_indexes(self):
+        """Find indexes of properties which are not indexed by datastore
+        and indexes of property values, which are not queried.
+
+        Such indexes were created by older versions of the stub or before
+        the property was declared unindexed. Whether the property is indexed
+        is decided by the schema, i.e. by the last stored entity of the kind.
+
+        Returns:
+          List of tuples (collection name, index name).
+        """
+        superfluous = []
+        for coll_name in self.entity_collections():
+            unindexed = self.schema.get_unindexed(coll_name)
+            info = self._db[coll_name].index_information()
+            for name, index in info.iteritems():
+                for field, direction in index['key']:
+                    if field in ('_id', ENTITY_GROUP_ATTR):
+                        continue
+                    if not field.startswith(SORT_KEYS_ATTR + "."):
+                        superfluous.append((coll_name, name))
+                        break
+                    field = field[len(SORT_KEYS_ATTR) + 1:]
+                    if field.split(".")[0] in unindexed:
+                        superfluous.append((coll_name, name))
+                        break
+        return superfluous
+
+    def get_entity_group(self, entity_group):
+        """Get all entities of the entity group regardless of their kind.
+
+        Args:
+          entity_group: entity_pb.Reference of the root entity of the group.
+
+        Returns:
+          List of entities (entity_pb.EntityProto) of the group.
+        """
+        root = _Key(entity_group, self._app_id).root()
+        group = self._db[self.ENTITY_GROUP_COLLECTION].find_one({'_id': root})
+        if group and group.get('k'):
+            coll_names = group['k']
+        else:
+            # groups written before their kinds were recorded are searched
+            # for in all collections
+            coll_names = self.entity_collections()
+        entities = []
+        for coll_name in coll_names:
+            for doc in self._db[coll_name].find({ENTITY_GROUP_ATTR: root}):
+                entities.append(_Document.from_mongo(doc, self._app_id,
+                                                     self._large_values).to_pb())
+        return entities
+
+    def get_entity_group_version(self, entity_group):
+        """Get version of the entity group.
+
+        Args:
+          entity_group: entity_pb.Reference of the root entity of the group.
+
+        Returns:
+          int, version of the entity group, 0 if it was never committed.
+        """
+        k = _Key(entity_group, self._app_id)
+        doc = self._db[self.ENTITY_GROUP_COLLECTION].find_one(
+                {'_id': k.to_mongo_key()})
+        if not doc:
+            return 0
+        return doc['v']
+
+    def bump_entity_group_version(self, entity_group, version=None, kinds=()):
+        """Atomically increase version of the entity group.
+
+        The version is compared and set in one atomic operation, so that
+        only one of concurrent commits (even from different processes)
+        on the same entity group succeeds.
+
+        Args:
+          entity_group: entity_pb.Reference of the root entity of the group.
+          version: int, expected current version of the entity group or None
+              to increase the version unconditionally.
+          kinds: names of collections where entities of the group were
+              stored, get_entity_group reads only the recorded collections.
+
+        Returns:
+          int, new version of the entity group or None if the current version
+          does not match the expected one.
+        """
+        k = _Key(entity_group, self._app_id)
+        spec = {'_id': k.to_mongo_key()}
+        if version is not None:
+            spec['v'] = version
+        coll = self._db[self.ENTITY_GROUP_COLLECTION]
+        try:
+            # upsert creates the version document of the group on the first
+            # commit, if the document exists and the version does not match
+            # the insert fails on duplicate _id
+            doc = coll.find_and_modify(spec, self._group_update(kinds),
+                                       upsert=not version, new=True)
+        except OperationFailure:
+            return None
+        if not doc:
+            return None
+        return doc['v']
+
+    def _group_update(self, kinds):
+        """Get update of the version document of the entity group.
+
+        Args:
+          kinds: names of collections where entities of the group were stored.
+
+        Returns:
+          Dict, update specification increasing the version.
+        """
+        update = {'$inc': {'v': 1}}
+        if kinds:
+            update['$addToSet'] = {'k': {'$each': sorted(kinds)}}
+        return update
+
+    def allocate_ids(self, size=None, max_id=None):
+        """Allocate range of ids from the counter shared by all processes.
+
+        The counter starts at the current time in units of 100 ns, so that
+        ids are never lower than ids allocated by older versions of the stub.
+
+        Args:
+          size: int, number of ids to allocate.
+          max_id: int, the counter is moved to at least this id.
+
+        Returns:
+          Tuple (first, last) of the allocated range, first is greater than
+          last if no id was allocated.
+        """
+        coll = self._db[self.SEQUENCE_COLLECTION]
+        while True:
+            if size:
+                doc = coll.find_and_modify({'_id': 'ids'},
+                                           {'$inc': {'v': size}}, new=True)
+                if doc:
+                    return doc['v'] - size + 1, doc['v']
+            else:
+                doc = coll.find_one({'_id': 'ids'})
+                if doc and doc['v'] >= max_id:
+                    return doc['v'] + 1, doc['v']
+                # compare and set, the counter may be moved concurrently
+                if doc and coll.find_and_modify({'_id': 'ids', 'v': doc['v']},
+                                                {'$set': {'v': max_id}}):
+                    return doc['v'] + 1, max_id
+            if not doc:
+                try:
+                    coll.insert({'_id': 'ids',
+                                 'v': long(time.time() * 10000000)}, w=1)
+                except DuplicateKeyError:
+                    pass
+
     def update_indexes(self, indices):
         d = {'_id' : 1, 'indexes': Binary(indices.Encode())}
         self._db['_indexes'].save(d)
@@ -984,6 +3279,191 @@ class MongoDatastore(object):
         if not i: return None
         return i['indexes']
 
+    def _snapshot_sources(self):
+        """Get names of collections which are copied into snapshots."""
+        return [c for c in self._db.collection_names()
+                if c not in (self.SNAPSHOT_COLLECTION, _ChangeWatcher.COLLECTION)
+                and not c.startswith(SNAPSHOT_PREFIX)
+                and not c.startswith('system.')]
+
+    def _copy_collection(self, source, target):
+        """Copy the collection on the server.
+
+        $out replaces the target collection at once and keeps its indexes.
+        """
+        list(_aggregate(self._db[source], [{'$match': {}}, {'$out': target}]))
+
+    def snapshots(self):
+        """Get names of existing snapshots.
+
+        Returns:
+          List of snapshot names.
+        """
+        return [doc['_id'] for doc in self._db[self.SNAPSHOT_COLLECTION].find()]
+
+    def snapshot(self, name):
+        """Save copy of the whole database (entities, schema, indexes, ...)
+        under the name, an existing snapshot of the same name is replaced.
+
+        Args:
+          name: string, name of the snapshot, must not contain dots.
+
+        Raises:
+          ValueError if the name is not valid.
+        """
+        if not name or '.' in name:
+            raise ValueError("Invalid snapshot name %r." % name)
+        self.delete_snapshot(name)
+        prefix = u"%s%s." % (SNAPSHOT_PREFIX, name)
+        colls = []
+        for coll_name in self._snapshot_sources():
+            self._copy_collection(coll_name, prefix + coll_name)
+            indexes = []
+            info = self._db[coll_name].index_information()
+            for index_name, index in info.iteritems():
+                if index_name == '_id_':
+                    continue
+                options = dict((k, v) for k, v in index.iteritems()
+                               if k not in ('key', 'v', 'ns'))
+                options['name'] = index_name
+                indexes.append({'key': [list(k) for k in index['key']],
+                                'options': options})
+            colls.append({'name': coll_name, 'indexes': indexes})
+        self._db[self.SNAPSHOT_COLLECTION].save(
+                {'_id': name, 'collections': colls}, w=1)
+
+    def restore_snapshot(self, name):
+        """Replace the whole database by the snapshot.
+
+        Collections are copied on the server, collections created after
+        the snapshot are dropped. Caches of this process are cleared and
+        other processes are notified (see watch_changes).
+
+        Args:
+          name: string, name of the snapshot.
+
+        Raises:
+          ValueError if there is no snapshot of such name.
+        """
+        snapshot = self._db[self.SNAPSHOT_COLLECTION].find_one({'_id': name})
+        if snapshot is None:
+            raise ValueError("Snapshot %s does not exist." % name)
+        prefix = u"%s%s." % (SNAPSHOT_PREFIX, name)
+        # restored versions of entity groups are moved past all current
+        # ones, so that no process takes the restored groups for groups
+        # it has cached
+        groups = self._db[self.ENTITY_GROUP_COLLECTION]
+        newest = list(groups.find({}, {'v': 1}).sort('v', DESCENDING).limit(1))
+        shift = newest[0]['v'] if newest else 0
+        restored = set()
+        for coll in snapshot['collections']:
+            coll_name = coll['name']
+            restored.add(coll_name)
+            self._copy_collection(prefix + coll_name, coll_name)
+            for index in coll['indexes']:
+                options = dict((str(k), v)
+                               for k, v in index['options'].iteritems())
+                self._db[coll_name].create_index(
+                        [tuple(k) for k in index['key']], **options)
+        changed = set(self._snapshot_sources())
+        for coll_name in changed - restored:
+            self._db.drop_collection(coll_name)
+        if shift:
+            groups.update({}, {'$inc': {'v': shift}}, multi=True)
+        # counters of the snapshot may not match its entities
+        if self._has_stat_counters():
+            self.rebuild_stat_counters()
+        # all cached entities, query results and schema may be stale
+        self.schema.reload()
+        self.evict(None, None)
+        for coll_name in changed | restored:
+            self._publish(coll_name)
+
+    def delete_snapshot(self, name):
+        """Delete the snapshot, if it exists.
+
+        Args:
+          name: string, name of the snapshot.
+        """
+        prefix = u"%s%s." % (SNAPSHOT_PREFIX, name)
+        for coll_name in self._db.collection_names():
+            if coll_name.startswith(prefix):
+                self._db.drop_collection(coll_name)
+        self._db[self.SNAPSHOT_COLLECTION].remove({'_id': name}, w=1)
+
+    def split_points(self, kind, count, oversampling=SPLIT_OVERSAMPLING):
+        """Get keys which split entities of the kind into balanced ranges.
+
+        Keys are picked evenly from a random sample of the entities, which
+        is read from the beginning of the sparse index of scatter property.
+        If no entity has the property (e.g. it was stored by an older version
+        of the stub), the sample is taken by $sample (mongod >= 3.2).
+
+        Args:
+          kind: string, kind of the entities.
+          count: int, number of ranges.
+          oversampling: int, number of sampled entities per range.
+
+        Returns:
+          Sorted list of at most count - 1 distinct keys
+          (datastore_types.Key), range i contains entities with keys from
+          split point i - 1 (inclusive) to split point i (exclusive).
+        """
+        if count <= 1:
+            return []
+        coll = self._db[kind.lower()]
+        size = count * oversampling
+        cursor = coll.find({SCATTER_SORT_KEY: {'$gt': u""}}, {'_id': 1})
+        sample = [d['_id'] for d in
+                  cursor.sort(SCATTER_SORT_KEY, ASCENDING).limit(size)]
+        if not sample:
+            pipeline = [{'$sample': {'size': size}}, {'$project': {'_id': 1}}]
+            sample = [d['_id'] for d in _aggregate(coll, pipeline)]
+        if not sample:
+            return []
+        sample.sort()
+        points = sorted(set(sample[i * len(sample) // count]
+                            for i in xrange(1, count)))
+        return [_Key(k, self._app_id).to_datastore_key() for k in points]
+
+
+
+class _AsyncRPC(apiproxy_rpc.RPC):
+    """
+    RPC executed asynchronously in the thread pool of the stub.
+
+    The call is started by MakeCall, so that independent RPCs issued by one
+    request overlap their round trips to mongodb. Wait blocks until the call
+    is finished.
+    """
+    def _MakeCallImpl(self):
+        super(_AsyncRPC, self)._MakeCallImpl()
+        self._result = self.stub._rpc_pool.apply_async(
+                self.stub.MakeSyncCall,
+                (self.package, self.call, self.request, self.response))
+
+    def _WaitImpl(self):
+        # base class performs the call on self.stub, let it only collect
+        # the outcome of the call finished in the pool
+        stub, self.stub = self.stub, _FinishedCall(self._result)
+        try:
+            return super(_AsyncRPC, self)._WaitImpl()
+        finally:
+            self.stub = stub
+
+
+
+class _FinishedCall(object):
+    """
+    Stand-in stub for _AsyncRPC, waits for the result of the call.
+    """
+    def __init__(self, result):
+        self._result = result
+
+    def MakeSyncCall(self, *args):
+        """Wait for the call, re-raise its exception if any."""
+        self._result.get()
+
 
 
 class DatastoreMongoDBStub(datastore_stub_util.BaseDatastore,
@@ -1002,7 +3482,19 @@ class DatastoreMongoDBStub(datastore_stub_util.BaseDatastore,
                  consistency_policy=None,
                  root_path=None,
                  mongodb_host='localhost',
-                 mongodb_port=27017):
+                 mongodb_port=27017,
+                 atomic_commit=False,
+                 rpc_threads=0,
+                 gridfs_threshold=None,
+                 gridfs_compress=False,
+                 entity_cache_size=0,
+                 entity_cache_bytes=None,
+                 watch_changes=False,
+                 query_cache_size=0,
+                 in_memory=False,
+                 stat_counters=False,
+                 replica_set=None,
+                 query_read_preference=None):
         """Constructor.
 
         Initializes stub and connection to mongodb.
@@ -1015,8 +3507,41 @@ class DatastoreMongoDBStub(datastore_stub_util.BaseDatastore,
           consistency_policy: The consistency policy to use or None to use the
               default. Consistency policies can be found in
               datastore_stub_util.*ConsistencyPolicy
-          mongodb_host: string, mongodb host address.
+          mongodb_host: string, mongodb host address or mongodb URI.
           mongodb_port: int, port on which the mongod server runs.
+          atomic_commit: bool, default False. If True, mutations of committed
+              transactions are applied in one mongodb transaction, if the
+              server supports it (see MongoDatastore).
+          rpc_threads: int, default 0. Size of the thread pool executing
+              asynchronous RPCs (e.g. ndb's get_async, put_async). If 0,
+              RPCs are executed synchronously when waited for.
+          gridfs_threshold: int or None, default None. Minimal size in bytes
+              of Blob, Text and EmbeddedEntity values stored in GridFS
+              instead of the entity document (see MongoDatastore).
+          gridfs_compress: bool, default False. If True, values stored
+              in GridFS are compressed by zlib.
+          entity_cache_size: int, default 0. Maximal number of entities
+              in the in-process LRU cache serving gets by key. If 0, entities
+              are not cached.
+          entity_cache_bytes: int or None, default None. Maximal total size
+              of cached entities in bytes.
+          watch_changes: bool, default False. If True, entities and schema
+              changed by other processes sharing the database are evicted
+              from caches by a background thread (see MongoDatastore).
+          query_cache_size: int, default 0. Maximal number of queries whose
+              results are cached in-process until their kind is written.
+              If 0, results of queries are not cached.
+          in_memory: bool, default False. If True, data are kept in memory
+              of the process instead of mongod (see MongoDatastore).
+          stat_counters: bool, default False. If True, put and delete count
+              values of property types for __Stat_PropertyType__ statistics
+              (see MongoDatastore), otherwise they are estimated.
+          replica_set: string or None, default None. Name of the replica set
+              of the mongodb servers.
+          query_read_preference: read preference or name of its mode (e.g.
+              'secondaryPreferred') used by non-ancestor queries, gets,
+              ancestor queries and transactions read from the primary
+              (see MongoDatastore). If None, all reads go to the primary.
         """
         assert isinstance(app_id, str), app_id != ''
 
@@ -1027,12 +3552,36 @@ class DatastoreMongoDBStub(datastore_stub_util.BaseDatastore,
                                                    app_id, trusted=False,
                                                    root_path=root_path)
         # speed-up dict for _EntitiesByEntityGroup method taken
-        # from DatastoreFileStub
-        self.__entities_by_group = collections.defaultdict(dict)
+        # from DatastoreFileStub. Contains only complete entity groups read
+        # from mongodb, valid as long as their version did not change.
+        self.__entities_by_group = {}
+        # versions of entity groups in the time they were read by this process
+        self.__entity_group_versions = {}
+        # locks of entity groups guarding the two dicts above
+        self.__entity_group_locks = _KeyedLocks()
         # initialize inner mongo datastore
         self._mongods = MongoDatastore(mongodb_host, mongodb_port, app_id,
-                                       require_indexes)
-        # load indexes into stub
+                                       require_indexes, atomic_commit,
+                                       gridfs_threshold, gridfs_compress,
+                                       entity_cache_size, entity_cache_bytes,
+                                       watch_changes, query_cache_size,
+                                       in_memory, stat_counters, replica_set,
+                                       query_read_preference)
+        # mutations collected while committing transaction in current thread
+        self.__commit = threading.local()
+        # pool executing asynchronous RPCs
+        self._rpc_pool = None
+        if rpc_threads:
+            self._rpc_pool = multiprocessing.pool.ThreadPool(rpc_threads)
+        self._LoadIndexes()
+        for coll_name, index_name in self._mongods.superfluous_indexes():
+            warnings.warn("Index %s of collection %s is not used by queries, "
+                          "it can be dropped." % (index_name, coll_name))
+
+
+    def _LoadIndexes(self):
+        """Load composite indexes stored in mongodb into the stub."""
+        self._BaseIndexManager__indexes.clear()
         index_proto = self._mongods.load_indexes()
         if index_proto:
             indexes = datastore_pb.CompositeIndices(index_proto)
@@ -1042,7 +3591,6 @@ class DatastoreMongoDBStub(datastore_stub_util.BaseDatastore,
                 # index is hard-wired and imitates the _SideLoadIndex method
                 self._BaseIndexManager__indexes[index.app_id()].append(index)
 
-
     def MakeSyncCall(self, service, call, request, response, request_id=None):
         """
         Base input RPC method.
@@ -1064,17 +3612,101 @@ class DatastoreMongoDBStub(datastore_stub_util.BaseDatastore,
         explanation = []
         assert response.IsInitialized(explanation), explanation
 
+    def CreateRPC(self):
+        """Create RPC object.
+
+        Returns:
+          _AsyncRPC if the stub has pool of RPC threads, otherwise default
+          synchronous apiproxy_rpc.RPC.
+        """
+        if self._rpc_pool is None:
+            return apiproxy_stub.APIProxyStub.CreateRPC(self)
+        return _AsyncRPC(stub=self)
+
     def Clear(self):
         """Clears out all stored values."""
         datastore_stub_util.DatastoreStub.Clear(self)
         self._mongods.clear()
-        self.__entities_by_group = collections.defaultdict(dict)
+        self.__entities_by_group = {}
+        self.__entity_group_versions = {}
 
     def Read(self):
         """Noop"""
 
+    def GetEntityCacheStats(self):
+        """Get statistics of the entity cache.
+
+        Returns:
+          Dict with hits, misses, evictions, entries, bytes and hit_ratio
+          or None if the cache is disabled.
+        """
+        return self._mongods.entity_cache_stats()
+
+    def GetQueryPlanStats(self):
+        """Get statistics of the cache of query plans.
+
+        Returns:
+          Dict with hits, misses, evictions, entries and hit_ratio.
+        """
+        return self._mongods.query_plan_stats()
+
+    def GetQueryCacheStats(self):
+        """Get statistics of the query cache.
+
+        Returns:
+          Dict with hits, misses, evictions, entries, bytes and hit_ratio
+          or None if the cache is disabled.
+        """
+        return self._mongods.query_cache_stats()
+
+    def CreateSnapshot(self, name):
+        """Save copy of the whole datastore under the name.
+
+        The copy is made on the mongodb server, see MongoDatastore.snapshot.
+
+        Args:
+          name: string, name of the snapshot, must not contain dots.
+        """
+        self._mongods.snapshot(name)
+
+    def RestoreSnapshot(self, name):
+        """Replace contents of the datastore by the snapshot.
+
+        Args:
+          name: string, name of the snapshot created by CreateSnapshot.
+        """
+        self._mongods.restore_snapshot(name)
+        self.__entities_by_group = {}
+        self.__entity_group_versions = {}
+        self._LoadIndexes()
+
+    def DeleteSnapshot(self, name):
+        """Delete the snapshot.
+
+        Args:
+          name: string, name of the snapshot.
+        """
+        self._mongods.delete_snapshot(name)
+
+    def GetSplitPoints(self, kind, count):
+        """Get keys splitting entities of the kind into balanced ranges,
+        which can be scanned in parallel (see MongoDatastore.split_points).
+
+        Args:
+          kind: string, kind of the entities.
+          count: int, number of ranges.
+
+        Returns:
+          Sorted list of at most count - 1 keys (datastore_types.Key).
+        """
+        return self._mongods.split_points(kind, count)
+
     def Close(self):
-        """Noop"""
+        """Stop threads executing asynchronous RPCs and watching changes."""
+        if self._rpc_pool is not None:
+            self._rpc_pool.close()
+            self._rpc_pool = None
+        self._mongods.close()
 
     def _GetEntityLocation(self, key):
         """Get keys to self.__entities_by_group from the given key.
@@ -1101,11 +3733,21 @@ class DatastoreMongoDBStub(datastore_stub_util.BaseDatastore,
             exists.
         """
         entity = datastore_stub_util.StoreEntity(entity)
-        # store entity into entity group dict
         eg_k, k = self._GetEntityLocation(entity.key())
-        self.__entities_by_group[eg_k][k] = entity
-        # put into mongo 
-        self._mongods.put([entity])
+        mutations = getattr(self.__commit, 'mutations', None)
+        with self.__entity_group_locks(eg_k):
+            # store entity into entity group dict, if the group is cached
+            if eg_k in self.__entities_by_group:
+                self.__entities_by_group[eg_k][k] = entity
+            # put into mongo, or postpone until the end of the commit
+            if mutations is not None:
+                mutations[0].append(entity)
+            else:
+                self._mongods.put([entity])
+            if getattr(self.__commit, 'locked', False):
+                self.__commit.written.add(eg_k)
+            else:
+                self._BumpEntityGroupVersion(entity.key(), eg_k, stored=True)
 
     def _Get(self, key):
         """Get the entity for the given reference or None.
@@ -1134,9 +3776,7 @@ class DatastoreMongoDBStub(datastore_stub_util.BaseDatastore,
                                        self._trusted, self._app_id)
         datastore_stub_util.Check(not (size and max_id),
                                   'Both size and max cannot be set.')
-
-        t = long(time.time() * 10000000)
-        return (t, t+size)
+        return self._mongods.allocate_ids(size, max_id)
 
     def _Delete(self, key):
         """Delete the entity associated with the specified reference.
@@ -1145,13 +3785,43 @@ class DatastoreMongoDBStub(datastore_stub_util.BaseDatastore,
           reference: The entity_pb.Reference of the entity to delete.
         """
         eg_k, k = self._GetEntityLocation(key)
-        try:
-            del self.__entities_by_group[eg_k][k]
-            if not self.__entities_by_group[eg_k]:
-                del self.__entities_by_group[eg_k]
-        except KeyError:
-            pass
-        self._mongods.delete(key)
+        mutations = getattr(self.__commit, 'mutations', None)
+        with self.__entity_group_locks(eg_k):
+            try:
+                del self.__entities_by_group[eg_k][k]
+            except KeyError:
+                pass
+            if mutations is not None:
+                mutations[1].append(key)
+            else:
+                self._mongods.delete(key)
+            if getattr(self.__commit, 'locked', False):
+                self.__commit.written.add(eg_k)
+            else:
+                self._BumpEntityGroupVersion(key, eg_k)
+
+    def _BumpEntityGroupVersion(self, key, eg_k, stored=False):
+        """Increase version of the entity group written outside of a commit.
+
+        Other processes then do not serve the group from their caches.
+        Must be called with the lock of the entity group held.
+
+        Args:
+          key: entity_pb.Reference of the written entity.
+          eg_k: key of the entity group in self.__entities_by_group.
+          stored: True if the entity was stored, False if deleted.
+        """
+        entity_group = datastore_stub_util._GetEntityGroup(key)
+        kinds = [_Key(key, key.app()).collection()] if stored else ()
+        version = self._mongods.bump_entity_group_version(entity_group,
+                                                          kinds=kinds)
+        # the cached group contains the write, unless another process has
+        # written the group since it was read
+        if self.__entity_group_versions.get(eg_k) == version - 1:
+            self.__entity_group_versions[eg_k] = version
+        else:
+            self.__entity_group_versions.pop(eg_k, None)
+            self.__entities_by_group.pop(eg_k, None)
 
     def _GetEntitiesInEntityGroup(self, entity_group):
         """Gets the contents of a specific entity group.
@@ -1164,21 +3834,185 @@ class DatastoreMongoDBStub(datastore_stub_util.BaseDatastore,
         Returns:
           A dict mapping datastore_types.ReferenceToKeyValue(key) to EntityProto
         """
+        eg_k = datastore_types.ReferenceToKeyValue(entity_group)
+        with self.__entity_group_locks(eg_k):
+            return self._ReadEntityGroup(entity_group, eg_k)
+
+    def _ReadEntityGroup(self, entity_group, eg_k):
+        """Read entity group from cache or from mongodb.
+
+        Must be called with the lock of the entity group held.
+
+        Args:
+          entity_group: A entity_pb.Reference of the entity group to get.
+          eg_k: key of the entity group in self.__entities_by_group.
+
+        Returns:
+          _EntityGroupSnapshot mapping datastore_types.ReferenceToKeyValue(key)
+          to EntityProto.
+        """
+        # the version has to be read before the entities, any later commit
+        # then causes conflict of the transaction using this snapshot
+        version = self._mongods.get_entity_group_version(entity_group)
+        if self.__entity_group_versions.get(eg_k) == version:
+            try:
+                return _EntityGroupSnapshot(self.__entities_by_group[eg_k],
+                                            version)
+            except KeyError:
+                pass
+        entities = dict((datastore_types.ReferenceToKeyValue(entity.key()), entity)
+                        for entity in self._mongods.get_entity_group(entity_group))
+        self.__entities_by_group[eg_k] = entities
+        self.__entity_group_versions[eg_k] = version
+        return _EntityGroupSnapshot(entities, version)
+
+    def _AcquireWriteLocks(self, meta_data_list):
+        """Acquire write locks on entity groups which are going to be committed.
+
+        Besides the in-process locks of datastore_stub_util, the versions of
+        the entity groups stored in mongodb are compared with the versions
+        read by the transaction and increased. If some entity group was
+        committed by another process in the meantime, the commit fails.
+
+        Args:
+          meta_data_list: list of datastore_stub_util.EntityGroupMetaData.
+
+        Raises:
+          apiproxy_errors.ApplicationError: CONCURRENT_TRANSACTION if version
+              of some entity group has changed.
+        """
+        datastore_stub_util.BaseDatastore._AcquireWriteLocks(self, meta_data_list)
+        claimed = {}
         try:
-            eg_k = datastore_types.ReferenceToKeyValue(entity_group)
-            return self.__entities_by_group[eg_k].copy()
-        except KeyError:
-            pass
-        query = datastore_pb.Query()
-        query.set_kind(entity_group.path().element_list()[0].type())
-        query.set_app(entity_group.app())
-        if entity_group.name_space():
-            query.set_name_space(entity_group.name_space())
-        query.mutable_ancestor().CopyFrom(entity_group)
+            for meta_data in meta_data_list:
+                eg_k, version = self._CommitEntityGroupVersion(meta_data)
+                claimed[eg_k] = (meta_data._entity_group, version)
+        except:
+            self._ReleaseWriteLocks(meta_data_list)
+            raise
+        # writes of the commit are finished by _ReleaseWriteLocks, in case
+        # of atomic commit they are collected until then
+        self.__commit.locked = True
+        self.__commit.claimed = claimed
+        self.__commit.written = set()
+        if self._mongods.atomic_commit:
+            self.__commit.mutations = ([], [])
+
+    def _ReleaseWriteLocks(self, meta_data_list):
+        """Finish writes of the commit and release write locks acquired
+        by _AcquireWriteLocks.
+
+        Mutations collected for atomic commit are written and versions of
+        the written entity groups are increased again while the locks are
+        still held, so that neither this process nor other processes see
+        the new version with the old entities.
+
+        Args:
+          meta_data_list: list of datastore_stub_util.EntityGroupMetaData.
+
+        Raises:
+          apiproxy_errors.ApplicationError: CONCURRENT_TRANSACTION if some
+              entity group was committed by another process before the
+              atomic commit was written.
+        """
+        locked = getattr(self.__commit, 'locked', False)
+        claimed = getattr(self.__commit, 'claimed', None)
+        written = getattr(self.__commit, 'written', None)
+        mutations = getattr(self.__commit, 'mutations', None)
+        self.__commit.locked = False
+        self.__commit.claimed = self.__commit.written = None
+        self.__commit.mutations = None
+        try:
+            if locked:
+                self._FinishCommit(claimed, written, mutations)
+        finally:
+            datastore_stub_util.BaseDatastore._ReleaseWriteLocks(
+                    self, meta_data_list)
+
+    def _FinishCommit(self, claimed, written, mutations):
+        """Write collected mutations and publish versions of written groups.
+
+        Args:
+          claimed: dict mapping keys of entity groups in
+              self.__entities_by_group to tuples (entity group, version
+              set by _CommitEntityGroupVersion).
+          written: set of keys of entity groups written by the commit.
+          mutations: tuple (entities, keys) collected for atomic commit
+              or None if they were written one by one.
+        """
+        groups = [(eg_k,) + claimed[eg_k] for eg_k in written]
+        entities, keys = mutations or ([], [])
+        try:
+            versions = self._mongods.commit(
+                    entities, keys, [(eg, v) for eg_k, eg, v in groups])
+        except:
+            self._ForgetEntityGroups(written)
+            raise
+        if versions is None:
+            self._ForgetEntityGroups(written)
+            raise apiproxy_errors.ApplicationError(
+                datastore_pb.Error.CONCURRENT_TRANSACTION,
+                'Concurrency exception.')
+        for (eg_k, eg, claimed_version), version in zip(groups, versions):
+            with self.__entity_group_locks(eg_k):
+                if self.__entity_group_versions.get(eg_k) == claimed_version:
+                    self.__entity_group_versions[eg_k] = version
+                else:
+                    self.__entity_group_versions.pop(eg_k, None)
+                    self.__entities_by_group.pop(eg_k, None)
+
+    def _ForgetEntityGroups(self, eg_keys):
+        """Drop cached entity groups whose mutations were not written.
+
+        Args:
+          eg_keys: iterable of keys of entity groups in
+              self.__entities_by_group.
+        """
+        for eg_k in eg_keys:
+            with self.__entity_group_locks(eg_k):
+                self.__entities_by_group.pop(eg_k, None)
+                self.__entity_group_versions.pop(eg_k, None)
+
+    def _CommitEntityGroupVersion(self, meta_data):
+        """Compare and set version of one entity group.
 
-        cursor = self._mongods.query(query)
-        return dict((datastore_types.ReferenceToKeyValue(entity.key()), entity)
-                     for entity in cursor)
+        Args:
+          meta_data: datastore_stub_util.EntityGroupMetaData of the group.
+
+        Returns:
+          Tuple (key of the group in self.__entities_by_group, new version).
+
+        Raises:
+          apiproxy_errors.ApplicationError: CONCURRENT_TRANSACTION if version
+              of the entity group has changed.
+        """
+        entity_group = meta_data._entity_group
+        eg_k = datastore_types.ReferenceToKeyValue(entity_group)
+        with self.__entity_group_locks(eg_k):
+            # the version the snapshot of the transaction was read at, not
+            # the version cached by this process, which may be newer
+            expected = getattr(meta_data._snapshot, 'version', None)
+            if expected is None:
+                # the transaction has not read the group, only claim it
+                expected = self._mongods.get_entity_group_version(entity_group)
+            version = self._mongods.bump_entity_group_version(entity_group,
+                                                              expected)
+            if version is None:
+                # drop stale snapshots, retried transaction reads them again
+                self.__entity_group_versions.pop(eg_k, None)
+                self.__entities_by_group.pop(eg_k, None)
+                meta_data._snapshot = None
+                raise apiproxy_errors.ApplicationError(
+                    datastore_pb.Error.CONCURRENT_TRANSACTION,
+                    'Concurrency exception.')
+            # the cached group is updated by writes of the commit only if it
+            # is the snapshot the transaction has read
+            if self.__entity_group_versions.get(eg_k) == expected:
+                self.__entity_group_versions[eg_k] = version
+            else:
+                self.__entity_group_versions.pop(eg_k, None)
+                self.__entities_by_group.pop(eg_k, None)
+        return eg_k, version
 
     def _GetQueryCursor(self, query, filters, orders, index_list):
         """Runs the given datastore_pb.Query and returns a QueryCursor for it.
@@ -1193,8 +4027,16 @@ class DatastoreMongoDBStub(datastore_stub_util.BaseDatastore,
           An IteratorCursor that can be used to fetch query results.
         """
         db_cursor = self._mongods.query(query)
+        if query.kind() in _StatCursor.KINDS:
+            # few statistics entities are filtered and ordered in memory
+            return datastore_stub_util._ExecuteQuery(list(db_cursor), query,
+                                                     filters, orders,
+                                                     index_list)
         orders = datastore_stub_util._GuessOrders(filters, orders)
         dsquery = datastore_stub_util._MakeQuery(query, filters, orders)
+        if getattr(db_cursor, 'count', None) is not None:
+            return _CountCursor(query, dsquery, orders, index_list,
+                                db_cursor.count)
         cursor = datastore_stub_util.IteratorCursor(query, dsquery, orders,
                                                     index_list, db_cursor)
         return cursor
@@ -12,12 +12,14 @@ if not exist %VERSION% GOTO BAD_FOLDER
 :: set some paths
 set PATCHFILE=dev_appserver.patch
 set STUBFILE=datastore_mongodb_stub.py
+set MEMORYFILE=datastore_mongodb_memory.py
 set SDK_GOOGLE=%1\google\
 set DATASTORE_PATH=%1\google\appengine\datastore\
 
 :: PATCH!
 echo Copying datastore mongodb stub into SDK...
 copy %STUBFILE% %DATASTORE_PATH%
+copy %MEMORYFILE% %DATASTORE_PATH%
 copy %PATCHFILE% %SDK_GOOGLE%
 cd %SDK_GOOGLE%
 echo Patching dev_appserver...
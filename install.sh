@@ -35,9 +35,11 @@ SDK_GOOGLE=$1/google/
 DATASTORE_PATH=$SDK_GOOGLE/appengine/datastore/
 PATCHFILE=dev_appserver.patch
 STUBFILE=datastore_mongodb_stub.py
+MEMORYFILE=datastore_mongodb_memory.py
 
 echo "Copying datastore mongodb stub into SDK..."
 cp $STUBFILE $DATASTORE_PATH
+cp $MEMORYFILE $DATASTORE_PATH
 cp $PATCHFILE $SDK_GOOGLE
 cd $SDK_GOOGLE
 echo "Patching dev_appserver..."
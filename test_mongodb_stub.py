@@ -1,28 +1,41 @@
 
 import os
+import shutil
+import tempfile
 import unittest
 import string
 import datetime
 import sys
 import textwrap
+import threading
+import time
 import weakref
 
-from google.appengine.api import apiproxy_stub_map, datastore_types, users
+from google.appengine.api import apiproxy_stub_map, datastore, \
+    datastore_types, users
 from google.appengine.api.memcache import memcache_stub
 from google.appengine.api.user_service_stub import UserServiceStub
 from google.appengine.api.datastore_file_stub import DatastoreFileStub
+from google.appengine.datastore import datastore_pb, entity_pb
+from google.appengine.datastore.datastore_sqlite_stub import DatastoreSqliteStub
 from google.appengine.datastore.datastore_stub_util import _MAXIMUM_RESULTS, \
     _MAX_QUERY_OFFSET, PseudoRandomHRConsistencyPolicy, MasterSlaveConsistencyPolicy
 from google.appengine.ext import ndb
+from google.appengine.ext.ndb import stats
 from google.appengine.ext.blobstore import BlobKey
+from bson import ObjectId
+from pymongo import MongoClient, ReadPreference
+from pymongo.errors import DuplicateKeyError
 
 
 # import DATASTORE MONGODB STUB from this pkg
-from datastore_mongodb_stub import DatastoreMongoDBStub
+from datastore_mongodb_stub import DatastoreMongoDBStub, MongoDatastore, \
+    _Prefetcher
+import datastore_mongodb_bulk
+import datastore_mongodb_memory
+import datastore_mongodb_stub
 
-# TODO: thread tests
 # TODO: Projection queries on multivalued properties
-# TODO: Datastore statistics
 
 APP_ID = 'test'
 
@@ -81,6 +94,20 @@ class _DatastoreStubTests(object):
         
 
 
+    def test_put_key_name_with_delimiters(self):
+        class Product(ndb.Model):
+            a = ndb.StringProperty()
+
+        parent = ndb.Key('Commercial', 'x-1')
+        p = Product(id='a-b-c\x01', parent=parent, a="a")
+        k = p.put()
+        try:
+            self.assertEqual(k.get(use_cache=False, use_memcache=False), p)
+            self.assertEqual(Product.query(ancestor=parent).fetch(), [p])
+        finally:
+            k.delete()
+
+
     def test_invalid_get(self):
         k = ndb.Key('Car', 2)
         assert k.get() is None
@@ -181,6 +208,21 @@ class _DatastoreStubTests(object):
         self.assertEqual(a, aa)
 
 
+    def test_non_utf8_string(self):
+        s = "\xff\xfe\x00pickled\x80"
+        class A(ndb.Expando):
+            pass
+        a = A(b=s)
+        k = a.put()
+        try:
+            aa = k.get(use_cache=False, use_memcache=False)
+            self.assertEqual(aa.b, s)
+            self.assertEqual(type(aa.b), str)
+            self.assertEqual(A.query(ndb.GenericProperty('b') == s).fetch(), [a])
+        finally:
+            k.delete()
+
+
     def test_datetime_property(self):
         class A(ndb.Model):
             b = ndb.DateTimeProperty()
@@ -719,6 +761,56 @@ class _DatastoreStubTests(object):
             ndb.delete_multi(keys)
 
 
+    def test_query_opt_ancestor_mixed_kinds(self):
+        class Parent(ndb.Model):
+            a = ndb.IntegerProperty()
+        class Child(ndb.Model):
+            a = ndb.IntegerProperty()
+
+        p = Parent(a=1)
+        pk = p.put()
+        c1 = Child(a=2, parent=pk)
+        c2 = Child(a=3, parent=ndb.Key('Parent', 'other'))
+        keys = ndb.put_multi([c1, c2]) + [pk]
+        try:
+            self.assertEqual(Parent.query(ancestor=pk).fetch(), [p])
+            self.assertEqual(Child.query(ancestor=pk).order(-Child.a).fetch(), [c1])
+            # entity group contains entities of both kinds
+            @ndb.transactional
+            def txn():
+                return ndb.get_multi([pk, c1.key], use_cache=False,
+                                     use_memcache=False)
+            self.assertEqual(txn(), [p, c1])
+        finally:
+            ndb.delete_multi(keys)
+
+
+    def test_query_kindless_ancestor(self):
+        class KindlessA(ndb.Model):
+            a = ndb.IntegerProperty()
+        class KindlessB(ndb.Model):
+            b = ndb.IntegerProperty()
+
+        root = ndb.Key('KindlessA', 1)
+        entities = [KindlessA(key=root, a=0),
+                    KindlessB(id=1, parent=root, b=1),
+                    KindlessA(id=1, parent=ndb.Key('KindlessB', 1, parent=root),
+                              a=2),
+                    KindlessB(id=2, parent=root, b=3),
+                    KindlessB(id=3, b=4)]
+        keys = ndb.put_multi(entities)
+        try:
+            # entities of all kinds in key order
+            q = ndb.Query(ancestor=root)
+            self.assertEqual(q.fetch(), entities[:4])
+            self.assertEqual(q.fetch(2, keys_only=True), keys[:2])
+            self.assertEqual(q.fetch(2, offset=1), entities[1:3])
+            q = q.filter(ndb.FilterNode('__key__', '>', keys[1]))
+            self.assertEqual(q.fetch(keys_only=True), keys[2:4])
+        finally:
+            ndb.delete_multi(keys)
+
+
     def test_query_opt_keys_only(self):
         Q, e = self._gen_entities(2, ndb.IntegerProperty)
         keys = ndb.put_multi(e)
@@ -730,6 +822,21 @@ class _DatastoreStubTests(object):
             ndb.delete_multi(keys)
 
 
+    def test_query_opt_keys_only_ancestor(self):
+        Q, (e1, e2) = self._gen_entities(2, ndb.IntegerProperty)
+        k1 = e1.put()
+        e3 = Q(id='child', a=3, parent=k1)
+        keys = ndb.put_multi([e2, e3])
+        keys.append(k1)
+        try:
+            l = Q.query(ancestor=k1).order(Q.key).fetch(keys_only=True)
+            self.assertEqual(l, [k1, e3.key])
+            self.assertEqual(l[1].parent(), k1)
+            self.assertEqual(l[1].id(), 'child')
+        finally:
+            ndb.delete_multi(keys)
+
+
     def test_query_opt_count(self):
         Q, e = self._gen_entities(10, ndb.IntegerProperty)
         keys = ndb.put_multi(e)
@@ -737,6 +844,15 @@ class _DatastoreStubTests(object):
         try:
             self.assertEqual(Q.query().count(), 10)
             self.assertEqual(Q.query(Q.a >= 5).count(), 5)
+            self.assertEqual(Q.query().count(limit=3), 3)
+            self.assertEqual(Q.query(Q.a >= 5).count(limit=20), 5)
+            # counts and results are bounded by cursors
+            q = Q.query().order(Q.a)
+            _, cursor, _ = q.fetch_page(3)
+            self.assertEqual(q.count(start_cursor=cursor), 7)
+            self.assertEqual(q.count(end_cursor=cursor), 3)
+            self.assertEqual([x.a for x in q.fetch(2, start_cursor=cursor)],
+                             [3, 4])
         finally:
             ndb.delete_multi(keys)
         # test count ranges (max results)
@@ -746,6 +862,58 @@ class _DatastoreStubTests(object):
             self.assertEqual(Q.query().count(), _MAXIMUM_RESULTS+10)
         finally:
             ndb.delete_multi(keys)
+        # partial entities of projection on repeated property are counted
+        class R(ndb.Model):
+            x = ndb.IntegerProperty(repeated=True)
+        keys = ndb.put_multi([R(x=[1, 2, 2]), R(x=[3])])
+        try:
+            self.assertEqual(R.query(projection=['x']).count(), 3)
+            self.assertEqual(R.query(projection=['x']).count(limit=2), 2)
+        finally:
+            ndb.delete_multi(keys)
+
+
+    def test_query_user_without_email(self):
+        class U(ndb.Model):
+            u = ndb.UserProperty()
+        u1 = users.User(federated_identity='https://id.example.com/1')
+        u2 = users.User(federated_identity='https://id.example.com/2')
+        keys = ndb.put_multi([U(u=u1), U(u=u2)])
+        try:
+            self.assertEqual([e.u for e in U.query(U.u == u2).fetch()], [u2])
+        finally:
+            ndb.delete_multi(keys)
+
+
+    def test_query_mixed_unindexed_values(self):
+        # Text value of the list is not indexed, the others are
+        e = datastore.Entity('Mixed')
+        e['a'] = [datastore_types.Text(u'long'), u'short']
+        k = datastore.Put(e)
+        try:
+            q = datastore.Query('Mixed', {'a =': u'short'})
+            self.assertEqual([x.key() for x in q.Run()], [k])
+            q = datastore.Query('Mixed', {'a =': u'long'})
+            self.assertEqual(list(q.Run()), [])
+        finally:
+            datastore.Delete(k)
+
+
+    def test_query_long_string(self):
+        class L(ndb.Model):
+            s = ndb.StringProperty()
+        prefix = u'x' * 300
+        keys = ndb.put_multi([L(s=prefix + u'a'), L(s=prefix + u'b'),
+                              L(s=u'y')])
+        try:
+            # values differ after the cut of their sort keys
+            l = L.query(L.s == prefix + u'b').fetch()
+            self.assertEqual([e.s for e in l], [prefix + u'b'])
+            l = L.query(L.s < u'y').fetch()
+            self.assertEqual(sorted(e.s for e in l),
+                             [prefix + u'a', prefix + u'b'])
+        finally:
+            ndb.delete_multi(keys)
 
 
     def test_query_opt_limit(self):
@@ -943,6 +1111,24 @@ class _DatastoreStubTests(object):
             ndb.delete_multi(keys)
 
 
+    def test_query_order_mixed_types(self):
+        class Q(ndb.Expando):
+            pass
+        values = [-5, 3, 2**40, True, u'abc', 'abd', -1.5, 2.5,
+                  ndb.GeoPt(1, 2), ndb.Key('A', 1), None]
+        e = [Q(a=v) for v in values]
+        e.append(Q(a=ndb.Text('unorderable')))
+        keys = ndb.put_multi(e)
+        try:
+            a = ndb.GenericProperty('a')
+            l = Q.query().order(a).fetch()
+            self.assertEqual([x.a for x in l], [None] + values[:-1])
+            l = Q.query().order(-a).fetch()
+            self.assertEqual([x.a for x in l], list(reversed(values[:-1])) + [None])
+        finally:
+            ndb.delete_multi(keys)
+
+
     def test_query_order_structured_property(self):
         Q, e = self._gen_entities(4, ndb.StructuredProperty)
         keys = ndb.put_multi(e)
@@ -1125,6 +1311,23 @@ class _DatastoreStubTests(object):
         self._datetime_test_wrapper(ndb.TimeProperty)
 
 
+    def test_query_order_key(self):
+        class Q(ndb.Model):
+            a = ndb.IntegerProperty()
+        e = [Q(id=i, a=i) for i in (1, 2, 10, 255, 256, 4096)]
+        e.extend([Q(id=s, a=0) for s in ('a', 'a-b', 'ab', 'b')])
+        keys = ndb.put_multi(e)
+        try:
+            l = Q.query().order(Q.key).fetch()
+            self.assertEqual(l, e)
+            l = Q.query().order(-Q.key).fetch()
+            self.assertEqual(l, list(reversed(e)))
+            l = Q.query(Q.key > ndb.Key('Q', 10)).order(Q.key).fetch()
+            self.assertEqual(l, e[3:])
+        finally:
+            ndb.delete_multi(keys)
+
+
     def test_query_order_named_property(self):
         """Test if stub does work correctly with named properties.
 
@@ -1214,7 +1417,6 @@ class _DatastoreStubTests(object):
         """Test wicked behaviour of datastore when using projection
            on more than one repeated property.
         """
-        raise unittest.SkipTest()
         class Q(ndb.Model):
             x = ndb.StringProperty(repeated=True)
             y = ndb.IntegerProperty(repeated=True)
@@ -1232,6 +1434,20 @@ class _DatastoreStubTests(object):
             k.delete()
 
 
+    def test_query_projection_repeated_mixed_types(self):
+        class M(ndb.Model):
+            a = ndb.GenericProperty(repeated=True)
+        k = M(a=[u'b', 3, 1.5, 2]).put()
+        try:
+            # integers, strings and floats, as without projection
+            l = M.query().order(M.a).fetch(projection=['a'])
+            self.assertEqual([m.a for m in l], [[2], [3], [u'b'], [1.5]])
+            l = M.query(M.a > 2).fetch(projection=['a'])
+            self.assertEqual([m.a for m in l], [[3]])
+        finally:
+            k.delete()
+
+
     def test_query_projection_with_filter(self):
         class Q(ndb.Model):
             x = ndb.StringProperty(repeated=True)
@@ -1303,6 +1519,43 @@ class _DatastoreStubTests(object):
         k.delete()
 
 
+    # THREADS
+
+    def test_threads_put_get_query(self):
+        """Hammer the stub with puts, gets and queries from many threads."""
+        class T(ndb.Model):
+            thread = ndb.IntegerProperty()
+            i = ndb.IntegerProperty()
+        threads_count, entities_count = 10, 30
+        errors = []
+
+        def worker(n):
+            try:
+                e = [T(thread=n, i=i) for i in xrange(entities_count)]
+                keys = ndb.put_multi(e, use_cache=False, use_memcache=False)
+                got = ndb.get_multi(keys, use_cache=False, use_memcache=False)
+                if got != e:
+                    errors.append("get in thread %d" % n)
+                l = T.query(T.thread == n).order(T.i).fetch()
+                if [x.i for x in l] != range(entities_count):
+                    errors.append("query in thread %d" % n)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(n,))
+                   for n in xrange(threads_count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        keys = T.query().fetch(keys_only=True)
+        try:
+            self.assertEqual(errors, [])
+            self.assertEqual(len(keys), threads_count * entities_count)
+        finally:
+            ndb.delete_multi(keys)
+
+
     # EXPANDO, POLYMODEL
 
     def test_expando_model(self):
@@ -1379,3 +1632,770 @@ class TestDatastoreMongodbStub(_DatastoreStubTests, unittest.TestCase):
         sys.stderr.write(underline + '\n' +cls.__name__ + '\n' + underline \
                          + textwrap.dedent(cls.__doc__) + '\n')
 
+    def test_transaction_concurrent_commit(self):
+        """Commit from another process (simulated by increasing version
+           of the entity group in mongodb) forces retry of the transaction.
+        """
+        class T(ndb.Model):
+            a = ndb.IntegerProperty()
+        k = T(a=0).put()
+        attempts = []
+        @ndb.transactional(retries=1)
+        def t():
+            e = k.get(use_cache=False, use_memcache=False)
+            if not attempts:
+                mongods = self._datastore_stub._mongods
+                mongods.bump_entity_group_version(k.reference())
+            attempts.append(e.a)
+            e.a += 1
+            e.put()
+        try:
+            t()
+            self.assertEqual(len(attempts), 2)
+            self.assertEqual(k.get(use_cache=False, use_memcache=False).a, 1)
+        finally:
+            k.delete()
+
+    def test_transaction_commit_after_reread(self):
+        """Commit of another process conflicts with the transaction even if
+           the entity group was read again by this process in the meantime.
+        """
+        class T(ndb.Model):
+            a = ndb.IntegerProperty()
+        k = T(a=0).put()
+        other = DatastoreMongoDBStub(APP_ID)
+        attempts = []
+        @ndb.transactional(retries=1)
+        def t():
+            e = k.get(use_cache=False, use_memcache=False)
+            if not attempts:
+                # another process stores the entity outside of transaction
+                other._Put(T(key=k, a=100)._to_pb(), False)
+                # another transaction of this process reads the group again
+                self._datastore_stub._GetEntitiesInEntityGroup(k.reference())
+            attempts.append(e.a)
+            e.a += 1
+            e.put()
+        try:
+            t()
+            self.assertEqual(attempts, [0, 100])
+            self.assertEqual(k.get(use_cache=False, use_memcache=False).a, 101)
+        finally:
+            other.Close()
+            k.delete()
+
+    def test_allocate_ids_threads(self):
+        class IdKind(ndb.Model):
+            pass
+        ranges = []
+        def worker():
+            for _ in xrange(20):
+                ranges.append(IdKind.allocate_ids(size=5))
+        threads = [threading.Thread(target=worker) for _ in xrange(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        ids = [i for first, last in ranges for i in xrange(first, last + 1)]
+        self.assertEqual(len(ids), 4 * 20 * 5)
+        self.assertEqual(len(set(ids)), len(ids))
+        last_id = max(ids)
+        self.assertEqual(IdKind.allocate_ids(max=last_id + 100),
+                         (last_id + 1, last_id + 100))
+
+    def _check_transactional_commit(self, stub):
+        class AtomicKind(ndb.Model):
+            a = ndb.IntegerProperty()
+        apiproxy_stub_map.apiproxy.ReplaceStub('datastore_v3', stub)
+        keys = []
+        try:
+            keys = ndb.put_multi([AtomicKind(a=i) for i in xrange(2)])
+            attempts = []
+            @ndb.transactional(xg=True, retries=1)
+            def t():
+                entities = ndb.get_multi(keys, use_cache=False,
+                                         use_memcache=False)
+                if not attempts:
+                    # commit from another process
+                    stub._mongods.bump_entity_group_version(
+                            keys[0].reference())
+                attempts.append(1)
+                entities[0].a += 10
+                entities[0].put()
+                keys[1].delete()
+            t()
+            self.assertEqual(len(attempts), 2)
+            self.assertEqual(keys[0].get(use_cache=False,
+                                         use_memcache=False).a, 10)
+            self.assertEqual(keys[1].get(use_cache=False,
+                                         use_memcache=False), None)
+        finally:
+            ndb.delete_multi(keys)
+            apiproxy_stub_map.apiproxy.ReplaceStub('datastore_v3',
+                                                   self._datastore_stub)
+            stub.Close()
+
+    def test_atomic_commit(self):
+        stub = DatastoreMongoDBStub(APP_ID, atomic_commit=True)
+        if not stub._mongods.atomic_commit:
+            stub.Close()
+            self.skipTest("mongod does not support transactions")
+        self._check_transactional_commit(stub)
+
+    def test_atomic_commit_fallback(self):
+        supports_transactions = MongoDatastore._supports_transactions
+        # server without replica set
+        MongoDatastore._supports_transactions = lambda self: False
+        try:
+            stub = DatastoreMongoDBStub(APP_ID, atomic_commit=True)
+        finally:
+            MongoDatastore._supports_transactions = supports_transactions
+        self.assertFalse(stub._mongods.atomic_commit)
+        self._check_transactional_commit(stub)
+
+    def test_write_concern(self):
+        """Writes outside of transactions are not acknowledged."""
+        mongods = self._datastore_stub._mongods
+        self.assertEqual(mongods.write_concern.get('w'), 0)
+
+    def test_atomic_commit_replica_set(self):
+        """Transactions of pymongo >= 3.7 against replica set given by
+           MONGODB_REPLICA_SET_URI, e.g.
+           mongodb://localhost:27018/?replicaSet=rs0
+        """
+        uri = os.environ.get('MONGODB_REPLICA_SET_URI')
+        if not uri or not datastore_mongodb_stub.PYM_3_7:
+            self.skipTest("needs pymongo >= 3.7 and MONGODB_REPLICA_SET_URI")
+        stub = DatastoreMongoDBStub(APP_ID, mongodb_host=uri,
+                                    atomic_commit=True, gridfs_threshold=100)
+        self.assertTrue(stub._mongods.atomic_commit)
+        self.assertEqual(stub._mongods.write_concern.get('w'), 0)
+        self._check_transactional_commit(
+                DatastoreMongoDBStub(APP_ID, mongodb_host=uri,
+                                     atomic_commit=True))
+        apiproxy_stub_map.apiproxy.ReplaceStub('datastore_v3', stub)
+        class AtomicLarge(ndb.Model):
+            t = ndb.TextProperty()
+        try:
+            k = AtomicLarge(t=u'a').put()
+            attempts = []
+            @ndb.transactional(retries=1)
+            def t():
+                e = k.get(use_cache=False, use_memcache=False)
+                if not attempts:
+                    # commit from another process
+                    stub._mongods.bump_entity_group_version(k.reference())
+                attempts.append(1)
+                e.t = u'x' * 1000
+                e.put()
+            t()
+            self.assertEqual(len(attempts), 2)
+            self.assertEqual(k.get(use_cache=False, use_memcache=False).t,
+                             u'x' * 1000)
+            # values stored by the aborted attempt are deleted from GridFS
+            self.assertEqual(stub._mongods._db['_gridfs.files'].count(), 1)
+        finally:
+            apiproxy_stub_map.apiproxy.ReplaceStub('datastore_v3',
+                                                   self._datastore_stub)
+            stub.Clear()
+            stub.Close()
+
+    def test_async_rpc(self):
+        stub = DatastoreMongoDBStub(APP_ID, rpc_threads=4)
+        apiproxy_stub_map.apiproxy.ReplaceStub('datastore_v3', stub)
+        class A(ndb.Model):
+            a = ndb.IntegerProperty()
+        keys = []
+        try:
+            futures = [A(a=i).put_async() for i in xrange(10)]
+            keys = [f.get_result() for f in futures]
+            futures = [A.query(A.a == i).fetch_async() for i in xrange(10)]
+            l = [f.get_result() for f in futures]
+            self.assertEqual([[x.a for x in r] for r in l],
+                             [[i] for i in xrange(10)])
+        finally:
+            ndb.delete_multi(keys)
+            apiproxy_stub_map.apiproxy.ReplaceStub('datastore_v3',
+                                                   self._datastore_stub)
+            stub.Close()
+
+
+    def test_unindexed_properties(self):
+        class U(ndb.Model):
+            a = ndb.IntegerProperty()
+            b = ndb.IntegerProperty(indexed=False)
+            c = ndb.TextProperty()
+            d = ndb.BlobProperty()
+        k = U(a=1, b=2, c=u'text', d='blob').put()
+        try:
+            mongods = self._datastore_stub._mongods
+            info = mongods._db['u'].index_information()
+            fields = set(f for index in info.values() for f, _ in index['key'])
+            self.assertTrue('_s.a' in fields)
+            # values are filtered by sort keys
+            self.assertFalse('a' in fields)
+            for attr in ('b', 'c', 'd'):
+                self.assertFalse(attr in fields)
+                self.assertFalse(attr + '.v' in fields)
+                self.assertFalse('_s.' + attr in fields)
+            self.assertEqual(U.query().order(U.a).fetch(), [k.get()])
+            # index created before the property was declared unindexed
+            mongods._db['u'].ensure_index('b')
+            self.assertTrue(('u', 'b_1') in mongods.superfluous_indexes())
+            # index of values created by older versions
+            mongods._db['u'].ensure_index('a')
+            self.assertTrue(('u', 'a_1') in mongods.superfluous_indexes())
+            self.assertFalse(('u', '_s.a_1') in mongods.superfluous_indexes())
+        finally:
+            k.delete()
+
+    def test_query_projection_unknown_repeated(self):
+        class P(ndb.Model):
+            x = ndb.IntegerProperty(repeated=True)
+        k = P(x=[1, 2, 3, 2]).put()
+        try:
+            # schema written by another process does not know x is a list
+            schema = self._datastore_stub._mongods.schema
+            schema._schema_coll.update({'_id': 'p'}, {'$unset': {'x': 1}})
+            schema._local_schema['p'].pop('x')
+            l = P.query(P.x > 1).fetch(projection=['x'])
+            self.assertEqual([p._to_dict() for p in l], [{'x': [2]}, {'x': [3]}])
+            l = P.query().fetch(projection=['x'])
+            self.assertEqual([p.x for p in l], [[1], [2], [3]])
+        finally:
+            k.delete()
+
+    def test_entity_group_kinds(self):
+        class GroupRoot(ndb.Model):
+            pass
+        class GroupChild(ndb.Model):
+            pass
+        class GroupTxnChild(ndb.Model):
+            pass
+        root = GroupRoot().put()
+        keys = [root, GroupChild(parent=root).put(),
+                ndb.transaction(lambda: GroupTxnChild(parent=root).put())]
+        try:
+            mongods = self._datastore_stub._mongods
+            doc = mongods._db[mongods.ENTITY_GROUP_COLLECTION].find_one(
+                    {'k': 'grouproot'})
+            self.assertEqual(sorted(doc['k']),
+                             ['groupchild', 'grouproot', 'grouptxnchild'])
+            entities = mongods.get_entity_group(root.reference())
+            self.assertEqual(sorted(e.key().path().element_list()[-1].type()
+                                    for e in entities),
+                             ['GroupChild', 'GroupRoot', 'GroupTxnChild'])
+        finally:
+            ndb.delete_multi(keys)
+
+    def test_prefetcher(self):
+        threads = threading.active_count()
+        streams = [_Prefetcher(iter(xrange(i, 250, 10)), 7) for i in xrange(10)]
+        self.assertEqual(sorted(x for stream in streams for x in stream),
+                         range(250))
+        # batches of all streams are read by the shared pool
+        self.assertTrue(threading.active_count() <=
+                        threads + _Prefetcher.POOL_SIZE)
+        def failing():
+            yield 1
+            raise ValueError()
+        self.assertRaises(ValueError, list, _Prefetcher(failing(), 7))
+
+    def test_gridfs_large_values(self):
+        stub = DatastoreMongoDBStub(APP_ID, gridfs_threshold=100,
+                                    gridfs_compress=True)
+        apiproxy_stub_map.apiproxy.ReplaceStub('datastore_v3', stub)
+        class G(ndb.Model):
+            a = ndb.IntegerProperty()
+            t = ndb.TextProperty()
+            b = ndb.BlobProperty()
+        text = unichr(269) * 1000
+        g = G(a=1, t=text, b='small')
+        k = g.put()
+        try:
+            mongods = stub._mongods
+            doc = mongods._db['g'].find_one()
+            self.assertTrue('r' in doc['t'] and 'v' not in doc['t'])
+            self.assertEqual(doc['b']['v'], 'small')
+            self.assertEqual(k.get(use_cache=False, use_memcache=False), g)
+            self.assertEqual(G.query(G.a == 1).fetch(), [g])
+            # overwritten value is removed from GridFS
+            g.t = u'x' * 200
+            g.put()
+            self.assertEqual(mongods._db['_gridfs.files'].count(), 1)
+            self.assertEqual(k.get(use_cache=False, use_memcache=False), g)
+        finally:
+            k.delete()
+            self.assertEqual(stub._mongods._db['_gridfs.files'].count(), 0)
+            apiproxy_stub_map.apiproxy.ReplaceStub('datastore_v3',
+                                                   self._datastore_stub)
+
+    def test_gridfs_read_without_threshold(self):
+        writer = DatastoreMongoDBStub(APP_ID, gridfs_threshold=100)
+        apiproxy_stub_map.apiproxy.ReplaceStub('datastore_v3', writer)
+        class H(ndb.Model):
+            a = ndb.IntegerProperty()
+            t = ndb.TextProperty()
+        h = H(a=1, t=u'x' * 1000)
+        k = h.put()
+        try:
+            # stub without threshold loads the values stored in GridFS
+            apiproxy_stub_map.apiproxy.ReplaceStub('datastore_v3',
+                                                   self._datastore_stub)
+            self.assertEqual(k.get(use_cache=False, use_memcache=False), h)
+            self.assertEqual(H.query(H.a == 1).fetch(), [h])
+            # but does not look up files of the entities it overwrites
+            h.t = u'y' * 1000
+            h.put()
+            mongods = self._datastore_stub._mongods
+            self.assertEqual(mongods._db['_gridfs.files'].count(), 1)
+            self.assertEqual(mongods._db['h'].find_one()['t']['v'], h.t)
+        finally:
+            # stub with threshold removes all files of the deleted entity
+            apiproxy_stub_map.apiproxy.ReplaceStub('datastore_v3', writer)
+            k.delete()
+            apiproxy_stub_map.apiproxy.ReplaceStub('datastore_v3',
+                                                   self._datastore_stub)
+        self.assertEqual(writer._mongods._db['_gridfs.files'].count(), 0)
+
+    def test_entity_cache(self):
+        stub = DatastoreMongoDBStub(APP_ID, entity_cache_size=2)
+        apiproxy_stub_map.apiproxy.ReplaceStub('datastore_v3', stub)
+        class C(ndb.Model):
+            a = ndb.IntegerProperty()
+        keys = []
+        try:
+            keys = ndb.put_multi([C(a=i) for i in xrange(3)])
+            for k in keys + keys[1:]:
+                k.get(use_cache=False, use_memcache=False)
+            stats = stub.GetEntityCacheStats()
+            self.assertEqual(stats['misses'], 3)
+            self.assertEqual(stats['hits'], 2)
+            self.assertEqual(stats['entries'], 2)
+            self.assertEqual(stats['evictions'], 1)
+            # write evicts the entity
+            e = C(key=keys[2], a=10)
+            e.put()
+            self.assertEqual(keys[2].get(use_cache=False, use_memcache=False), e)
+            self.assertEqual(stub.GetEntityCacheStats()['misses'], 4)
+        finally:
+            ndb.delete_multi(keys)
+            apiproxy_stub_map.apiproxy.ReplaceStub('datastore_v3',
+                                                   self._datastore_stub)
+
+    def test_watch_changes(self):
+        """Entity changed by another process is evicted from the cache."""
+        stubs = [DatastoreMongoDBStub(APP_ID, entity_cache_size=10,
+                                      watch_changes=True) for _ in xrange(2)]
+        class W(ndb.Model):
+            a = ndb.IntegerProperty()
+        w = W(a=1)
+        k = w.put()
+        try:
+            reader, writer = [s._mongods for s in stubs]
+            read = lambda: W._from_pb(reader.get(k.reference())).a
+            self.assertEqual(read(), 1)
+            w.a = 2
+            writer.put([w._to_pb()])
+            for _ in xrange(50):
+                if read() == 2:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(read(), 2)
+        finally:
+            k.delete()
+            for s in stubs:
+                s.Close()
+
+    def test_watch_changes_unordered_ids(self):
+        """Invalidations are tailed in insertion order, ObjectIds created
+           by other processes may be lower than the last seen one.
+        """
+        supports_change_streams = MongoDatastore._supports_change_streams
+        MongoDatastore._supports_change_streams = lambda self: False
+        try:
+            stub = DatastoreMongoDBStub(APP_ID, entity_cache_size=10,
+                                        watch_changes=True)
+        finally:
+            MongoDatastore._supports_change_streams = supports_change_streams
+        class V(ndb.Model):
+            a = ndb.IntegerProperty()
+        v = V(a=1)
+        k = v.put()
+        try:
+            reader = stub._mongods
+            read = lambda: V._from_pb(reader.get(k.reference())).a
+            self.assertEqual(read(), 1)
+            # another process writes the entity and announces it
+            v.a = 2
+            self._datastore_stub._mongods.put([v._to_pb()])
+            key = datastore_mongodb_stub._Key(k.reference(), APP_ID)
+            reader._db['_invalidations'].insert(
+                    {'_id': ObjectId('0' * 24), 'c': key.collection(),
+                     'k': key.to_mongo_key()})
+            for _ in xrange(50):
+                if read() == 2:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(read(), 2)
+        finally:
+            k.delete()
+            stub.Close()
+
+    def test_query_cache(self):
+        stub = DatastoreMongoDBStub(APP_ID, query_cache_size=10)
+        apiproxy_stub_map.apiproxy.ReplaceStub('datastore_v3', stub)
+        class R(ndb.Model):
+            a = ndb.IntegerProperty()
+        keys = []
+        try:
+            keys = ndb.put_multi([R(a=i) for i in xrange(5)])
+            q = R.query(R.a >= 2).order(R.a)
+            first = q.fetch()
+            self.assertEqual(q.fetch(), first)
+            self.assertEqual(stub.GetQueryCacheStats()['hits'], 1)
+            # write into the kind invalidates cached results
+            keys.append(R(a=10).put())
+            self.assertEqual([x.a for x in q.fetch()], [2, 3, 4, 10])
+            self.assertEqual(stub.GetQueryCacheStats()['hits'], 1)
+        finally:
+            ndb.delete_multi(keys)
+            apiproxy_stub_map.apiproxy.ReplaceStub('datastore_v3',
+                                                   self._datastore_stub)
+
+    def test_query_plans(self):
+        class QueryPlanKind(ndb.Model):
+            a = ndb.IntegerProperty()
+            b = ndb.StringProperty()
+        Q = QueryPlanKind
+        keys = ndb.put_multi([Q(a=i, b=str(i)) for i in xrange(5)])
+        try:
+            hits = self._datastore_stub.GetQueryPlanStats()['hits']
+            for i in xrange(5):
+                l = Q.query(Q.a >= i).order(Q.a).fetch()
+                self.assertEqual([x.a for x in l], range(i, 5))
+            stats = self._datastore_stub.GetQueryPlanStats()
+            self.assertEqual(stats['hits'] - hits, 4)
+            # values of the same shape do not leak between queries
+            self.assertEqual(Q.query(Q.b == '3').get().a, 3)
+            self.assertEqual(Q.query(Q.b == '1').get().a, 1)
+        finally:
+            ndb.delete_multi(keys)
+
+    def test_bulk_export_import(self):
+        class BulkKind(ndb.Model):
+            a = ndb.IntegerProperty()
+        keys = ndb.put_multi([BulkKind(a=i) for i in xrange(20)])
+        directory = tempfile.mkdtemp()
+        copy_id = APP_ID + '_bulk'
+        conn = self._datastore_stub._mongods._conn
+        db, copy_db = conn[APP_ID], conn[copy_id]
+        try:
+            datastore_mongodb_bulk.export_data(APP_ID, directory,
+                                               compress=True, processes=2)
+            counts = datastore_mongodb_bulk.import_data(copy_id, directory,
+                                                        drop=True, processes=2)
+            self.assertEqual(counts['bulkkind'], 20)
+            self.assertEqual(list(copy_db.bulkkind.find().sort('_id')),
+                             list(db.bulkkind.find().sort('_id')))
+            self.assertEqual(sorted(copy_db.bulkkind.index_information()),
+                             sorted(db.bulkkind.index_information()))
+            # import would mix the data with existing ones
+            self.assertRaises(datastore_mongodb_bulk.DatabaseNotEmptyError,
+                              datastore_mongodb_bulk.import_data, copy_id,
+                              directory, processes=2)
+            self.assertEqual(copy_db.bulkkind.count(), 20)
+        finally:
+            conn.drop_database(copy_id)
+            shutil.rmtree(directory)
+            ndb.delete_multi(keys)
+
+    def test_load_file_stub(self):
+        class LoadedKind(ndb.Model):
+            a = ndb.IntegerProperty()
+            t = ndb.TextProperty()
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'datastore')
+        copy_id = APP_ID + '_load'
+        file_stub = DatastoreFileStub(APP_ID, path, None)
+        apiproxy_stub_map.apiproxy.ReplaceStub('datastore_v3', file_stub)
+        try:
+            keys = ndb.put_multi([LoadedKind(a=i, t='x' * i) for i in xrange(5)])
+            file_stub.Write()
+            apiproxy_stub_map.apiproxy.ReplaceStub('datastore_v3',
+                                                   self._datastore_stub)
+            counts = datastore_mongodb_bulk.load_stub_file(copy_id, path,
+                                                           batch_size=2)
+            self.assertEqual(counts, {'loadedkind': 5})
+            mongods = DatastoreMongoDBStub(copy_id)._mongods
+            for i, k in enumerate(keys):
+                e = LoadedKind._from_pb(mongods.get(k.reference()))
+                self.assertEqual((e.a, e.t), (i, 'x' * i))
+            self.assertEqual(mongods.schema.get_unindexed('loadedkind'), set(['t']))
+        finally:
+            apiproxy_stub_map.apiproxy.ReplaceStub('datastore_v3',
+                                                   self._datastore_stub)
+            self._datastore_stub._mongods._conn.drop_database(copy_id)
+            shutil.rmtree(directory)
+
+    def test_load_sqlite_stub(self):
+        class SqliteKind(ndb.Model):
+            a = ndb.IntegerProperty()
+            s = ndb.StringProperty(repeated=True)
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'datastore.sqlite')
+        copy_id = APP_ID + '_load_sqlite'
+        sqlite_stub = DatastoreSqliteStub(APP_ID, path)
+        apiproxy_stub_map.apiproxy.ReplaceStub('datastore_v3', sqlite_stub)
+        try:
+            parent = SqliteKind(a=0).put()
+            keys = [parent] + ndb.put_multi(
+                    [SqliteKind(parent=parent, a=i, s=['x'] * i)
+                     for i in xrange(1, 4)])
+            apiproxy_stub_map.apiproxy.ReplaceStub('datastore_v3',
+                                                   self._datastore_stub)
+            counts = datastore_mongodb_bulk.load_stub_file(copy_id, path)
+            self.assertEqual(counts, {'sqlitekind': 4})
+            mongods = DatastoreMongoDBStub(copy_id)._mongods
+            for i, k in enumerate(keys):
+                e = SqliteKind._from_pb(mongods.get(k.reference()))
+                self.assertEqual((e.a, e.s), (i, ['x'] * i))
+            self.assertEqual(len(mongods.get_entity_group(parent.reference())), 4)
+        finally:
+            apiproxy_stub_map.apiproxy.ReplaceStub('datastore_v3',
+                                                   self._datastore_stub)
+            self._datastore_stub._mongods._conn.drop_database(copy_id)
+            shutil.rmtree(directory)
+
+    def test_snapshots(self):
+        class SnapKind(ndb.Model):
+            a = ndb.IntegerProperty()
+        class OtherSnapKind(ndb.Model):
+            b = ndb.StringProperty()
+        stub = self._datastore_stub
+        keys = ndb.put_multi([SnapKind(a=i) for i in xrange(10)])
+        mongods = stub._mongods
+        try:
+            stub.CreateSnapshot('fixture')
+            ndb.delete_multi(keys[:5])
+            SnapKind(a=100).put()
+            other = OtherSnapKind(b='x').put()
+            version = mongods.get_entity_group_version(keys[0].reference())
+            # indexes loaded by the stub are replaced by the restored ones
+            stub._BaseIndexManager__indexes['snapshot-app'].append(None)
+            stub.RestoreSnapshot('fixture')
+            self.assertEqual([e.a for e in SnapKind.query().order(SnapKind.a)],
+                             range(10))
+            # restored version is not mistaken for a version seen before
+            self.assertTrue(mongods.get_entity_group_version(
+                    keys[0].reference()) > version)
+            self.assertFalse('snapshot-app' in stub._BaseIndexManager__indexes)
+            self.assertEqual(other.get(use_cache=False, use_memcache=False),
+                             None)
+            self.assertEqual([c for c in stub._mongods.entity_collections()
+                              if c.startswith('_snap.')], [])
+            self.assertRaises(ValueError, stub.RestoreSnapshot, 'missing')
+        finally:
+            stub.DeleteSnapshot('fixture')
+            ndb.delete_multi(SnapKind.query().fetch(keys_only=True))
+
+    def test_datastore_stats(self):
+        class StatKind(ndb.Model):
+            a = ndb.IntegerProperty()
+            b = ndb.StringProperty()
+        mongods = self._datastore_stub._mongods
+        mongods._stat_counters = True
+        keys = ndb.put_multi([StatKind(a=i, b='x') for i in xrange(5)])
+        try:
+            kind_stat = stats.KindStat.query(
+                    stats.KindStat.kind_name == 'StatKind').get()
+            self.assertEqual(kind_stat.count, 5)
+            self.assertTrue(kind_stat.bytes >= kind_stat.entity_bytes > 0)
+            self.assertTrue(stats.GlobalStat.query().get().count >= 5)
+            def counts():
+                return dict((s.property_type, s.count)
+                            for s in stats.PropertyTypeStat.query())
+            before = counts()
+            ndb.delete_multi(keys[:2])
+            after = counts()
+            self.assertEqual(before['Integer'] - after['Integer'], 2)
+            self.assertEqual(before['String'] - after['String'], 2)
+        finally:
+            mongods._stat_counters = False
+            ndb.delete_multi(keys)
+            mongods._db[mongods.STATS_COLLECTION].drop()
+
+    def test_stat_counters_rebuild(self):
+        class RebuiltStatKind(ndb.Model):
+            a = ndb.IntegerProperty()
+        stub = self._datastore_stub
+        mongods = stub._mongods
+        stats_coll = mongods._db[mongods.STATS_COLLECTION]
+        # entities written before the counters were maintained
+        keys = ndb.put_multi([RebuiltStatKind(a=i) for i in xrange(3)])
+        try:
+            stub.CreateSnapshot('stats')
+            mongods._stat_counters = True
+            ndb.delete_multi(keys[:2])
+            counters = stats_coll.find_one({'_id': 'rebuiltstatkind'})
+            self.assertEqual(counters['Integer']['count'], -2)
+            stub.RestoreSnapshot('stats')
+            counters = stats_coll.find_one({'_id': 'rebuiltstatkind'})
+            self.assertEqual(counters['Integer']['count'], 3)
+            stub.Clear()
+            self.assertEqual(stats_coll.find_one(), None)
+        finally:
+            mongods._stat_counters = False
+            stub.DeleteSnapshot('stats')
+            ndb.delete_multi(keys)
+            stats_coll.drop()
+
+    def test_split_points(self):
+        class SplitKind(ndb.Model):
+            a = ndb.IntegerProperty()
+        stub = self._datastore_stub
+        keys = ndb.put_multi([SplitKind(a=i) for i in xrange(200)])
+        try:
+            # the SDK sets scatter property on a part of entities
+            scattered = SplitKind.query().order(
+                    ndb.GenericProperty('__scatter__')).fetch(keys_only=True)
+            self.assertTrue(0 < len(scattered) < len(keys))
+            self.assertEqual(stub.GetSplitPoints('SplitKind', 1), [])
+            points = stub.GetSplitPoints('SplitKind', 4)
+            self.assertEqual(len(points), 3)
+            self.assertEqual(points, sorted(points))
+            bounds = [None] + [ndb.Key.from_old_key(p) for p in points] + [None]
+            sizes = []
+            for lo, hi in zip(bounds, bounds[1:]):
+                query = SplitKind.query()
+                if lo is not None:
+                    query = query.filter(SplitKind.key >= lo)
+                if hi is not None:
+                    query = query.filter(SplitKind.key < hi)
+                sizes.append(query.count())
+            self.assertEqual(sum(sizes), len(keys))
+            self.assertTrue(min(sizes) > 10)
+            # scatter values are filtered as bytes, in the same way as
+            # they are stored
+            mongods = stub._mongods
+            sort_keys = sorted(
+                    d['_s']['__scatter__'] for d in mongods._db['splitkind'].find(
+                            {'_s.__scatter__': {'$exists': True}}))
+            middle = len(sort_keys) / 2
+            query = datastore_pb.Query()
+            query.set_app(APP_ID)
+            query.set_kind('SplitKind')
+            query.set_keys_only(True)
+            f = query.add_filter()
+            f.set_op(datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL)
+            prop = f.add_property()
+            prop.set_name('__scatter__')
+            prop.set_multiple(False)
+            prop.set_meaning(entity_pb.Property.BYTESTRING)
+            prop.mutable_value().set_stringvalue(
+                    sort_keys[middle][1:].encode('latin-1'))
+            self.assertEqual(len(list(mongods.query(query))),
+                             len(sort_keys) - middle)
+        finally:
+            ndb.delete_multi(keys)
+
+    def test_query_read_preference(self):
+        class ReadPrefKind(ndb.Model):
+            a = ndb.IntegerProperty()
+        parent = ndb.Key('ReadPrefParent', 1)
+        keys = ndb.put_multi([ReadPrefKind(parent=parent, a=i)
+                              for i in xrange(3)])
+        stub_mongods = self._datastore_stub._mongods
+        query_db = stub_mongods._query_db
+        mongods = MongoDatastore('localhost', 27017, APP_ID,
+                                 query_read_preference='secondaryPreferred')
+        try:
+            self.assertEqual(mongods._query_db.read_preference,
+                             ReadPreference.SECONDARY_PREFERRED)
+            self.assertEqual(mongods._db.read_preference,
+                             ReadPreference.PRIMARY)
+            self.assertRaises(ValueError, MongoDatastore, 'localhost', 27017,
+                              APP_ID, query_read_preference='fastest')
+            # standalone server serves reads of every preference
+            stub_mongods._query_db = mongods._query_db
+            self.assertEqual(sorted(e.a for e in ReadPrefKind.query()),
+                             [0, 1, 2])
+            self.assertEqual([e.a for e in ReadPrefKind.query(ancestor=parent)
+                              .order(ReadPrefKind.a)], [0, 1, 2])
+        finally:
+            stub_mongods._query_db = query_db
+            mongods.close()
+            ndb.delete_multi(keys)
+
+    def test_replica_set_client(self):
+        """pymongo < 3.0 reads from secondaries only by replica set client,
+           which gets seed list instead of host and port.
+        """
+        created = []
+        class ReplicaSetClient(MongoClient):
+            def __init__(self, seeds, **options):
+                created.append((seeds, options))
+                # the test server is standalone
+                MongoClient.__init__(self, 'localhost', 27017)
+        module = datastore_mongodb_stub
+        client_class, cursor_type = module.MongoReplicaSetClient, module.CursorType
+        module.MongoReplicaSetClient, module.CursorType = ReplicaSetClient, None
+        try:
+            for host, port in [('localhost', 27017), ('db1:27018', 27017),
+                               ('mongodb://db1,db2', 27017)]:
+                MongoDatastore(host, port, APP_ID, replica_set='rs0').close()
+            # without replica set the client is not needed
+            MongoDatastore('localhost', 27017, APP_ID).close()
+        finally:
+            module.MongoReplicaSetClient = client_class
+            module.CursorType = cursor_type
+        self.assertEqual(created, [('localhost:27017', {'replicaSet': 'rs0'}),
+                                   ('db1:27018', {'replicaSet': 'rs0'}),
+                                   ('mongodb://db1,db2', {'replicaSet': 'rs0'})])
+
+
+class TestDatastoreMongodbMemoryStub(_DatastoreStubTests, unittest.TestCase):
+    """
+    Test mongodb stub with the in-process storage engine.
+    """
+    def __init__(self, *args, **kwargs):
+        unittest.TestCase.__init__(self, *args, **kwargs)
+        _DatastoreStubTests.__init__(self)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._datastore_stub.Clear()
+
+    @classmethod
+    def setUpClass(cls):
+        datastore_stub = DatastoreMongoDBStub(APP_ID, in_memory=True)
+        apiproxy_stub_map.apiproxy.ReplaceStub('datastore_v3', datastore_stub)
+        cls._datastore_stub = datastore_stub
+        underline = '~'*len(cls.__name__)
+        sys.stderr.write(underline + '\n' +cls.__name__ + '\n' + underline \
+                         + textwrap.dedent(cls.__doc__) + '\n')
+
+    def test_memory_engine_queries(self):
+        db = datastore_mongodb_memory.MemoryClient()['memory_engine_test']
+        coll = db['c']
+        try:
+            coll.ensure_index('a')
+            coll.insert([{'_id': 2, 'a': [1, 5]}, {'_id': 1, 'a': u'x'},
+                         {'_id': 3, 'a': 3}, {'_id': 4}])
+            def find(spec, *order):
+                cursor = coll.find(spec)
+                if order:
+                    cursor.sort(list(order))
+                return [d['_id'] for d in cursor]
+            self.assertEqual(find({}), [1, 2, 3, 4])
+            # ranges match array elements of the same type only
+            self.assertEqual(find({'a': {'$gt': 2}}), [2, 3])
+            self.assertEqual(find({'a': 5}), [2])
+            self.assertEqual(find({'a': None}), [4])
+            # null < numbers < strings, arrays by their smallest element
+            self.assertEqual(find({}, ('a', 1)), [4, 2, 3, 1])
+            self.assertEqual(find({}, ('a', -1)), [1, 2, 3, 4])
+            self.assertRaises(DuplicateKeyError, coll.insert, {'_id': 1})
+            self.assertEqual(coll.find_one(3, {'_id': 0}), {'a': 3})
+        finally:
+            db.client.drop_database(db)
@@ -49,6 +49,15 @@ class TestPatchedTestbedInitialization(unittest.TestCase):
         # deactivate stub
         self.testbed.init_datastore_v3_stub(enable=False)
 
+    def test_init_in_memory(self):
+        # no mongod is needed, host and port are ignored
+        self.testbed.init_datastore_v3_stub(use_mongodb='memory',
+                                            mongodb_host='some.host',
+                                            mongodb_port=55555)
+        stub = self.testbed.get_stub('datastore_v3')
+        self.assertIsInstance(stub, DatastoreMongoDBStub)
+        self.testbed.init_datastore_v3_stub(enable=False)
+
     def test_init_host_port(self):
         with self.assertRaises(AutoReconnect):
             self.testbed.init_datastore_v3_stub(use_mongodb=True,